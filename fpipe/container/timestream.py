@@ -9,10 +9,16 @@ Inheritance diagram
 
 """
 
+import logging
+import warnings
 from tlpipe.container import timestream
 from caput import mpiarray
 from caput import memh5
+from caput import mpiutil
 import numpy as np
+import h5py
+
+logger = logging.getLogger(__name__)
 
 class FAST_Timestream(timestream.Timestream):
     """Container class for the timestream data.
@@ -59,6 +65,26 @@ class FAST_Timestream(timestream.Timestream):
 
     def lin2I(self):
         """Convert the linear polarized data to Stokes I only."""
+
+        self.lin2stokes('I')
+
+    def lin2stokes(self, stokes='IQUV', time_chunk=1024):
+        """Convert the linear polarized data to Stokes parameters in place.
+
+        The Stokes parameters in `stokes` are computed in one pass, chunk by
+        chunk along time, into the leading slots of the polarization axis of
+        the existing main data, and the polarization axis is then compacted
+        within the same buffer, so the main data is never held twice. The
+        data is only redistributed if polarization is the distributed axis.
+
+            I = 0.5 * (hh + vv)
+            Q = 0.5 * (hh - vv)
+            U = 0.5 * (hv + vh)
+            V = -0.5j * (hv - vh)
+
+        A Stokes parameter is masked if any of its linear polarizations is
+        masked.
+        """
         try:
             pol = self.pol
         except KeyError:
@@ -71,65 +97,352 @@ class FAST_Timestream(timestream.Timestream):
             pol.attrs['pol_type'] = 'linear'
 
         if pol.attrs['pol_type'] == 'stokes' and pol.shape[0] == 4:
-            warning.warn('Data is already Stokes polarization, no need to convert')
+            warnings.warn('Data is already Stokes polarization, no need to convert')
             return
 
-        if pol.attrs['pol_type'] == 'linear' and pol.shape[0] >=2:
-
-            # redistribute to 0 axis if polarization is the distributed axis
-            original_dist_axis = self.main_data_dist_axis
-            if 'polarization' == self.main_data_axes[self.main_data_dist_axis]:
-                self.redistribute(0)
-
-            pol = pol[:].tolist()
-            p = self.pol_dict
-            if pol[0] == 'hh':
-                # for some reason, pol attr recorded in MeerKAT data are
-                # ['hh', 'vv', 'hv', 'vh'], change it back to [0, 1, 2, 3]
-                pol = [p[_p] for _p in pol]
-
-            # create a new MPIArray to hold the new data
-            shp = self.main_data.shape
-            shp = shp[:-2] + (1, ) + shp[-1:]
-            md = mpiarray.MPIArray(shp, axis=self.main_data_dist_axis, 
-                    comm=self.comm, dtype=self.main_data.dtype)
-            # convert to Stokes I, Q, U, V
-            #print "convert to Stokes I, Q, U, V "
-            md.local_array[:, :, 0] = 0.5 * ( 
-                      self.main_data.local_data[:, :, pol.index(p['hh'])]\
-                    + self.main_data.local_data[:, :, pol.index(p['vv'])]) # I
+        if pol.attrs['pol_type'] != 'linear' or pol.shape[0] < 2:
+            raise RuntimeError('Can not convert to Stokes polarization')
+
+        pol = pol[:].tolist()
+        p = self.pol_dict
+        if isinstance(pol[0], str):
+            # for some reason, pol attr recorded in MeerKAT data are
+            # ['hh', 'vv', 'hv', 'vh'], change it back to [0, 1, 2, 3]
+            pol = [p[_p] for _p in pol]
+
+        need = set()
+        for s in stokes:
+            need.update({'I': 'hh vv', 'Q': 'hh vv', 'U': 'hv vh',
+                'V': 'hv vh'}[s].split())
+        missing = [_p for _p in need if p[_p] not in pol]
+        if len(missing) > 0:
+            raise RuntimeError('Can not convert to Stokes %s without %s'
+                    %(stokes, missing))
+        if 'V' in stokes and not np.iscomplexobj(self.main_data.local_data):
+            raise RuntimeError('Stokes V needs complex cross polarization data')
+        ind = dict([(_p, pol.index(p[_p])) for _p in need])
+
+        # redistribute to 0 axis if polarization is the distributed axis
+        original_dist_axis = self.main_data_dist_axis
+        if 'polarization' == self.main_data_axes[self.main_data_dist_axis]:
+            self.redistribute(0)
+        dist_axis = self.main_data_dist_axis
 
+        names = [self.main_data_name, ]
+        if self.main_data_name + '_mask' in self.keys():
+            names.append(self.main_data_name + '_mask')
+        for name in names:
+            local = self[name].local_data
+            is_mask = local.dtype.kind == 'b'
+            for st in range(0, local.shape[0], time_chunk):
+                et = min(st + time_chunk, local.shape[0])
+                lin = dict([(_p, local[st:et, :, ind[_p]]) for _p in need])
+                out = [_stokes_from_lin(lin, s, is_mask) for s in stokes]
+                for ii, _out in enumerate(out):
+                    local[st:et, :, ii] = _out
+                del lin, out
+
+            md = mpiarray.MPIArray.wrap(_compact_pol(local, len(stokes)),
+                    axis=dist_axis)
             attr_dict = {} # temporarily save attrs of this dataset
-            memh5.copyattrs(self.main_data.attrs, attr_dict)
-            del self[self.main_data_name]
-            # create main data
-            self.create_dataset(self.main_data_name, shape=md.shape, 
-                    dtype=md.dtype, data=md, distributed=True, 
-                    distributed_axis=self.main_data_dist_axis)
-            memh5.copyattrs(attr_dict, self.main_data.attrs)
-
-            if self.main_data_name + '_mask' in self.keys():
-                mk = mpiarray.MPIArray(shp, axis=self.main_data_dist_axis, 
-                        comm=self.comm, dtype=self[self.main_data_name + '_mask'].dtype)
-                mk.local_array[:, :, 0] = \
-                self[self.main_data_name + '_mask'].local_data[:, :, pol.index(p['hh'])]\
-                + self[self.main_data_name + '_mask'].local_data[:, :, pol.index(p['vv'])] 
-                attr_dict = {} # temporarily save attrs of this dataset
-                memh5.copyattrs(self[self.main_data_name + '_mask'].attrs, attr_dict)
-                del self[self.main_data_name + '_mask']
-                # create main data mask
-                self.create_dataset(self.main_data_name + '_mask', shape=md.shape, 
-                        dtype=mk.dtype, data=mk, distributed=True, 
-                        distributed_axis=self.main_data_dist_axis)
-                memh5.copyattrs(attr_dict, self[self.main_data_name + '_mask'].attrs)
-
-            del self['pol']
-            self.create_dataset('pol', data=np.array(['I', ]), dtype='S1')
-            self['pol'].attrs['pol_type'] = 'stokes'
-
-            # redistribute self to original axis
+            memh5.copyattrs(self[name].attrs, attr_dict)
+            del local
+            del self[name]
+            self.create_dataset(name, shape=md.shape, dtype=md.dtype, data=md,
+                    distributed=True, distributed_axis=dist_axis)
+            memh5.copyattrs(attr_dict, self[name].attrs)
+            del md
+
+        del self['pol']
+        self.create_dataset('pol', data=np.array(list(stokes)), dtype='S1')
+        self['pol'].attrs['pol_type'] = 'stokes'
+
+        # redistribute self to original axis
+        if self.main_data_dist_axis != original_dist_axis:
             self.redistribute(original_dist_axis)
 
+def file_freq(f):
+    """Frequencies of the open hdf5 file `f`. The converted files only have
+    the `nfreq`, `freqstart` and `freqstep` attrs, the `freq` dataset is
+    built from them if missing, the same as the full loader."""
+
+    if 'freq' in f:
+        return f['freq'][:]
+    return f.attrs['freqstart'] + f.attrs['freqstep'] * np.arange(f.attrs['nfreq'])
+
+def _stokes_from_lin(lin, s, is_mask=False):
+    """Stokes parameter `s` from the dict of linear polarizations."""
+
+    if is_mask:
+        if s in 'IQ':
+            return lin['hh'] | lin['vv']
+        return lin['hv'] | lin['vh']
+    if s == 'I':
+        return 0.5 * (lin['hh'] + lin['vv'])
+    if s == 'Q':
+        return 0.5 * (lin['hh'] - lin['vv'])
+    if s == 'U':
+        return 0.5 * (lin['hv'] + lin['vh'])
+    if s == 'V':
+        return -0.5j * (lin['hv'] - lin['vh'])
+    raise ValueError('Unknown Stokes parameter %s'%s)
+
+def _compact_pol(local, n_pol, row_chunk=4096):
+    """Keep the first `n_pol` polarizations of the (time, freq, pol, bl) array,
+    moving them to the front of the same buffer.
+
+    Returns a contiguous view of the buffer, a copy only if `local` is not
+    contiguous.
+    """
+
+    if n_pol == local.shape[2]:
+        return local
+    if not local.flags.c_contiguous:
+        return np.ascontiguousarray(local[:, :, :n_pol])
+
+    n_time, n_freq, _n_pol, n_bl = local.shape
+    rows = n_time * n_freq
+    flat = local.reshape(-1)
+    old = flat.reshape(rows, _n_pol * n_bl)
+    new = flat[:rows * n_pol * n_bl].reshape(rows, n_pol * n_bl)
+    # the new rows never run ahead of the old ones
+    for st in range(0, rows, row_chunk):
+        et = min(st + row_chunk, rows)
+        new[st:et] = old[st:et, :n_pol * n_bl]
+    return new.reshape(n_time, n_freq, n_pol, n_bl)
+
+def _as_slice(index):
+    """Regular index array to slice, for the hdf5 hyperslab selection."""
+
+    if index.shape[0] == 0:
+        return slice(0, 0)
+    step = index[1] - index[0] if index.shape[0] > 1 else 1
+    return slice(index[0], index[-1] + 1, step)
+
+class LazyTimestream(object):
+    """Read-only view of the timestream files, a dataset is only read on its
+    first access.
+
+    Only the datasets named by the task can be accessed, each is read with
+    the data selection and its hyperslab. The main data and its mask are
+    distributed, only the local part along the distributed axis is read.
+    The datasets along time are concatenated over the files, the others are
+    read from the first file. The size read of each dataset is logged.
+
+    Parameters
+    ----------
+    files : list of str
+        The input files.
+    start, stop : int or None
+        Time range over the concatenated files.
+    dist_axis : int or str
+        The distributed axis of the main data.
+    selection : dict or None
+        {axis name : (start, stop[, step])} data selection of the main axes.
+    datasets : dict or None
+        {dataset name : {axis name : (start, stop[, step])} or None}, the
+        datasets needed and their hyperslabs relative to the selection. The
+        `freq` dataset is built from the file attrs if missing.
+    comm : MPI communicator or None
+    """
+
+    _main_data_name_ = FAST_Timestream._main_data_name_
+    _main_data_axes_ = FAST_Timestream._main_data_axes_
+    _main_axes_ordered_datasets_ = FAST_Timestream._main_axes_ordered_datasets_
+    _time_ordered_datasets_ = FAST_Timestream._time_ordered_datasets_
+    pol_dict = FAST_Timestream.pol_dict
+
+    def __init__(self, files, start=0, stop=None, dist_axis=0, selection=None,
+            datasets=None, comm=None):
+
+        if selection is None:
+            selection = {}
+        if datasets is None:
+            datasets = {}
+        self.files = files
+        self.comm = mpiutil.world if comm is None else comm
+        self.main_data_name = self._main_data_name_
+        self.selection = selection
+        self._datasets = datasets
+        self._cache = {}
+        self.read_size = {}
+
+        with h5py.File(files[0], 'r') as f:
+            self._keys = [name for name in f.keys() if name in datasets]
+            # freq from the nfreq, freqstart, freqstep attrs
+            self._synth_freq = 'freq' in datasets and 'freq' not in f \
+                    and 'nfreq' in f.attrs
+            if self._synth_freq:
+                self._keys.append('freq')
+            self._shape = f[self._main_data_name_].shape
+            self.attrs = dict(f.attrs.items())
+        self._time_len = []
+        for fname in files:
+            with h5py.File(fname, 'r') as f:
+                self._time_len.append(f[self._main_data_name_].shape[0])
+        self._time_index = np.arange(sum(self._time_len))[slice(start, stop)]
+        self.main_data_dist_axis = self._axis_index(dist_axis)
+
+    @property
+    def main_data_axes(self):
+        return self._main_data_axes_
+
+    def _axis_index(self, axis):
+        if isinstance(axis, str):
+            return self._main_data_axes_.index(axis)
+        return axis
+
+    def _main_axes(self, name):
+        """Main axes of each axis of the dataset, None if not along them."""
+
+        if name in self._main_axes_ordered_datasets_:
+            return self._main_axes_ordered_datasets_[name]
+        if name in self._time_ordered_datasets_:
+            return self._time_ordered_datasets_[name]
+        return None
+
+    def _distributed(self, name):
+        return name in (self.main_data_name, self.main_data_name + '_mask')
+
+    def _index(self, name, axis, local=True, hyperslab=None):
+        """Index of the main axis `axis` to read for dataset `name`, with the
+        declared hyperslab if `hyperslab` is None."""
+
+        axis_name = self._main_data_axes_[axis]
+        if axis == 0:
+            index = self._time_index
         else:
-            raise RuntimeError('Can not convert to Stokes polarization')
+            index = np.arange(self._shape[axis])
+        if axis_name in self.selection:
+            index = index[slice(*self.selection[axis_name])]
+        if hyperslab is None:
+            hyperslab = self._datasets[name]
+        if hyperslab is not None and axis_name in hyperslab:
+            index = index[slice(*hyperslab[axis_name])]
+        if local and axis == self.main_data_dist_axis and self._distributed(name):
+            n, st, et = mpiutil.split_local(index.shape[0], comm=self.comm)
+            index = index[st:et]
+        return index
+
+    def _read(self, name, hyperslab=None):
+
+        axes = self._main_axes(name)
+        if name == 'freq' and self._synth_freq:
+            with h5py.File(self.files[0], 'r') as f:
+                data = file_freq(f)[self._index(name, 1, hyperslab=hyperslab)]
+        elif axes is None:
+            with h5py.File(self.files[0], 'r') as f:
+                data = f[name][:]
+        else:
+            sel = [self._index(name, axis, hyperslab=hyperslab)
+                    if axis is not None else None for axis in axes]
+            if axes[0] != 0:
+                with h5py.File(self.files[0], 'r') as f:
+                    data = f[name][tuple([_as_slice(ind) if ind is not None
+                        else slice(None) for ind in sel])]
+            else:
+                data = []
+                offset = 0
+                for fname, n in zip(self.files, self._time_len):
+                    ind = sel[0][(sel[0] >= offset) & (sel[0] < offset + n)]
+                    if ind.shape[0] > 0:
+                        with h5py.File(fname, 'r') as f:
+                            data.append(f[name][(_as_slice(ind - offset), )
+                                + tuple([_as_slice(_ind) if _ind is not None
+                                    else slice(None) for _ind in sel[1:]])])
+                    offset += n
+                data = np.concatenate(data, axis=0)
+
+        self.read_size[name] = self.read_size.get(name, 0) + data.nbytes
+        logger.info('rank %d read %s %s %.2f MB'%(mpiutil.rank, name,
+            data.shape, data.nbytes / 1024.**2))
+        return data
+
+    def read_hyperslab(self, name, hyperslab):
+        """Read the {axis name : (start, stop[, step])} `hyperslab` of dataset
+        `name` relative to the selection, instead of the declared one. The
+        data are not cached."""
+
+        return self._read(name, hyperslab)
+
+    def __getitem__(self, name):
+
+        if name not in self._datasets:
+            raise KeyError('Dataset %s is not declared for lazy read'%name)
+        if name not in self._cache:
+            self._cache[name] = self._read(name)
+        return self._cache[name]
+
+    def __contains__(self, name):
+        return name in self._keys
+
+    def keys(self):
+        return list(self._keys)
+
+    def iterkeys(self):
+        return iter(self._keys)
+
+    @property
+    def main_data(self):
+        return self[self.main_data_name]
+
+    @property
+    def vis(self):
+        return self['vis']
+
+    @property
+    def vis_mask(self):
+        return self['vis_mask']
+
+    @property
+    def local_vis(self):
+        return self['vis']
+
+    @property
+    def local_vis_mask(self):
+        return self['vis_mask']
+
+    @property
+    def freq(self):
+        return self['freq']
+
+    def redistribute(self, dist_axis):
+        """Change the distributed axis, the datasets along the old and new
+        distributed axes are dropped and read again on next access."""
+
+        dist_axis = self._axis_index(dist_axis)
+        if dist_axis == self.main_data_dist_axis:
+            return
+        for name in self._cache.keys():
+            if self._distributed(name):
+                del self._cache[name]
+        self.main_data_dist_axis = dist_axis
+
+    def bl_data_operate(self, func, full_data=False, copy_data=False,
+            show_progress=False, progress_step=None, keep_dist_axis=False,
+            **kwargs):
+        """Call `func(vis, vis_mask, li, gi, bl, self, **kwargs)` for each local
+        baseline, as :meth:`Timestream.bl_data_operate`."""
+
+        self.redistribute('baseline')
+        vis = self.main_data
+        vis_mask = self[self.main_data_name + '_mask']
+        blorder = self['blorder']
+        n_bl = self._index(self.main_data_name, 3, local=False).shape[0]
+        n, st, et = mpiutil.split_local(n_bl, comm=self.comm)
+        for li in range(vis.shape[-1]):
+            if show_progress and (progress_step is None or li % progress_step == 0):
+                logger.info('rank %d baseline %d of %d'%(mpiutil.rank, li,
+                    vis.shape[-1]))
+            func(vis[..., li], vis_mask[..., li], li, st + li, blorder[st + li],
+                    self, **kwargs)
+
+    def add_history(self, history=''):
+
+        self.attrs['history'] = self.attrs.get('history', '') + history
+
+    def info(self):
 
+        for name in sorted(self.read_size.keys()):
+            logger.info('rank %d %-10s %10.2f MB read'%(mpiutil.rank, name,
+                self.read_size[name] / 1024.**2))
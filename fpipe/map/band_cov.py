@@ -0,0 +1,163 @@
+"""Banded block-sparse storage of the inverse noise covariance.
+
+The pixel-pixel inverse noise covariance C^-1 = P^T N^-1 P is only non-zero
+for the pixel pairs seen by the same time sample, i.e. closer than twice the
+beam cut radius. With the pixels ordered as (ra, dec), the non-zeros are
+within `w_ra` RA rows and `w_dec` Dec columns of the diagonal, so C^-1 is
+stored as
+
+    band[i, j, di, dj] = C^-1[(i, j), (i + di - w_ra, j + dj - w_dec)]
+
+of shape (n_ra, n_dec, 2 w_ra + 1, 2 w_dec + 1), instead of the dense
+(n_ra, n_dec, n_ra, n_dec). Entries pointing outside of the map are zero.
+For a 200 x 60 map with width (3, 3) that is 49 values per pixel against
+12000 of the dense one.
+
+The band width is recorded in the `band_width` attribute of the data set,
+see :func:`read_width`.
+
+"""
+
+import logging
+
+import numpy as np
+
+from fpipe.map import algebra as al
+
+logger = logging.getLogger(__name__)
+
+
+def band_width(ra_axis, dec_axis, max_sep):
+    """Band width (w_ra, w_dec) in pixels for the cut radius `max_sep` (deg).
+
+    Two pixels are coupled if both are within `max_sep` of one sample, the
+    RA pixel size is taken at the Dec closest to the pole, so the width is
+    large enough over the whole map. If `max_sep` is None, the samples are
+    assigned to the nearest pixel and C^-1 is diagonal.
+    """
+
+    if max_sep is None:
+        return (0, 0)
+
+    n_ra, n_dec = len(ra_axis), len(dec_axis)
+    cos_dec = np.cos(np.max(np.abs(dec_axis)) * np.pi / 180.)
+    w_ra, w_dec = 0, 0
+    if n_ra > 1:
+        ra_pix = np.abs(ra_axis[1] - ra_axis[0]) * cos_dec
+        w_ra = min(int(np.ceil(2. * max_sep / ra_pix)), n_ra - 1)
+    if n_dec > 1:
+        dec_pix = np.abs(dec_axis[1] - dec_axis[0])
+        w_dec = min(int(np.ceil(2. * max_sep / dec_pix)), n_dec - 1)
+    return (w_ra, w_dec)
+
+def band_shape(map_shp, width):
+
+    return tuple(map_shp) + (2 * width[0] + 1, 2 * width[1] + 1)
+
+def get_width(band):
+    """Band width of the (n_ra, n_dec, n_dra, n_ddec) band array."""
+
+    return ((band.shape[-2] - 1) // 2, (band.shape[-1] - 1) // 2)
+
+def read_width(dset):
+    """Band width of the hdf5 data set, None if stored dense."""
+
+    if 'band_width' not in dset.attrs:
+        return None
+    return tuple(al.safe_eval(dset.attrs['band_width']))
+
+def dense_width(dense, map_shp):
+    """The smallest band width holding the dense (n_pix, n_pix) matrix."""
+
+    n_dec = map_shp[1]
+    row, col = np.nonzero(dense.reshape(np.prod(map_shp), -1))
+    if row.size == 0:
+        return (0, 0)
+    ri, rj = np.divmod(row, n_dec)
+    ci, cj = np.divmod(col, n_dec)
+    return (int(np.abs(ci - ri).max()), int(np.abs(cj - rj).max()))
+
+def add_coo(band, row, col, data):
+    """Add the entries of the dense (n_pix, n_pix) matrix to the band.
+
+    `row`, `col` are the flat pixel indices, they should not repeat, e.g.
+    from a coo matrix after `sum_duplicates`. Entries out of the band are
+    dropped with a warning.
+    """
+
+    n_ra, n_dec = band.shape[:2]
+    w_ra, w_dec = get_width(band)
+    ri, rj = np.divmod(row, n_dec)
+    ci, cj = np.divmod(col, n_dec)
+    di = ci - ri + w_ra
+    dj = cj - rj + w_dec
+    inside  = (di >= 0) & (di <= 2 * w_ra)
+    inside &= (dj >= 0) & (dj <= 2 * w_dec)
+    if not np.all(inside):
+        logger.warning('%d entries out of band (%d, %d), dropped'%(
+            np.sum(~inside), w_ra, w_dec))
+        ri, rj, di, dj = ri[inside], rj[inside], di[inside], dj[inside]
+        data = data[inside]
+    band[ri, rj, di, dj] += data
+
+def add_dense(band, dense):
+    """Add the dense (n_pix, n_pix) matrix to the band."""
+
+    n_pix = band.shape[0] * band.shape[1]
+    dense = dense.reshape(n_pix, n_pix)
+    row, col = np.nonzero(dense)
+    add_coo(band, row, col, dense[row, col])
+
+def from_dense(dense, map_shp, width, dtype=None):
+
+    if dtype is None:
+        dtype = dense.dtype
+    band = np.zeros(band_shape(map_shp, width), dtype=dtype)
+    add_dense(band, dense)
+    return band
+
+def to_dense(band):
+    """The dense (n_pix, n_pix) matrix, for small maps only.
+
+    The band may be a RA slab of a larger map, the entries coupling to
+    pixels outside of the slab are left out.
+    """
+
+    n_ra, n_dec = band.shape[:2]
+    w_ra, w_dec = get_width(band)
+    ri, rj, di, dj = np.nonzero(band)
+    ci = ri + di - w_ra
+    cj = rj + dj - w_dec
+    good = (ci >= 0) & (ci < n_ra) & (cj >= 0) & (cj < n_dec)
+    dense = np.zeros((n_ra * n_dec, n_ra * n_dec), dtype=band.dtype)
+    dense[ri[good] * n_dec + rj[good], ci[good] * n_dec + cj[good]] \
+            = band[ri[good], rj[good], di[good], dj[good]]
+    return dense
+
+def diagonal(band):
+
+    w_ra, w_dec = get_width(band)
+    return band[:, :, w_ra, w_dec]
+
+def dot(band, x):
+    """C^-1 x, x of shape (n_ra, n_dec) or (n_ra, n_dec, n_vec)."""
+
+    n_ra, n_dec = band.shape[:2]
+    w_ra, w_dec = get_width(band)
+    x = np.asarray(x)
+    extra = (1, ) * (x.ndim - 2)
+    y = np.zeros(x.shape, dtype=np.result_type(band.dtype, x.dtype))
+    for di in range(2 * w_ra + 1):
+        a = di - w_ra
+        i0, i1 = max(0, -a), min(n_ra, n_ra - a)
+        if i0 >= i1:
+            continue
+        for dj in range(2 * w_dec + 1):
+            b = dj - w_dec
+            j0, j1 = max(0, -b), min(n_dec, n_dec - b)
+            if j0 >= j1:
+                continue
+            _b = band[i0:i1, j0:j1, di, dj]
+            y[i0:i1, j0:j1] += _b.reshape(_b.shape + extra) \
+                    * x[i0+a:i1+a, j0+b:j1+b]
+    return y
@@ -11,12 +11,17 @@ from tlpipe.utils.path_util import output_path
 from fpipe.timestream import timestream_task
 from fpipe.map import algebra as al
 from fpipe.map import mapbase
+from fpipe.map import band_cov
+from fpipe.map import pcg
+from fpipe.pipeline.profile import ProfiledTask
 
 import healpy as hp
 import numpy as np
 import scipy as sp
 #from scipy import linalg
 from numpy import linalg
+from scipy.linalg import cho_factor, cho_solve, get_lapack_funcs
+from scipy.linalg import lu_factor, lu_solve
 import h5py
 import sys
 import gc
@@ -28,7 +33,7 @@ from meerKAT_utils.constants import f_medium, f_large
 
 __dtype__ = 'float32'
 
-class CleanMap_SplitRA(OneAndOne, mapbase.MultiMapBase):
+class CleanMap_SplitRA(ProfiledTask, OneAndOne, mapbase.MultiMapBase):
 
     params_init = {
 
@@ -81,6 +86,7 @@ class CleanMap_SplitRA(OneAndOne, mapbase.MultiMapBase):
         block_olap = self.params['block_overlap']
         ra_length_tot = self.map_shp[-2]
         dec_length_tot = self.map_shp[-1]
+        band_width = band_cov.read_width(self.df_in[0]['cov_inv'])
         task_n = int( ra_length_tot / block_length) + 1
         if mpiutil.rank0:
             logger.debug('RA split into %4d task with block length %4d'%(
@@ -112,10 +118,19 @@ class CleanMap_SplitRA(OneAndOne, mapbase.MultiMapBase):
 
                 map_shp = (ra_length_olap, dec_length_tot)
                 _dirty_map = np.zeros(map_shp)
-                _cov_inv = np.zeros(map_shp * 2, dtype=float)
+                if band_width is not None:
+                    _cov_inv = np.zeros(band_cov.band_shape(map_shp, band_width))
+                    cov_slice = radec_slice_olap
+                else:
+                    _cov_inv = np.zeros(map_shp * 2, dtype=float)
+                    cov_slice = radec_slice_olap * 2
                 for df in self.df_in:
                     _dirty_map += df['dirty_map'][indx + radec_slice_olap]
-                    _cov_inv   += df['cov_inv'][indx + radec_slice_olap * 2]
+                    _cov_inv   += df['cov_inv'][indx + cov_slice]
+                if band_width is not None:
+                    # dense for the RA block only, of block_length plus the
+                    # overlaps
+                    _cov_inv = band_cov.to_dense(_cov_inv)
 
                 clean_map, noise_diag = make_cleanmap(_dirty_map, _cov_inv, threshold)
                 clean_map  =  clean_map[ olap_lower : olap_lower+ra_length ]
@@ -133,13 +148,21 @@ class CleanMap_SplitRA(OneAndOne, mapbase.MultiMapBase):
         mpiutil.barrier()
         super(CleanMap_SplitRA, self).finish()
 
-class CleanMap(OneAndOne, mapbase.MultiMapBase):
+class CleanMap(ProfiledTask, OneAndOne, mapbase.MultiMapBase):
 
     params_init = {
 
             'save_cov' : False,
             'diag_cov' : True,
             'threshold' : 1.e-3,
+
+            'solver' : 'inv', # 'inv' or 'cg', always 'cg' for a banded cov_inv
+            'cg_precond' : 'jacobi', # 'jacobi' or 'block'
+            'cg_tol' : 1.e-6,
+            'cg_maxiter' : None,
+            'noise_est' : 'truncated', # 'truncated' or 'stochastic'
+            'probe_dist' : None, # default to twice the band width + 1
+            'n_probe' : 64,
             }
 
     prefix = 'cm_'
@@ -182,6 +205,13 @@ class CleanMap(OneAndOne, mapbase.MultiMapBase):
 
         diag_cov  = self.params['diag_cov']
         threshold = self.params['threshold']
+        band_width = band_cov.read_width(self.df_in[0]['cov_inv'])
+        use_cg = self.params['solver'] == 'cg' and not diag_cov
+        if band_width is not None and not diag_cov and not use_cg:
+            # the inverse of the band is dense, solve with cg instead
+            if mpiutil.rank0:
+                logger.info('banded cov_inv, use the cg solver')
+            use_cg = True
         task_n = np.prod(self.map_shp[:-2])
         for task_ind in mpiutil.mpirange(task_n):
 
@@ -192,7 +222,10 @@ class CleanMap(OneAndOne, mapbase.MultiMapBase):
 
             map_shp = self.map_shp[-2:]
             _dirty_map = np.zeros(map_shp, dtype=__dtype__)
-            if diag_cov:
+            if band_width is not None:
+                _cov_inv = np.zeros(band_cov.band_shape(map_shp, band_width),
+                        dtype=__dtype__)
+            elif diag_cov:
                 _cov_inv = np.zeros(map_shp, dtype=__dtype__)
             else:
                 _cov_inv = np.zeros(map_shp * 2, dtype=__dtype__)
@@ -200,9 +233,22 @@ class CleanMap(OneAndOne, mapbase.MultiMapBase):
                 _dirty_map += df['dirty_map'][indx + (slice(None), )]
                 self.read_block_from_dset(ii, 'cov_inv', indx, _cov_inv)
                 #_cov_inv   += df['cov_inv'][indx + (slice(None), )]
+            if band_width is not None and diag_cov:
+                _cov_inv = band_cov.diagonal(_cov_inv).copy()
 
             self.df_out[-1]['dirty_map' ][indx + (slice(None), )] = _dirty_map
-            clean_map, noise_diag = make_cleanmap(_dirty_map,_cov_inv,diag_cov,threshold)
+            if use_cg:
+                clean_map, noise_diag = make_cleanmap_cg(_dirty_map, _cov_inv,
+                        threshold, band=band_width is not None,
+                        precond=self.params['cg_precond'],
+                        noise_est=self.params['noise_est'],
+                        probe_dist=self.params['probe_dist'],
+                        n_probe=self.params['n_probe'],
+                        tol=self.params['cg_tol'],
+                        maxiter=self.params['cg_maxiter'])
+            else:
+                clean_map, noise_diag = make_cleanmap(_dirty_map, _cov_inv,
+                        diag_cov, threshold)
             self.df_out[-1]['clean_map' ][indx + (slice(None), )] = clean_map
             self.df_out[-1]['noise_diag'][indx + (slice(None), )] = noise_diag
             del _cov_inv
@@ -235,7 +281,8 @@ def make_cleanmap(dirty_map, cov_inv_block, diag_cov=False, threshold=1.e-5):
         cov_inv_diag_max = cov_inv_diag.max()
         if np.all(cov_inv_diag == 0):
             logger.error('Singular Noise Matrix, ignore')
-            noise = np.zeros_like(cov_inv_block)
+            clean_map = np.zeros_like(dirty_map)
+            noise_diag = np.zeros_like(dirty_map)
         else:
             cov_inv_diag_min = cov_inv_diag[cov_inv_diag!=0].min()
             logger.info('cov inv diag max %e, min %e'%(cov_inv_diag_max, cov_inv_diag_min))
@@ -243,21 +290,143 @@ def make_cleanmap(dirty_map, cov_inv_block, diag_cov=False, threshold=1.e-5):
             cov_inv_diag[:] = cov_inv_diag_max * threshold
             #cov_inv_diag[:] = threshold
 
-            cov_inv_block += np.eye(np.prod(map_shp)) * cov_inv_diag[:, None]
+            cov_inv_block[np.diag_indices(np.prod(map_shp))] += cov_inv_diag
             #noise = linalg.pinv(cov_inv_block, rcond=threshold)
-            noise = linalg.inv(cov_inv_block)
-            noise[cov_inv_bad] = 0.
-
-        clean_map = np.dot(noise, dirty_map)
-        noise_diag = np.diag(noise)
+            #noise = linalg.inv(cov_inv_block)
+            try:
+                clean_map, noise_diag = cho_cleanmap(dirty_map, cov_inv_block)
+            except linalg.LinAlgError:
+                logger.warning('Noise Matrix not positive definite, use LU')
+                clean_map, noise_diag = lu_cleanmap(dirty_map, cov_inv_block)
+            clean_map[cov_inv_bad] = 0.
+            noise_diag[cov_inv_bad] = 0.
 
-        del noise
         gc.collect()
 
     clean_map.shape = map_shp
     noise_diag.shape = map_shp
 
 
+    return clean_map, noise_diag
+
+def cho_cleanmap(dirty_map, cov_inv, chunk_len=1024):
+    """Clean map and noise diagonal of the regularised inverse covariance,
+    with the Cholesky factor C^-1 = L L^T.
+
+    The noise diagonal is the column sum of squares of L^-1, inverted in
+    place of L, so neither C nor a second (n_pix, n_pix) matrix is formed.
+    The factor is computed in double precision on a copy, `cov_inv` is kept
+    for :func:`lu_cleanmap` if the factorisation fails.
+    """
+
+    c, lower = cho_factor(cov_inv.astype('float64'), lower=True,
+            overwrite_a=True, check_finite=False)
+    clean_map = cho_solve((c, lower), dirty_map, check_finite=False)
+
+    trtri, = get_lapack_funcs(('trtri', ), (c, ))
+    c, info = trtri(c, lower=1, overwrite_c=1)
+    if info != 0:
+        raise linalg.LinAlgError('Singular Cholesky factor')
+    n_pix = c.shape[0]
+    noise_diag = np.zeros(n_pix, dtype='float64')
+    for st in range(0, n_pix, chunk_len):
+        et = min(st + chunk_len, n_pix)
+        # the upper triangle of c is not referenced
+        noise_diag += np.sum(np.tril(c[st:et], k=st) ** 2, axis=0)
+
+    return clean_map, noise_diag
+
+def lu_cleanmap(dirty_map, cov_inv, chunk_len=1024):
+    """Clean map and noise diagonal with the LU factorisation, for the
+    matrix not positive definite in floating point. The noise diagonal is
+    solved `chunk_len` columns at a time."""
+
+    lu = lu_factor(cov_inv.astype('float64'), overwrite_a=True,
+            check_finite=False)
+    clean_map = lu_solve(lu, dirty_map, check_finite=False)
+
+    n_pix = cov_inv.shape[0]
+    noise_diag = np.zeros(n_pix, dtype='float64')
+    for st in range(0, n_pix, chunk_len):
+        et = min(st + chunk_len, n_pix)
+        cols = np.arange(et - st)
+        unit = np.zeros((n_pix, et - st))
+        unit[st + cols, cols] = 1.
+        noise_diag[st:et] = lu_solve(lu, unit, overwrite_b=True,
+                check_finite=False)[st + cols, cols]
+
+    return clean_map, noise_diag
+
+def make_cleanmap_cg(dirty_map, cov_inv, threshold=1.e-5, band=False,
+        diag=None, precond='jacobi', noise_est='truncated', probe_dist=None,
+        n_probe=64, tol=1.e-6, maxiter=None):
+    """Clean map with the conjugate gradient solver of :mod:`fpipe.map.pcg`.
+
+    The regularisation is the same as :func:`make_cleanmap`.
+
+    Parameters
+    ----------
+    dirty_map : array, shape (n_ra, n_dec)
+    cov_inv : array or function
+        The dense (n_pix, n_pix) or banded inverse covariance, or the
+        operator C^-1 x of x of shape (n_pix, k), e.g. from
+        :func:`fpipe.map.pointing.cov_inv_operator`, then `diag` is needed.
+    band : bool
+        If `cov_inv` is the band of :mod:`fpipe.map.band_cov`.
+    precond : 'jacobi' or 'block'
+        The block preconditioner inverts the (n_dec, n_dec) block of each
+        RA row, not available for the operator.
+    noise_est : 'truncated' or 'stochastic'
+        Noise diagonal estimator, see :mod:`fpipe.map.pcg`.
+    probe_dist : tuple or None
+        Pixel spacing of the truncated probing, default to twice the band
+        width + 1.
+    """
+
+    map_shp = dirty_map.shape
+    if callable(cov_inv):
+        apply_C, _diag = cov_inv, diag
+        width = None
+    else:
+        apply_C, _diag = pcg.matrix_operator(cov_inv, map_shp, band=band)
+        if band:
+            width = band_cov.get_width(cov_inv)
+        else:
+            width = band_cov.dense_width(cov_inv, map_shp)
+
+    cov_inv_bad = _diag == 0
+    if np.all(cov_inv_bad):
+        logger.error('Singular Noise Matrix, ignore')
+        return np.zeros(map_shp), np.zeros(map_shp)
+    cov_inv_diag_max = _diag.max()
+    logger.info('cov inv diag max %e, min %e'%(cov_inv_diag_max,
+        _diag[~cov_inv_bad].min()))
+    reg = cov_inv_diag_max * threshold
+    apply_A = lambda x: apply_C(x) + reg * x
+
+    if precond == 'block' and width is not None:
+        apply_M = pcg.block_preconditioner(cov_inv, map_shp, reg, band=band)
+    else:
+        if precond == 'block':
+            logger.warning('no block preconditioner for the operator, use jacobi')
+        apply_M = pcg.jacobi_preconditioner(_diag + reg)
+
+    if probe_dist is None:
+        if width is None:
+            probe_dist = (8, 8)
+        else:
+            probe_dist = (2 * width[0] + 1, 2 * width[1] + 1)
+
+    clean_map, noise_diag, n_iter = pcg.solve_map(apply_A, dirty_map, map_shp,
+            apply_M, noise_est=noise_est, probe_dist=probe_dist,
+            n_probe=n_probe, tol=tol, maxiter=maxiter)
+    logger.info('CG converged in %d iterations'%n_iter)
+
+    clean_map[cov_inv_bad] = 0.
+    noise_diag[cov_inv_bad] = 0.
+    clean_map.shape = map_shp
+    noise_diag.shape = map_shp
+
     return clean_map, noise_diag
 
 def make_cleanmap_old(dirty_map, cov_inv_block, threshold=1.e-5):
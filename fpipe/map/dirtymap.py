@@ -11,16 +11,20 @@ from tlpipe.utils.path_util import output_path
 from fpipe.timestream import timestream_task
 from fpipe.map import algebra as al
 from fpipe.map import mapbase
+from fpipe.map import pointing
+from fpipe.map import band_cov
 
 import healpy as hp
 import numpy as np
 import scipy as sp
+from scipy.sparse import csr_matrix
 #from scipy import linalg
 from numpy.linalg import multi_dot
 from numpy import linalg
 from scipy import special
 import h5py
 import sys
+import os
 import gc
 
 from tlpipe.rfi import interpolate
@@ -55,6 +59,8 @@ class DirtyMap(timestream_task.TimestreamTask, mapbase.MapBase):
 
             'beam_fwhm_at21cm' : 1.0,
             'beam_cut'  : 0.01,
+            'sparse_pointing' : True,
+            'pointing_cache_size' : 1024, # MB, None to disable the cache
 
             'interpolation' : 'linear',
             'tblock_len' : 100,
@@ -67,12 +73,18 @@ class DirtyMap(timestream_task.TimestreamTask, mapbase.MapBase):
 
             'save_cov' : False,
             'diag_cov' : False,
+            'band_cov' : False, # banded cov_inv, see fpipe.map.band_cov
+            'accumulate' : False, # sum the map blocks per rank, write once at the end,
+                                  # only helps if several ranks share a block
+            'accum_mem' : 4096, # MB of the in-memory blocks, then scratch memmap
 
             'save_localHI' : False,
             }
 
     prefix = 'dm_'
 
+    _dist_axis_ = 'frequency'
+
     def __init__(self, *args, **kwargs):
 
         super(DirtyMap, self).__init__(*args, **kwargs)
@@ -116,9 +128,18 @@ class DirtyMap(timestream_task.TimestreamTask, mapbase.MapBase):
                 logger.info('save local HI')
             freq = ts['freq'][:] - 1420.
             local_hi = np.abs(freq) < 1
+            if ts.main_data_dist_axis == 1:
+                f_st = ts.vis.local_offset[1]
+                local_hi = local_hi[f_st:f_st + ts.vis.local_shape[1]]
             ts.local_vis_mask[:, local_hi, ...] = False
 
         self.init_output()
+        if self.params['accumulate']:
+            accum_mem = self.params['accum_mem']
+            if accum_mem is not None:
+                accum_mem = accum_mem * 1024**2
+            self.init_accumulator(accum_mem,
+                    scratch_dir=os.path.dirname(os.path.abspath(self.df.filename)))
         if 'ns_on' in ts.iterkeys():
             ns = ts['ns_on'].local_data
             ts.local_vis_mask[:] += ns[:, None, None, :]
@@ -127,7 +148,7 @@ class DirtyMap(timestream_task.TimestreamTask, mapbase.MapBase):
 
         func = self.init_ps_datasets(ts)
 
-        ts.redistribute('frequency')
+        self.redistribute(ts, 'frequency')
 
         vis_var = mpiarray.MPIArray.wrap(np.zeros(ts.vis.local_shape), 1)
         axis_order = tuple(xrange(len(ts.vis.shape)))
@@ -148,12 +169,13 @@ class DirtyMap(timestream_task.TimestreamTask, mapbase.MapBase):
         if not func is None:
 
             #ts.redistribute('time')
-            ts.redistribute('frequency')
+            self.redistribute(ts, 'frequency')
             func(self.make_map, full_data=False, copy_data=True, 
                     show_progress=show_progress, 
                     progress_step=progress_step, keep_dist_axis=False)
 
         mpiutil.barrier()
+        self.flush_blocks()
 
         self.df.close()
 
@@ -273,9 +295,14 @@ class DirtyMap(timestream_task.TimestreamTask, mapbase.MapBase):
         self.df['mask'] = np.zeros([n_bl, n_pol, n_freq])
         #self.mask = np.zeros([n_bl, n_pol, n_freq])
 
+        self.band_width = self.cov_band_width(ts)
         if self.params['diag_cov']:
             axis_names = ('bl', 'pol', 'freq', 'ra', 'dec')
             cov_tmp = np.zeros((n_bl, n_pol, n_freq) +  self.map_shp)
+        elif self.band_width is not None:
+            axis_names = ('bl', 'pol', 'freq', 'ra', 'dec', 'dra', 'ddec')
+            cov_tmp = np.zeros((n_bl, n_pol, n_freq) 
+                    + band_cov.band_shape(self.map_shp, self.band_width))
         else:
             axis_names = ('bl', 'pol', 'freq', 'ra', 'dec', 'ra', 'dec')
             cov_tmp = np.zeros((n_bl, n_pol, n_freq) +  self.map_shp + self.map_shp)
@@ -285,6 +312,8 @@ class DirtyMap(timestream_task.TimestreamTask, mapbase.MapBase):
         cov_tmp.set_axis_info('freq', freq_c, freq_d)
         cov_tmp.set_axis_info('ra',   field_centre[0], self.ra_spacing)
         cov_tmp.set_axis_info('dec',  field_centre[1], self.dec_spacing)
+        if self.band_width is not None:
+            cov_tmp.info['band_width'] = self.band_width
         #self.cov = cov_tmp
         
         self.create_dataset_like('cov_inv', cov_tmp)
@@ -292,11 +321,44 @@ class DirtyMap(timestream_task.TimestreamTask, mapbase.MapBase):
         self.df['pol'] = self.pol
         self.df['bl']  = self.bl
 
+        self.init_pointing_cache(ts)
+
         #func = ts.freq_pol_and_bl_data_operate
         func = ts.freq_data_operate
 
         return func
 
+    def max_sep(self, ts):
+        """The cut radius of the widest beam, at the lowest frequency."""
+
+        freq_min = ts['freq'][:].min() * 1.e-3
+        beam_fwhm = self.params['beam_fwhm_at21cm'] * 1.42 / freq_min
+        beam_sig = beam_fwhm  / (2. * np.sqrt(2.*np.log(2.)))
+        return pointing.cut_radius(beam_sig, self.params['beam_cut'])
+
+    def cov_band_width(self, ts):
+        """Band width of the banded cov_inv, None if not banded."""
+
+        if self.params['diag_cov'] or not self.params['band_cov']:
+            return None
+
+        band_width = band_cov.band_width(self.map_tmp.get_axis('ra'),
+                self.map_tmp.get_axis('dec'), self.max_sep(ts))
+        if mpiutil.rank0:
+            logger.info('cov_inv band width (%d, %d)'%band_width)
+        return band_width
+
+    def init_pointing_cache(self, ts):
+
+        self.pointing_cache = None
+        cache_size = self.params['pointing_cache_size']
+        if not self.params['sparse_pointing'] or cache_size is None:
+            return
+
+        self.pointing_cache = pointing.PointingCache(
+                self.map_tmp.get_axis('ra'), self.map_tmp.get_axis('dec'),
+                max_sep=self.max_sep(ts), max_size=cache_size)
+
     def make_map(self, vis, vis_mask, li, gi, bl, ts, **kwargs):
 
         #print "make map vis shape = ", vis.shape
@@ -323,8 +385,12 @@ class DirtyMap(timestream_task.TimestreamTask, mapbase.MapBase):
         dec_axis = self.map_tmp.get_axis('dec')
 
         map_shp = ra_axis.shape + dec_axis.shape
+        band = self.band_width is not None
         if self.params['diag_cov']:
             _ci = np.zeros((np.product(map_shp),), dtype=__dtype__)
+        elif band:
+            _ci = np.zeros(band_cov.band_shape(map_shp, self.band_width),
+                    dtype=__dtype__)
         else:
             _ci = np.zeros((np.product(map_shp), np.product(map_shp)), dtype=__dtype__)
         _dm = np.zeros((np.product(map_shp),), dtype=__dtype__)
@@ -377,15 +443,19 @@ class DirtyMap(timestream_task.TimestreamTask, mapbase.MapBase):
                                ra_axis, dec_axis, 
                                _ci, _dm,
                                diag_cov = self.params['diag_cov'],
+                               band = band,
                                beam_size= beam_fwhm,
-                               beam_cut = self.params['beam_cut'])
+                               beam_cut = self.params['beam_cut'],
+                               sparse = self.params['sparse_pointing'],
+                               pointing_cache = self.pointing_cache,
+                               cache_key = (b_idx, st))
 
         logger.debug('write to disk')
         _dm.shape = map_shp
         self.write_block_to_dset('dirty_map', map_idx, _dm)
         if self.params['diag_cov']:
             _ci.shape = map_shp
-        else:
+        elif not band:
             _ci.shape = map_shp * 2
         self.write_block_to_dset('cov_inv', map_idx, _ci)
         del _ci, _dm
@@ -399,7 +469,8 @@ class DirtyMap(timestream_task.TimestreamTask, mapbase.MapBase):
         mpiutil.barrier()
 
 def timestream2map(vis_one, vis_mask, vis_var, time, ra, dec, ra_axis, dec_axis, 
-        cov_inv_block, dirty_map, diag_cov=False, beam_size=3./60.,  beam_cut = 0.01,):
+        cov_inv_block, dirty_map, diag_cov=False, band=False, beam_size=3./60.,
+        beam_cut = 0.01, sparse=True, pointing_cache=None, cache_key=None):
 
     map_shp = ra_axis.shape + dec_axis.shape
 
@@ -418,6 +489,29 @@ def timestream2map(vis_one, vis_mask, vis_var, time, ra, dec, ra_axis, dec_axis,
     _good *= ~vis_mask
     if np.sum(_good) == 0: return
 
+    if sparse:
+        vis_var = vis_var[_good]
+        vis_var[vis_var==0] = np.inf
+        if beam_cut is not None and mpiutil.rank0:
+            logger.info('beam cut %f'%(beam_cut))
+        max_sep = pointing.cut_radius(beam_sig, beam_cut)
+        if pointing_cache is not None and pointing_cache.covers(max_sep):
+            logger.debug('est. sparse pointing from cache')
+            in_range, indptr, indices, sep = pointing_cache.get(cache_key, ra, dec)
+            P = pointing.beam_weight(indptr, indices, sep, np.prod(map_shp),
+                    beam_sig, beam_cut)
+            P = P[_good[in_range]]
+        else:
+            logger.debug('est. sparse pointing')
+            indptr, indices, sep = pointing.pointing_separation(
+                    ra[_good], dec[_good], ra_axis, dec_axis, max_sep)
+            P = pointing.beam_weight(indptr, indices, sep, np.prod(map_shp),
+                    beam_sig, beam_cut)
+        logger.debug('est. dirty map and noise inv')
+        pointing.accumulate_map(P, vis_one[_good], 1. / vis_var,
+                dirty_map, cov_inv_block, diag_cov=diag_cov, band=band)
+        return
+
     ra   = ra[_good] * np.pi / 180.
     dec  = dec[_good]* np.pi / 180.
     vis_one  = vis_one[_good]
@@ -458,6 +552,16 @@ def timestream2map(vis_one, vis_mask, vis_var, time, ra, dec, ra_axis, dec_axis,
 
     weight = noise_inv_weight
 
+    if band:
+        # the band entries from the non-zeros of P, as the sparse pointing,
+        # without the dense (n_pix, n_pix) product.
+        logger.debug('est. dirty map and noise inv')
+        pointing.accumulate_map(csr_matrix(P), vis_one, weight,
+                dirty_map, cov_inv_block, diag_cov=diag_cov, band=band)
+        del P
+        gc.collect()
+        return
+
     logger.debug('est. dirty map')
     dirty_map += np.dot(P.T, vis_one * weight)
     #dirty_map = dirty_map.astype(__dtype__)
@@ -633,9 +737,13 @@ class MakeMap_CombineAll(DirtyMap):
 
         msg = 'init cov dsets'
         logger.debug(msg)
+        self.band_width = self.cov_band_width(ts)
         if self.params['diag_cov']:
             axis_names = ('freq', 'ra', 'dec')
             cov_shp = (n_freq, ) +  self.map_shp 
+        elif self.band_width is not None:
+            axis_names = ('freq', 'ra', 'dec', 'dra', 'ddec')
+            cov_shp = (n_freq, ) + band_cov.band_shape(self.map_shp, self.band_width)
         else:
             axis_names = ('freq', 'ra', 'dec', 'ra', 'dec')
             cov_shp = (n_freq, ) +  self.map_shp + self.map_shp
@@ -648,11 +756,15 @@ class MakeMap_CombineAll(DirtyMap):
                 'freq_centre' : freq_c,
                 'axes'        : axis_names,
                 }
+        if self.band_width is not None:
+            cov_info['band_width'] = self.band_width
         self.create_dataset('cov_inv', cov_shp, cov_info, __dtype__)
 
         self.df['pol'] = self.pol
         self.df['bl']  = self.bl
 
+        self.init_pointing_cache(ts)
+
         #func = ts.freq_pol_and_bl_data_operate
         func = ts.freq_data_operate
 
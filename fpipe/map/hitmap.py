@@ -1,5 +1,6 @@
 import logging
 from fpipe.timestream import timestream_task
+from fpipe.container.timestream import LazyTimestream
 from tlpipe.utils.path_util import output_path
 import matplotlib.pyplot as plt
 import numpy as np
@@ -17,17 +18,30 @@ class MakeAvgMap(timestream_task.TimestreamTask):
             }
     prefix = 'mkavgm_'
 
+    _dist_axis_ = 'baseline'
+
+    def lazy_datasets(self):
+
+        main_data = self.params['main_data']
+        freq_idx = self.params['freq_idx']
+        freq_slab = {'frequency': (freq_idx, freq_idx + 1)}
+        return {main_data: freq_slab, main_data + '_mask': freq_slab,
+                'freq': freq_slab, 'blorder': None, 'ra': None, 'dec': None}
+
     def process(self, ts):
 
         nside = self.params['nside']
         self.pixls = np.arange(hp.nside2npix(nside) + 1) - 0.5
         self.hitmap = np.zeros(hp.nside2npix(nside), dtype='float32')
         self.avgmap = np.zeros(hp.nside2npix(nside), dtype='float32')
-        self.freq = ts['freq'][self.params['freq_idx']]
+        # only the selected channel is read in lazy mode
+        self.freq_idx = 0 if isinstance(ts, LazyTimestream) \
+                else self.params['freq_idx']
+        self.freq = ts['freq'][self.freq_idx]
 
         ts.main_data_name = self.params['main_data']
 
-        ts.redistribute('baseline')
+        self.redistribute(ts, 'baseline')
 
         func = ts.bl_data_operate
 
@@ -49,7 +63,7 @@ class MakeAvgMap(timestream_task.TimestreamTask):
 
         logger.info('%03d'%gi)
 
-        _vis = np.sum(vis[:, self.params['freq_idx'], :], axis=-1)
+        _vis = np.sum(vis[:, self.freq_idx, :], axis=-1)
 
         pixidx = hp.ang2pix(nside, ra, dec, lonlat=True)
         self.hitmap += np.histogram(pixidx, self.pixls)[0]
@@ -7,6 +7,8 @@ import h5py
 from caput import mpiutil
 
 import os, fcntl
+import tempfile
+from collections import OrderedDict
 
 logger = logging.getLogger(__name__)
 
@@ -20,11 +22,126 @@ else:
             'driver' : None,
             }
 
+class BlockAccumulator(object):
+    """Private partial sums of the output blocks of each rank.
+
+    The blocks added by the rank are summed in memory, or in a scratch memmap
+    once `max_mem` bytes are used. :meth:`flush` reduces the partial sums of
+    each block over the ranks holding it with a tree merge, and the block is
+    written exactly once by one rank, so no lock or read-back of the other
+    ranks' contributions is needed.
+
+    Parameters
+    ----------
+    comm : MPI communicator or None
+    max_mem : int or None
+        Memory budget in bytes of the in-memory blocks, None for no limit.
+    scratch_dir : str or None
+        Directory of the scratch memmap files, default the system temp dir.
+    chunk_size : int
+        Bytes sent at once in the merge.
+    """
+
+    def __init__(self, comm=None, max_mem=None, scratch_dir=None,
+            chunk_size=256*1024**2):
+
+        self.comm = comm
+        self.max_mem = max_mem
+        self.scratch_dir = scratch_dir
+        self.chunk_size = chunk_size
+        self.blocks = OrderedDict()
+        self.mem = 0
+
+    def _alloc(self, shape, dtype):
+
+        nbytes = np.prod(shape) * np.dtype(dtype).itemsize
+        if self.max_mem is not None and self.mem + nbytes > self.max_mem:
+            fd, fname = tempfile.mkstemp(suffix='.block', dir=self.scratch_dir)
+            os.close(fd)
+            block = np.memmap(fname, dtype=dtype, mode='w+', shape=shape)
+            # the mapping is kept after the file is removed
+            os.remove(fname)
+            return block
+        self.mem += nbytes
+        return np.zeros(shape, dtype=dtype)
+
+    def add(self, key, data):
+        """Add `data` to the partial sum of block `key`."""
+
+        block = self.blocks.get(key, None)
+        if block is None:
+            block = self._alloc(data.shape, data.dtype)
+            self.blocks[key] = block
+        block += data
+
+    def _send(self, block, dest, tag):
+
+        flat = block.reshape(-1)
+        step = max(self.chunk_size // block.itemsize, 1)
+        for st in range(0, flat.shape[0], step):
+            self.comm.Send(np.ascontiguousarray(flat[st:st+step]), dest=dest,
+                    tag=tag)
+
+    def _recv_add(self, block, source, tag):
+
+        flat = block.reshape(-1)
+        step = max(self.chunk_size // block.itemsize, 1)
+        buf = np.empty(min(step, flat.shape[0]), dtype=block.dtype)
+        for st in range(0, flat.shape[0], step):
+            et = min(st + step, flat.shape[0])
+            self.comm.Recv(buf[:et-st], source=source, tag=tag)
+            flat[st:et] += buf[:et-st]
+
+    def flush(self, write):
+        """Reduce the partial sums and call `write(key, data)` once for each
+        block, on the first rank holding it. Collective over `comm`."""
+
+        if self.comm is None or self.comm.size == 1:
+            for key, block in self.blocks.items():
+                write(key, block)
+            self.clear()
+            return
+
+        rank = self.comm.rank
+        holders = OrderedDict()
+        for _rank, keys in enumerate(self.comm.allgather(self.blocks.keys())):
+            for key in keys:
+                holders.setdefault(key, []).append(_rank)
+
+        # all ranks go through the blocks in the same order
+        for tag, key in enumerate(sorted(holders.keys())):
+            ranks = holders[key]
+            if rank not in ranks:
+                continue
+            ii = ranks.index(rank)
+            block = self.blocks[key]
+            tag = tag % 32767
+            step = 1
+            while step < len(ranks):
+                if ii % (2 * step) == step:
+                    self._send(block, ranks[ii - step], tag)
+                    break
+                if ii + step < len(ranks):
+                    self._recv_add(block, ranks[ii + step], tag)
+                step *= 2
+            if ii == 0:
+                write(key, block)
+            del self.blocks[key]
+
+        self.clear()
+        self.comm.Barrier()
+
+    def clear(self):
+
+        self.blocks.clear()
+        self.mem = 0
+
 class MapBase(object):
 
     def __init__(self, *args, **kwargs):
 
         self.df = None
+        self.accumulator = None
 
     def __del__(self):
 
@@ -39,7 +156,7 @@ class MapBase(object):
 
     def create_dataset(self, name, dset_shp, dset_info={}, dtype='f'):
 
-        d = self.df.create_dataset(name, dset_shp, dtype=dtype)
+        d = create_contiguous_dataset(self.df, name, dset_shp, dtype=dtype)
         for key, value in dset_info.iteritems():
             d.attrs[key] = repr(value)
 
@@ -47,14 +164,38 @@ class MapBase(object):
 
         self.create_dataset(name, dset_tmp.shape, dset_tmp.info, dset_tmp.dtype)
 
+    def init_accumulator(self, max_mem=None, scratch_dir=None):
+        """Accumulate the blocks of :meth:`write_block_to_dset` in memory
+        until :meth:`flush_blocks`."""
+
+        self.accumulator = BlockAccumulator(mpiutil._comm, max_mem, scratch_dir)
+
     def write_block_to_dset(self, dset_name, indx, data, chunk_size=1024**3):
 
+        if self.accumulator is not None:
+            self.accumulator.add((dset_name, tuple(indx)), data)
+            return
         _write_block_to_dset(self.df, dset_name, indx, data, chunk_size=chunk_size)
 
+    def flush_blocks(self, chunk_size=1024**3):
+        """Write the accumulated blocks, collective."""
+
+        if self.accumulator is None:
+            return
+        def write(key, data):
+            _write_block_to_dset(self.df, key[0], key[1], data,
+                    chunk_size=chunk_size, lock=False)
+        self.accumulator.flush(write)
+
     def read_block_from_dset(self, dset_name, indx, data, chunk_size=1024**3):
 
         _read_block_from_dset(self.df, dset_name, indx, data, chunk_size=1024**3)
 
+    def block_view(self, dset_name, indx, mode='r+'):
+        """Writable view of the block dset[indx] of the output file."""
+
+        return block_memmap(self.df, dset_name, indx, mode)
+
 
 class MultiMapBase(object):
 
@@ -65,6 +206,7 @@ class MultiMapBase(object):
 
         self.df_in  = []
         self.df_out = []
+        self.accumulator = None
 
     def __del__(self):
 
@@ -87,7 +229,8 @@ class MultiMapBase(object):
 
     def create_dataset(self, df_idx, name, dset_shp, dset_info={}, dtype='f'):
 
-        d = self.df_out[df_idx].create_dataset(name, dset_shp, dtype=dtype)
+        d = create_contiguous_dataset(self.df_out[df_idx], name, dset_shp,
+                dtype=dtype)
         for key, value in dset_info.iteritems():
             d.attrs[key] = repr(value)
 
@@ -95,78 +238,139 @@ class MultiMapBase(object):
 
         self.create_dataset(df_idx, name, dset_tmp.shape, dset_tmp.info, dset_tmp.dtype)
 
+    def init_accumulator(self, max_mem=None, scratch_dir=None):
+
+        self.accumulator = BlockAccumulator(mpiutil._comm, max_mem, scratch_dir)
+
     def write_block_to_dset(self, df_idx, dset_name, indx, data, chunk_size=1024**3):
 
+        if self.accumulator is not None:
+            self.accumulator.add((df_idx, dset_name, tuple(indx)), data)
+            return
         _write_block_to_dset(self.df_out[df_idx], dset_name, indx, data,
                 chunk_size=chunk_size)
 
+    def flush_blocks(self, chunk_size=1024**3):
+
+        if self.accumulator is None:
+            return
+        def write(key, data):
+            _write_block_to_dset(self.df_out[key[0]], key[1], key[2], data,
+                    chunk_size=chunk_size, lock=False)
+        self.accumulator.flush(write)
+
     def read_block_from_dset(self, df_idx, dset_name, indx, data, chunk_size=1024**3):
 
         _read_block_from_dset(self.df_in[df_idx], dset_name, indx, data,
                 chunk_size= chunk_size )
 
+    def block_view(self, df_idx, dset_name, indx, mode='r+'):
+        """Writable view of the block dset[indx] of output file `df_idx`."""
 
-def _read_block_from_dset(df, dset_name, indx, data, chunk_size=1024**3):
+        return block_memmap(self.df_out[df_idx], dset_name, indx, mode)
+
+
+def create_contiguous_dataset(df, name, shape, dtype='f'):
+    """Contiguous dataset with its storage allocated at creation, so that its
+    file offset is fixed and the blocks can be memory mapped, see
+    :func:`block_memmap`. The storage is filled with zeros at allocation,
+    as the blocks are accumulated in place and the file space may be reused
+    from freed objects."""
+
+    space = h5py.h5s.create_simple(tuple(shape))
+    dcpl = h5py.h5p.create(h5py.h5p.DATASET_CREATE)
+    dcpl.set_layout(h5py.h5d.CONTIGUOUS)
+    dcpl.set_alloc_time(h5py.h5d.ALLOC_TIME_EARLY)
+    dcpl.set_fill_time(h5py.h5d.FILL_TIME_ALLOC)
+    dcpl.set_fill_value(np.zeros((1, ), dtype=dtype))
+    tid = h5py.h5t.py_create(np.dtype(dtype))
+    dsid = h5py.h5d.create(df.id, name.encode(), tid, space, dcpl=dcpl)
+    # extend the file to the allocated size
+    df.flush()
+    return h5py.Dataset(dsid)
+
+def _block_offset(dset, indx):
+    """File offset and shape of the block dset[indx], None if the dataset
+    has no fixed offset, i.e. chunked or not allocated."""
 
-    dset = df[dset_name]
     dset_off = dset.id.get_offset()
+    if dset_off is None:
+        return None, None
+    indx = tuple(indx)
+    shape = dset.shape[len(indx):]
+    block_off = 0
+    if len(indx) > 0:
+        block_off = np.ravel_multi_index(indx + (0, ) * len(shape),
+                dset.shape) * dset.dtype.itemsize
+    return dset_off + block_off, shape
+
+def block_memmap(df, dset_name, indx, mode='r+'):
+    """NumPy view of the block dset[indx] mapped from the file, None if the
+    dataset has no fixed offset."""
 
-    block_siz = data.size * data.itemsize
-    block_off = np.sum([indx[i] * np.prod(dset.shape[i+1:]) * data.itemsize 
-        for i in range(len(indx))])
-    total_off = dset_off + block_off
-    msg = 'rank: %03d | block size: %12.6f MB | item size: %2d | block off: %6dB'%(
-            mpiutil.rank, block_siz/ (1024*1024.), data.itemsize, block_off)
-    logger.debug(msg)
+    dset = df[dset_name]
+    offset, shape = _block_offset(dset, indx)
+    if offset is None:
+        return None
+    if mode != 'r' and os.path.getsize(df.filename) < offset + \
+            np.prod(shape) * dset.dtype.itemsize:
+        raise ValueError('Storage of %s is not allocated'%dset_name)
+    return np.memmap(str(df.filename), dtype=dset.dtype, mode=mode,
+            offset=offset, shape=shape)
 
-    _f = os.open(str(df.filename), os.O_RDWR | os.O_CREAT )
-    fcntl.lockf(_f, fcntl.LOCK_EX, block_siz, total_off , os.SEEK_SET)
-    os.lseek(_f, total_off, os.SEEK_SET)
-    for ii in range(0, block_siz, chunk_size):
-        read_size = min(chunk_size, block_siz - ii)
-        _s = slice(ii/data.itemsize, (ii+read_size)/data.itemsize)
-        data.flat[_s] += np.frombuffer(os.read(_f, read_size), dtype=dset.dtype)
+def _read_block_from_dset(df, dset_name, indx, data, chunk_size=1024**3):
+    """Add the block dset[indx] to `data`."""
 
-    fcntl.lockf(_f, fcntl.LOCK_UN)
-    os.close(_f)
+    block = block_memmap(df, dset_name, indx, mode='r')
+    if block is None:
+        # chunked dataset, read via hdf5
+        data += df[dset_name][tuple(indx)].reshape(data.shape)
+        return
 
+    msg = 'rank: %03d | block size: %12.6f MB | item size: %2d'%(
+            mpiutil.rank, block.nbytes / (1024*1024.), block.itemsize)
+    logger.debug(msg)
 
-def _write_block_to_dset(df, dset_name, indx, data, chunk_size=1024**3):
+    if not data.flags.c_contiguous:
+        data += np.asarray(block).reshape(data.shape)
+        return
+    _data = data.reshape(-1)
+    _block = block.reshape(-1)
+    step = max(chunk_size // block.itemsize, 1)
+    for st in range(0, _block.shape[0], step):
+        _data[st:st+step] += _block[st:st+step]
+    del block, _block
+
+def _write_block_to_dset(df, dset_name, indx, data, chunk_size=1024**3,
+        lock=True):
+    """Add `data` to the block dset[indx] of a contiguous dataset.
+
+    The byte range is locked for the read-add-write if `lock`, not needed if
+    each block is written by one rank only.
+    """
 
     dset = df[dset_name]
-    dset_off = dset.id.get_offset()
+    offset, shape = _block_offset(dset, indx)
+    block = block_memmap(df, dset_name, indx, mode='r+')
+    if block is None:
+        raise ValueError('%s is not a contiguous dataset'%dset_name)
 
-    block_siz = data.size * data.itemsize
-    block_off = np.sum([indx[i] * np.prod(dset.shape[i+1:]) * data.itemsize 
-        for i in range(len(indx))])
-    total_off = dset_off + block_off
-    msg = 'rank: %03d | dset offset: %12dB'%(mpiutil.rank, dset_off)
-    logger.debug(msg)
-    msg = 'rank: %03d | block size: %12.6f MB | item size: %2d | block off: %6dB'%(
-            mpiutil.rank, block_siz/ (1024*1024.), data.itemsize, block_off)
+    msg = 'rank: %03d | block size: %12.6f MB | item size: %2d | offset: %12dB'%(
+            mpiutil.rank, block.nbytes / (1024*1024.), block.itemsize, offset)
     logger.debug(msg)
 
-    _f = os.open(str(df.filename), os.O_RDWR | os.O_CREAT )
-    fcntl.lockf(_f, fcntl.LOCK_EX, block_siz, total_off , os.SEEK_SET)
-    os.lseek(_f, total_off, os.SEEK_SET)
+    if lock:
+        _f = os.open(str(df.filename), os.O_RDWR)
+        fcntl.lockf(_f, fcntl.LOCK_EX, block.nbytes, offset, os.SEEK_SET)
     try:
-        for ii in range(0, block_siz, chunk_size):
-            read_size = min(chunk_size, block_siz - ii)
-            _s = slice(ii/data.itemsize, (ii+read_size)/data.itemsize)
-            #print ii, read_size/data.itemsize, data.flat[_s].shape
-            data.flat[_s] += np.frombuffer(os.read(_f, read_size), dtype=dset.dtype)
-    except ValueError as err:
-        msg = 'empty array, igore read'
-        logger.debug(msg)
-
-    #buf = buffer(data)
-    os.lseek(_f, total_off, os.SEEK_SET)
-    for ii in range(0, block_siz, chunk_size):
-        read_size = min(chunk_size, block_siz - ii)
-        _s = slice(ii/data.itemsize, (ii+read_size)/data.itemsize)
-        buf = buffer(data.flat[_s])
-        os.write(_f, buf)
-    fcntl.lockf(_f, fcntl.LOCK_UN)
-    os.close(_f)
-
-
+        _data = data.reshape(-1)
+        _block = block.reshape(-1)
+        step = max(chunk_size // block.itemsize, 1)
+        for st in range(0, _block.shape[0], step):
+            _block[st:st+step] += _data[st:st+step]
+        block.flush()
+    finally:
+        if lock:
+            fcntl.lockf(_f, fcntl.LOCK_UN)
+            os.close(_f)
+    del block, _block
@@ -0,0 +1,194 @@
+"""Preconditioned conjugate gradient solver of the map-making equation.
+
+The clean map m solves C^-1 m = d, with C^-1 the (regularised) inverse noise
+covariance and d the dirty map. C^-1 is only used through its product with
+vectors, see :func:`matrix_operator`, so it can be kept banded
+(:mod:`fpipe.map.band_cov`) or applied from the pointing directly
+(:func:`fpipe.map.pointing.cov_inv_operator`).
+
+The noise diagonal diag(C) is estimated with the same solver, either
+
+    'stochastic'  diag(C) ~ mean(z * C z) of random +-1 vectors z, or
+    'truncated'   probing with the pixels split into classes of spacing
+                  `probe_dist`, the inverse covariance beyond `probe_dist`
+                  is truncated.
+
+All the right hand sides are solved at once, one operator product per
+iteration.
+
+"""
+
+import logging
+
+import numpy as np
+
+from fpipe.map import band_cov
+
+logger = logging.getLogger(__name__)
+
+
+def pcg(apply_A, b, apply_M=None, tol=1.e-6, maxiter=None):
+    """Solve A x = b with preconditioned conjugate gradients.
+
+    Parameters
+    ----------
+    apply_A : function
+        A x, for x of shape (n, k).
+    b : array, shape (n, ) or (n, k)
+        The right hand sides, solved column by column.
+    apply_M : function or None
+        The preconditioner M^-1 r, identity if None.
+    tol : float
+        Relative residual |r| / |b| of convergence.
+    maxiter : int or None
+        Max number of iterations, default to n.
+
+    Returns
+    -------
+    x : array, the same shape as `b`
+    n_iter : int
+    """
+
+    if apply_M is None:
+        apply_M = lambda r: r
+    b = np.asarray(b, dtype='float64')
+    single = b.ndim == 1
+    if single:
+        b = b[:, None]
+    if maxiter is None:
+        maxiter = b.shape[0]
+
+    b_norm = np.sqrt(np.sum(b ** 2, axis=0))
+    b_norm[b_norm == 0] = 1.
+    x = np.zeros_like(b)
+    r = b.copy()
+    z = apply_M(r)
+    p = z.copy()
+    rz = np.sum(r * z, axis=0)
+    n_iter = 0
+    for n_iter in range(maxiter):
+        active = np.sqrt(np.sum(r ** 2, axis=0)) / b_norm > tol
+        if not np.any(active):
+            break
+        Ap = apply_A(p)
+        pAp = np.sum(p * Ap, axis=0)
+        alpha = np.zeros_like(pAp)
+        good = active & (pAp != 0)
+        alpha[good] = rz[good] / pAp[good]
+        x += alpha * p
+        r -= alpha * Ap
+        z = apply_M(r)
+        rz_new = np.sum(r * z, axis=0)
+        beta = np.zeros_like(rz)
+        beta[rz != 0] = rz_new[rz != 0] / rz[rz != 0]
+        p = z + beta * p
+        rz = rz_new
+    else:
+        n_iter = maxiter
+        logger.warning('CG not converged in %d iterations, residual %e'%(
+            maxiter, np.max(np.sqrt(np.sum(r ** 2, axis=0)) / b_norm)))
+
+    if single:
+        x = x[:, 0]
+    return x, n_iter
+
+def matrix_operator(cov_inv, map_shp, band=False):
+    """Product with the dense (n_pix, n_pix) or banded inverse covariance.
+
+    Returns
+    -------
+    apply : function
+        C^-1 x, for x of shape (n_pix, k).
+    diag : 1D array, the diagonal of C^-1.
+    """
+
+    n_pix = np.prod(map_shp)
+    if band:
+        def apply(x):
+            _x = x.reshape(tuple(map_shp) + (-1, ))
+            return band_cov.dot(cov_inv, _x).reshape(n_pix, -1)
+        diag = band_cov.diagonal(cov_inv).ravel()
+    else:
+        cov_inv = cov_inv.reshape(n_pix, n_pix)
+        apply = cov_inv.dot
+        diag = np.diag(cov_inv)
+    return apply, diag
+
+def jacobi_preconditioner(diag):
+
+    inv_diag = np.zeros(diag.shape, dtype='float64')
+    inv_diag[diag != 0] = 1. / diag[diag != 0]
+    return lambda r: inv_diag[:, None] * r
+
+def block_preconditioner(cov_inv, map_shp, reg, band=False):
+    """Block Jacobi preconditioner with one block of (n_dec, n_dec) per RA
+    row, `reg` is added to the diagonal."""
+
+    n_ra, n_dec = map_shp
+    if band:
+        w_ra, w_dec = band_cov.get_width(cov_inv)
+        blocks = np.zeros((n_ra, n_dec, n_dec), dtype='float64')
+        for dj in range(2 * w_dec + 1):
+            b = dj - w_dec
+            j0, j1 = max(0, -b), min(n_dec, n_dec - b)
+            jj = np.arange(j0, j1)
+            blocks[:, jj, jj + b] = cov_inv[:, j0:j1, w_ra, dj]
+    else:
+        ii = np.arange(n_ra)
+        blocks = cov_inv.reshape(n_ra, n_dec, n_ra, n_dec)[ii, :, ii, :]
+        blocks = blocks.astype('float64')
+    jj = np.arange(n_dec)
+    blocks[:, jj, jj] += reg
+    blocks = np.linalg.inv(blocks)
+
+    def apply(r):
+        _r = r.reshape(n_ra, n_dec, -1)
+        return np.einsum('ijk,ikl->ijl', blocks, _r).reshape(r.shape)
+    return apply
+
+def truncated_probes(map_shp, probe_dist):
+    """Probe vectors of the pixel classes of spacing `probe_dist`, and the
+    class of each pixel."""
+
+    n_ra, n_dec = map_shp
+    s_ra  = max(min(probe_dist[0], n_ra),  1)
+    s_dec = max(min(probe_dist[1], n_dec), 1)
+    ii, jj = np.indices(map_shp)
+    klass = ((ii % s_ra) * s_dec + jj % s_dec).ravel()
+    probes = np.zeros((n_ra * n_dec, s_ra * s_dec))
+    probes[np.arange(n_ra * n_dec), klass] = 1.
+    return probes, klass
+
+def stochastic_probes(n_pix, n_probe, seed=0):
+
+    rng = np.random.RandomState(seed)
+    return rng.randint(0, 2, size=(n_pix, n_probe)) * 2. - 1.
+
+def solve_map(apply_A, dirty_map, map_shp, apply_M=None, noise_est='truncated',
+        probe_dist=(8, 8), n_probe=64, tol=1.e-6, maxiter=None):
+    """Clean map and noise diagonal, with A = C^-1 already regularised.
+
+    Returns
+    -------
+    clean_map, noise_diag : 1D array of n_pix
+    n_iter : int
+    """
+
+    n_pix = np.prod(map_shp)
+    if noise_est == 'truncated':
+        probes, klass = truncated_probes(map_shp, probe_dist)
+    elif noise_est == 'stochastic':
+        probes = stochastic_probes(n_pix, n_probe)
+    else:
+        raise ValueError('Unknown noise estimator %s'%noise_est)
+
+    b = np.concatenate([dirty_map.reshape(n_pix, 1), probes], axis=1)
+    x, n_iter = pcg(apply_A, b, apply_M, tol=tol, maxiter=maxiter)
+    clean_map = x[:, 0]
+    x = x[:, 1:]
+    if noise_est == 'truncated':
+        noise_diag = x[np.arange(n_pix), klass]
+    else:
+        noise_diag = np.mean(probes * x, axis=1)
+
+    return clean_map, noise_diag, n_iter
@@ -0,0 +1,294 @@
+"""Sparse pointing matrix for the map-making.
+
+The pointing matrix P maps the map pixels to the time samples, P[t, p] is the
+normalized beam response of pixel p for the time sample t. Only the pixels
+within the beam cut have non-zero response, so P is stored in CSR format and
+the dirty map and the inverse noise covariance
+
+    d     = P^T N^-1 v
+    C^-1  = P^T N^-1 P
+
+are accumulated with sparse products, without the dense (n_time, n_pix) P and
+the (n_time, n_time) diagonal noise matrix.
+
+The separations between the samples and the pixels only depend on the
+pointing, they can be kept in a :class:`PointingCache` and reused by all
+frequency channels, where only the beam width changes.
+
+"""
+
+import logging
+from collections import OrderedDict
+
+import numpy as np
+from scipy import sparse
+
+from fpipe.map import band_cov
+
+logger = logging.getLogger(__name__)
+
+
+def cut_radius(beam_sig, beam_cut):
+    """Angular radius (deg) where the Gaussian beam drops to `beam_cut`.
+
+    A tiny margin is added, so that the pixels just at the radius are kept and
+    the exact cut is left to :func:`beam_weight`.
+    """
+
+    if beam_cut is None:
+        return None
+    r2 = max(-2. * np.log(beam_cut), 0.)
+    return beam_sig * np.sqrt(r2) * (1. + 1.e-6) + 1.e-10
+
+def in_map_range(ra, dec, ra_axis, dec_axis):
+    """Mask of the time samples pointing inside the map."""
+
+    _good  = ( ra  < max(ra_axis))
+    _good *= ( ra  > min(ra_axis))
+    _good *= ( dec < max(dec_axis))
+    _good *= ( dec > min(dec_axis))
+    return _good
+
+def pointing_separation(ra, dec, ra_axis, dec_axis, max_sep=None, chunk_len=256):
+    """Angular separation between each time sample and the nearby pixels.
+
+    Parameters
+    ----------
+    ra, dec : 1D array, length n_time
+        Pointing of the time samples, in deg.
+    ra_axis, dec_axis : 1D array
+        Pixel centres of the map, in deg.
+    max_sep : float or None
+        Only pixels closer than `max_sep` (deg) are kept. If None, only the
+        nearest pixel of each time sample is kept.
+    chunk_len : int
+        Number of time samples processed at once.
+
+    Returns
+    -------
+    indptr, indices, sep : 1D arrays
+        The CSR structure of the (n_time, n_ra * n_dec) separation matrix, and
+        the separation in deg.
+    """
+
+    ra  = np.asarray(ra,  dtype='float64') * np.pi / 180.
+    dec = np.asarray(dec, dtype='float64') * np.pi / 180.
+    ra_centr  = np.asarray(ra_axis,  dtype='float64') * np.pi / 180.
+    dec_centr = np.asarray(dec_axis, dtype='float64') * np.pi / 180.
+
+    n_time = ra.shape[0]
+    n_dec = dec_centr.shape[0]
+    if max_sep is not None:
+        cos_max = np.cos(max_sep * np.pi / 180.)
+
+    counts  = np.zeros(n_time, dtype='int64')
+    indices = []
+    cos_sep_list = []
+    for st in range(0, n_time, chunk_len):
+        et = min(st + chunk_len, n_time)
+
+        _ra  = ra[st:et, None]
+        _dec = dec[st:et, None]
+        _a = np.sin(_ra) * np.sin(ra_centr[None, :])
+        _b = np.cos(_ra) * np.cos(ra_centr[None, :])
+        _c = np.cos(_dec - dec_centr[None, :])
+
+        ra_st = 0
+        if max_sep is not None:
+            # upper bound of cos(sep) of each ra column, drop the columns
+            # that are far away from all samples in this chunk.
+            _c_max = _c.max(axis=1)[:, None]
+            _c_min = _c.min(axis=1)[:, None]
+            bound = _a + np.maximum(_b * _c_max, _b * _c_min)
+            cols = np.flatnonzero(np.any(bound >= cos_max, axis=0))
+            if cols.size == 0:
+                continue
+            ra_st, ra_ed = cols[0], cols[-1] + 1
+            _a = _a[:, ra_st:ra_ed]
+            _b = _b[:, ra_st:ra_ed]
+
+        cos_sep = _a[:, :, None] + _b[:, :, None] * _c[:, None, :]
+        cos_sep.shape = (et - st, -1)
+        np.clip(cos_sep, -1., 1., out=cos_sep)
+
+        if max_sep is None:
+            tt = np.arange(et - st)
+            pix = np.argmax(cos_sep, axis=1)
+        else:
+            tt, pix = np.nonzero(cos_sep >= cos_max)
+
+        cos_sep_list.append(cos_sep[tt, pix])
+        counts[st:et] = np.bincount(tt, minlength=et - st)
+        # local pixel index to the global one
+        indices.append((pix + ra_st * n_dec).astype('int32'))
+
+    indptr = np.zeros(n_time + 1, dtype='int64')
+    np.cumsum(counts, out=indptr[1:])
+    if len(indices) == 0:
+        return indptr, np.zeros(0, dtype='int32'), np.zeros(0, dtype='float64')
+
+    indices = np.concatenate(indices)
+    sep = np.arccos(np.concatenate(cos_sep_list)) * 180. / np.pi
+
+    return indptr, indices, sep
+
+def beam_weight(indptr, indices, sep, n_pix, beam_sig, beam_cut=0.01):
+    """Build the normalized sparse pointing matrix from the separations.
+
+    Parameters
+    ----------
+    indptr, indices, sep : 1D arrays
+        Output of :func:`pointing_separation`.
+    n_pix : int
+        Number of map pixels.
+    beam_sig : float
+        Gaussian beam sigma, in deg.
+    beam_cut : float or None
+        Beam response below `beam_cut` is set to zero. If None, the samples
+        are assigned to the nearest pixel with unit weight.
+
+    Returns
+    -------
+    P : scipy.sparse.csr_matrix, shape (n_time, n_pix)
+    """
+
+    n_time = indptr.shape[0] - 1
+    if beam_cut is None:
+        weight = np.ones_like(sep)
+    else:
+        weight = np.exp(- 0.5 * (sep / beam_sig) ** 2)
+        weight[weight < beam_cut] = 0.
+        row = np.repeat(np.arange(n_time), np.diff(indptr))
+        norm = np.bincount(row, weights=weight, minlength=n_time)
+        norm[norm==0] = np.inf
+        weight /= norm[row]
+
+    # copy the index arrays, they may be shared with the cache
+    P = sparse.csr_matrix((weight, indices.copy(), indptr.copy()),
+            shape=(n_time, n_pix))
+    P.eliminate_zeros()
+    return P
+
+def accumulate_map(P, vis, weight, dirty_map, cov_inv_block, diag_cov=False,
+        band=False):
+    """Accumulate the dirty map and inverse covariance with sparse pointing.
+
+    Parameters
+    ----------
+    P : scipy.sparse.csr_matrix, shape (n_time, n_pix)
+        Pointing matrix.
+    vis : 1D array, length n_time
+        Time stream.
+    weight : 1D array, length n_time
+        Inverse noise variance of each time sample.
+    dirty_map : 1D array, length n_pix
+        Dirty map, updated in place.
+    cov_inv_block : 1D array of n_pix or 2D array of (n_pix, n_pix)
+        Inverse noise covariance, updated in place. It is the diagonal only if
+        `diag_cov` is True.
+    band : bool
+        If True, `cov_inv_block` is the (n_ra, n_dec, n_dra, n_ddec) band of
+        :mod:`fpipe.map.band_cov`.
+    """
+
+    dirty_map += P.T.dot(vis * weight)
+
+    P_w = sparse.diags(weight).dot(P).tocsr()
+    if diag_cov:
+        cov_inv_block += np.asarray(P.multiply(P_w).sum(axis=0)).ravel()
+    else:
+        cov = P.T.dot(P_w).tocoo()
+        cov.sum_duplicates()
+        if band:
+            band_cov.add_coo(cov_inv_block, cov.row, cov.col, cov.data)
+        else:
+            cov_inv_block[cov.row, cov.col] += cov.data
+
+def cov_inv_operator(P, weight):
+    """The inverse covariance P^T N^-1 P as an operator, without forming it.
+
+    Returns
+    -------
+    apply : function
+        C^-1 x, for x of shape (n_pix, k).
+    diag : 1D array, the diagonal of C^-1.
+    """
+
+    def apply(x):
+        return P.T.dot(weight[:, None] * P.dot(x))
+    diag = np.asarray(P.multiply(P).T.dot(weight)).ravel()
+    return apply, diag
+
+
+class PointingCache(object):
+    """LRU cache of the sample-pixel separations.
+
+    The separations are computed for all the samples pointing inside the map
+    and for the pixels within `max_sep`, which should be the cut radius of the
+    widest beam. Entries are keyed by the caller, e.g. (feed, time block).
+
+    Parameters
+    ----------
+    ra_axis, dec_axis : 1D array
+        Pixel centres of the map, in deg.
+    max_sep : float or None
+        Separation cut in deg, None to keep the nearest pixel only.
+    max_size : float
+        Memory budget in MB. The least recently used entries are dropped
+        once the budget is exceeded.
+    """
+
+    def __init__(self, ra_axis, dec_axis, max_sep=None, max_size=1024):
+
+        self.ra_axis  = ra_axis
+        self.dec_axis = dec_axis
+        self.max_sep  = max_sep
+        self.max_size = max_size * 1024**2
+
+        self._cache = OrderedDict()
+        self._size  = 0
+
+    def covers(self, max_sep):
+        """Check if the cached separations are enough for `max_sep`."""
+
+        if self.max_sep is None or max_sep is None:
+            return self.max_sep is None and max_sep is None
+        return max_sep <= self.max_sep
+
+    def get(self, key, ra, dec):
+        """Get the separations of `key`, compute them with `ra`, `dec` if missing.
+
+        Returns
+        -------
+        in_range : 1D bool array, length n_time
+            The samples pointing inside the map.
+        indptr, indices, sep : 1D arrays
+            See :func:`pointing_separation`, for the in-range samples only.
+        """
+
+        if key in self._cache:
+            value = self._cache.pop(key)
+            self._cache[key] = value
+            return value
+
+        in_range = in_map_range(ra, dec, self.ra_axis, self.dec_axis)
+        indptr, indices, sep = pointing_separation(ra[in_range], dec[in_range],
+                self.ra_axis, self.dec_axis, self.max_sep)
+        value = (in_range, indptr, indices, sep)
+        size = sum([x.nbytes for x in value])
+        if size > self.max_size:
+            logger.debug('pointing of %s exceeds the cache size'%(key, ))
+            return value
+
+        while self._size + size > self.max_size:
+            _key, _value = self._cache.popitem(last=False)
+            self._size -= sum([x.nbytes for x in _value])
+            logger.debug('drop pointing of %s from cache'%(_key, ))
+        self._cache[key] = value
+        self._size += size
+        return value
+
+    def clear(self):
+
+        self._cache.clear()
+        self._size = 0
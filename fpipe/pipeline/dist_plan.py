@@ -0,0 +1,154 @@
+"""Plan the redistribution of the time stream between the tasks.
+
+Each :class:`~fpipe.timestream.timestream_task.TimestreamTask` declares the
+distributed axis it works on in `_dist_axis_`, None if any. The tasks
+redistribute through :func:`redistribute`, which skips the no-op ones and
+records the time spent and the bytes moved by each task, reported by
+:func:`report` at the end of the pipeline. The time stream is read along the
+axis of the first task, see `TimestreamTask.read_input`, so no transpose is
+needed at all for a chain of tasks working on the same axis.
+
+The tasks with the same non-None `_reorder_group_` commute, the adjacent
+ones in the pipeline can be reordered by :func:`order_tasks` so that the
+tasks on the same axis run together.
+
+"""
+
+import time
+import logging
+from collections import OrderedDict
+
+import numpy as np
+from caput import mpiutil
+from fpipe.container.timestream import FAST_Timestream
+
+logger = logging.getLogger(__name__)
+
+# {stage : [number of redistributions, skipped no-op ones, bytes, seconds]}
+_stats = OrderedDict()
+
+
+def axis_index(ts, axis):
+
+    if isinstance(axis, str):
+        return ts.main_data_axes.index(axis)
+    return axis
+
+def redistributed_bytes(ts):
+    """Bytes sent by this rank in an all-to-all of the distributed datasets,
+    the sum over the ranks is the total volume."""
+
+    size = ts.comm.size if ts.comm is not None else 1
+    nbytes = 0
+    for name in (ts.main_data_name, ts.main_data_name + '_mask'):
+        if name in ts.keys():
+            dset = ts[name]
+            shape = getattr(dset, 'local_shape', dset.shape)
+            nbytes += np.prod(shape) * np.dtype(dset.dtype).itemsize
+    return int(nbytes * (size - 1) // size)
+
+def redistribute(ts, axis, stage=''):
+    """Redistribute `ts` along `axis` if it is not yet, return True if moved."""
+
+    axis = axis_index(ts, axis)
+    stat = _stats.setdefault(stage, [0, 0, 0, 0.])
+    if axis == ts.main_data_dist_axis:
+        stat[1] += 1
+        return False
+
+    nbytes = redistributed_bytes(ts)
+    t0 = time.time()
+    ts.redistribute(axis)
+    dt = time.time() - t0
+    stat[0] += 1
+    stat[2] += nbytes
+    stat[3] += dt
+    if mpiutil.rank0:
+        logger.info('%s: redistribute along %s, %.2f MB sent by rank 0 in %.2f s'%(
+            stage, ts.main_data_axes[axis], nbytes / 1024.**2, dt))
+    return True
+
+def get_stats():
+
+    return _stats
+
+def report(clear=True):
+    """Log the redistributions of each stage, the bytes sent summed over the
+    ranks and the slowest rank's time."""
+
+    stages = list(_stats.keys())
+    nbytes = np.array([_stats[s][2] for s in stages])
+    dt = np.array([_stats[s][3] for s in stages])
+    if mpiutil.size > 1 and len(stages) > 0:
+        nbytes = np.sum(mpiutil.world.allgather(nbytes), axis=0)
+        dt = np.max(mpiutil.world.allgather(dt), axis=0)
+    if mpiutil.rank0 and len(stages) > 0:
+        logger.info('%-24s %6s %6s %12s %10s'%('stage', 'moved', 'no-op',
+            'MB', 'seconds'))
+        for ii, stage in enumerate(stages):
+            n, n_skip = _stats[stage][:2]
+            logger.info('%-24s %6d %6d %12.2f %10.2f'%(stage, n, n_skip,
+                nbytes[ii] / 1024.**2, dt[ii]))
+    if clear:
+        _stats.clear()
+
+def _task_class(task):
+    return task[0] if isinstance(task, (tuple, list)) else task
+
+def _task_axis(task):
+    return _axis_name(getattr(_task_class(task), '_dist_axis_', None))
+
+def _axis_name(axis):
+    if axis is None or isinstance(axis, str):
+        return axis
+    return FAST_Timestream._main_data_axes_[axis]
+
+def count_transposes(tasks, dist_axis=0):
+    """Number of redistributions of a chain of tasks, read along `dist_axis`."""
+
+    n = 0
+    dist_axis = _axis_name(dist_axis)
+    for task in tasks:
+        axis = _task_axis(task)
+        if axis is not None and axis != dist_axis:
+            n += 1
+            dist_axis = axis
+    return n
+
+def order_tasks(tasks, dist_axis=None):
+    """Reorder the adjacent tasks of the same `_reorder_group_`, so that the
+    tasks on the same axis run together, starting with the current axis.
+
+    The order is kept otherwise, the tasks are (class, prefix) tuples as in
+    `pipe_tasks`, or the classes.
+    """
+
+    tasks = list(tasks)
+    dist_axis = _axis_name(dist_axis)
+    ordered = []
+    ii = 0
+    while ii < len(tasks):
+        group = getattr(_task_class(tasks[ii]), '_reorder_group_', None)
+        jj = ii + 1
+        while group is not None and jj < len(tasks) and \
+                getattr(_task_class(tasks[jj]), '_reorder_group_', None) == group:
+            jj += 1
+        run = tasks[ii:jj]
+
+        # axes in order of first appearance, the current one first
+        axes = [_task_axis(t) for t in run]
+        order = []
+        for axis in [None, dist_axis] + axes:
+            if axis not in order:
+                order.append(axis)
+        run = [t for axis in order for t, _axis in zip(run, axes)
+                if _axis == axis]
+        ordered += run
+
+        for t in run:
+            axis = _task_axis(t)
+            if axis is not None:
+                dist_axis = axis
+        ii = jj
+
+    return ordered
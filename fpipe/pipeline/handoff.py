@@ -0,0 +1,60 @@
+"""In-memory handoff of the time stream between pipeline runs.
+
+Running the tasks as separate pipelines, e.g. in a notebook, means writing the
+full time stream to hdf5 files after each stage and reading it back in the
+next one. In the handoff mode, a task keeps its output in memory, registered
+under its output file names, and the next task reading these files takes it
+from the registry instead. The registry is per process, each rank keeps its
+local part in place and takes it back in the next run of the same process,
+with no copy and no transport between the processes. The files are only
+written if a checkpoint is asked for.
+
+The entry is removed once taken, so the memory is released with the last
+reference. Call :func:`clear` to drop the entries never taken. The entry is
+the output object itself, not a copy, a later task of the same pipeline
+working in place on it also changes the entry.
+
+"""
+
+import os
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+_registry = OrderedDict()
+
+
+def _key(files):
+
+    if isinstance(files, str):
+        files = [files, ]
+    return tuple(sorted([os.path.abspath(f) for f in files]))
+
+def put(files, tod):
+    """Register `tod` as the content of `files`."""
+
+    key = _key(files)
+    if key in _registry:
+        logger.debug('replace the handoff of %s'%(key, ))
+    _registry[key] = tod
+
+def has(files):
+
+    return _key(files) in _registry
+
+def get(files, keep=False):
+    """Take the time stream registered for `files`, None if missing."""
+
+    key = _key(files)
+    if keep:
+        return _registry.get(key, None)
+    return _registry.pop(key, None)
+
+def keys():
+
+    return list(_registry.keys())
+
+def clear():
+
+    _registry.clear()
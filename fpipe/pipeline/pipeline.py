@@ -2,6 +2,8 @@
 pipeline driver for runing within Jupyter notebook
 """
 from tlpipe.pipeline.pipeline import *
+from fpipe.pipeline import dist_plan
+from fpipe.pipeline import profile
 
 class run_pipeline(object):
 
@@ -27,7 +29,13 @@ class run_pipeline(object):
 
     def run(self):
 
+        if self._p.get('pipe_reorder', False):
+            # group the commuting tasks on the same distributed axis
+            self._p['pipe_tasks'] = dist_plan.order_tasks(self._p['pipe_tasks'])
         Manager(self._p, feedback=self._p['pipe_feedback']).run()
+        # pipe_profile: file name prefix of the json and csv profile
+        profile.report(self._p.get('pipe_profile', None))
+        dist_plan.report()
         self.clr()
 
     def clr(self): 
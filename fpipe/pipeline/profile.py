@@ -0,0 +1,161 @@
+"""Per task timing and resource report of the pipeline.
+
+The tasks derived from :class:`ProfiledTask` record, for each call of
+`read_process_write` on each rank, the wall time, the CPU time, the peak
+resident memory, the bytes read and written by the process and the bytes
+moved by the redistributions of :mod:`fpipe.pipeline.dist_plan`.
+
+The bytes read and written are the `rchar` and `wchar` counters of
+`/proc/self/io`, i.e. all the read and write calls including the ones served
+by the page cache, zero if not available. The peak memory is the peak of the
+process so far, the memory of an earlier task shows up in the later ones.
+
+:func:`report` gathers the records of all ranks, writes them to JSON and CSV
+files and logs a summary table of each task over the ranks, it is called at
+the end of `run_pipeline.run`.
+
+"""
+
+import os
+import time
+import json
+import logging
+import resource
+from collections import OrderedDict
+
+import numpy as np
+from caput import mpiutil
+
+from fpipe.pipeline import dist_plan
+
+logger = logging.getLogger(__name__)
+
+_records = []
+
+_fields = ['task', 'rank', 'wall', 'cpu', 'peak_rss', 'read_bytes',
+        'write_bytes', 'redistributed_bytes']
+
+
+def _io_bytes():
+    """Bytes read and written by the process so far."""
+
+    try:
+        with open('/proc/self/io', 'r') as f:
+            io = dict([line.split(':') for line in f if ':' in line])
+        return int(io['rchar']), int(io['wchar'])
+    except (IOError, KeyError, ValueError):
+        return 0, 0
+
+def _redistributed_bytes():
+
+    return sum([stat[2] for stat in dist_plan.get_stats().values()])
+
+class TaskRecord(object):
+    """Context manager recording one task run."""
+
+    def __init__(self, task):
+
+        self.task = task
+
+    def __enter__(self):
+
+        self.wall = time.time()
+        t = os.times()
+        self.cpu = t[0] + t[1]
+        self.io = _io_bytes()
+        self.redistributed = _redistributed_bytes()
+        return self
+
+    def __exit__(self, *args):
+
+        t = os.times()
+        io = _io_bytes()
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        _records.append(OrderedDict([
+            ('task', self.task),
+            ('rank', mpiutil.rank),
+            ('wall', time.time() - self.wall),
+            ('cpu', t[0] + t[1] - self.cpu),
+            ('peak_rss', peak_rss),
+            ('read_bytes', io[0] - self.io[0]),
+            ('write_bytes', io[1] - self.io[1]),
+            ('redistributed_bytes', _redistributed_bytes() - self.redistributed),
+            ]))
+        return False
+
+def task_name(task):
+
+    name = task.__class__.__name__
+    if getattr(task, 'iterable', False):
+        name += '[%d]'%getattr(task, 'iteration', 0)
+    return name
+
+class ProfiledTask(object):
+    """Mix-in recording `read_process_write` of the pipeline tasks, should be
+    ahead of the task base class."""
+
+    def read_process_write(self, input):
+
+        with TaskRecord(task_name(self)):
+            return super(ProfiledTask, self).read_process_write(input)
+
+def get_records():
+
+    return _records
+
+def summary(records):
+    """{task : {field : (min, mean, max, sum) over ranks}}, the iterations
+    of a task are summed on each rank first, the peak memory is the max."""
+
+    tasks = OrderedDict()
+    for rec in records:
+        tasks.setdefault(rec['task'], []).append(rec)
+    result = OrderedDict()
+    for task, recs in tasks.items():
+        # the records of each rank are summed first for the iterations
+        ranks = OrderedDict()
+        for rec in recs:
+            r = ranks.setdefault(rec['rank'], dict.fromkeys(_fields[2:], 0))
+            for key in _fields[2:]:
+                if key == 'peak_rss':
+                    r[key] = max(r[key], rec[key])
+                else:
+                    r[key] += rec[key]
+        result[task] = OrderedDict()
+        for key in _fields[2:]:
+            value = np.array([r[key] for r in ranks.values()], dtype='float64')
+            result[task][key] = (value.min(), value.mean(), value.max(),
+                    value.sum())
+    return result
+
+def report(output=None, clear=True):
+    """Gather the records, write `output`.json and `output`.csv if `output`
+    is not None, and log the summary table on rank 0."""
+
+    records = list(_records)
+    if mpiutil.size > 1:
+        records = sum(mpiutil.world.gather(records, root=0) or [], [])
+
+    if mpiutil.rank0 and len(records) > 0:
+        if output is not None:
+            path = os.path.dirname(output)
+            if path != '' and not os.path.exists(path):
+                os.makedirs(path)
+            with open(output + '.json', 'w') as f:
+                json.dump(records, f, indent=1)
+            with open(output + '.csv', 'w') as f:
+                f.write(','.join(_fields) + '\n')
+                for rec in records:
+                    f.write(','.join([str(rec[key]) for key in _fields]) + '\n')
+            logger.info('profile written to %s.json and %s.csv'%(output, output))
+
+        logger.info('%-28s %10s %10s %10s %10s %10s %10s'%('task',
+            'wall max', 'cpu sum', 'rss max', 'read MB', 'write MB', 'mpi MB'))
+        for task, s in summary(records).items():
+            logger.info('%-28s %10.2f %10.2f %10.1f %10.1f %10.1f %10.1f'%(
+                task, s['wall'][2], s['cpu'][3], s['peak_rss'][2] / 1024.**2,
+                s['read_bytes'][3] / 1024.**2, s['write_bytes'][3] / 1024.**2,
+                s['redistributed_bytes'][3] / 1024.**2))
+
+    if clear:
+        del _records[:]
@@ -14,6 +14,7 @@ import numpy as np
 from scipy.interpolate import InterpolatedUnivariateSpline
 from fpipe.timestream import timestream_task
 from fpipe.timestream import bandpass_cal as bp
+from fpipe.timestream import noise_diode
 #from tlpipe.container.raw_timestream import RawTimestream
 #from tlpipe.container.timestream import Timestream
 from tlpipe.utils.path_util import output_path
@@ -289,10 +290,18 @@ class PlotTimeStream(timestream_task.TimestreamTask):
             }
     prefix = 'ptsbase_'
 
+    _dist_axis_ = 'baseline'
+
     def __init__(self, parameter_file_or_dict=None, feedback=0):
         super(PlotTimeStream, self).__init__(parameter_file_or_dict, feedback)
         self.feedback = feedback
 
+    def lazy_datasets(self):
+
+        main_data = self.params['main_data']
+        return dict.fromkeys([main_data, main_data + '_mask', 'blorder',
+            'freq', 'sec1970', 'ra', 'dec', 'ns_on'])
+
     def process(self, ts):
 
         fig  = plt.figure(figsize=(8, 6))
@@ -304,7 +313,7 @@ class PlotTimeStream(timestream_task.TimestreamTask):
 
         ts.main_data_name = self.params['main_data']
 
-        ts.redistribute('baseline')
+        self.redistribute(ts, 'baseline')
 
         func = ts.bl_data_operate
 
@@ -672,20 +681,15 @@ class PlotNcalVSTime(PlotVvsTime):
 
         on_t = self.params['noise_on_time']
 
-        vis1 = np.ma.array(vis)
-        if flag_mask:
-            vis1.mask = vis_mask
-
         if 'ns_on' in ts.iterkeys():
             print 'Uisng Noise Diode Mask for Ant. %03d'%(bl[0] - 1)
             if len(ts['ns_on'].shape) == 2:
                 on = ts['ns_on'][:, gi].astype('bool')
             else:
-                on = ts['ns_on'][:]
-            #on = ts['ns_on'][:]
-            vis1.mask[~on, ...] = True
+                on = ts['ns_on'][:].astype('bool')
         else:
             print "No Noise Diode Mask info"
+            on = np.zeros(vis.shape[0], dtype='bool')
 
         if self.params['plot_index']:
             y_label = r'$\nu$ index'
@@ -716,7 +720,7 @@ class PlotNcalVSTime(PlotVvsTime):
 
         good_time_st = np.argwhere(~bad_time)[ 0, 0]
         good_time_ed = np.argwhere(~bad_time)[-1, 0]
-        vis1 = vis1[good_time_st:good_time_ed, ...]
+        vis1 = vis[good_time_st:good_time_ed, ...]
         vis_mask = vis_mask[good_time_st:good_time_ed, ...]
         time = ts['sec1970'][good_time_st:good_time_ed]
         x_axis = x_axis[good_time_st:good_time_ed]
@@ -730,7 +734,14 @@ class PlotNcalVSTime(PlotVvsTime):
 
 
         kernel_size = self.params['kernel_size']
-        vis1, on = bp.get_Ncal(vis1, vis_mask, on, on_t)
+        nd = noise_diode.NoiseDiode(on, on_t)
+        if flag_mask:
+            vis1 = nd.diff(vis1, vis_mask)
+            # the flagged noise diode on samples are masked too
+            vis1.mask |= vis_mask[nd.on_index].astype('bool')
+        else:
+            vis1 = nd.diff(vis1)
+        on = nd.on
         bandpass = np.ma.median(vis1, axis=0)
         bandpass[:,0] = medfilt(bandpass[:,0], kernel_size=kernel_size)
         bandpass[:,1] = medfilt(bandpass[:,1], kernel_size=kernel_size)
@@ -783,41 +794,6 @@ class PlotNcalVSTime(PlotVvsTime):
         self.xmin = min([xmin, self.xmin])
         self.xmax = max([xmax, self.xmax])
 
-def get_Ncal(vis, vis_mask, on, on_t):
-
-    # remove the cal at the beginning/ending
-    on[ :on_t] = False
-    on[-on_t:] = False
-    if on_t == 2:
-        # noise cal may have half missing, because of the RFI flagging
-        # remove them
-        on  = (np.roll(on, 1) * on) + (np.roll(on, -1) * on)
-        # use one time stamp before, one after as cal off
-        off = (np.roll(on, 1) + np.roll(on, -1)) ^ on
-        vis1_on  = vis[on, ...]
-        vis1_off = vis[off, ...].data
-    elif on_t == 1:
-        off = np.roll(on, 1) + np.roll(on, -1)
-        vis1_on  = vis[on, ...]
-        vis1_off = vis[off, ...].data
-        vis_shp = vis1_off.shape
-        vis1_off = vis1_off.reshape( (-1, 2) + vis_shp[1:] )
-        vis1_off = np.mean(vis1_off, axis=1)
-    else:
-        raise
-    
-    #vis1 = vis1.data
-    vis1 = vis1_on - vis1_off
-
-    if on_t > 1:
-        vis_shp = vis1.shape
-        vis1 = vis1.reshape((-1, on_t) + vis_shp[1:])
-        vis1 = vis1 + vis1[:, ::-1, ...]
-        vis1.shape = vis_shp
-
-    return vis1, on
-
-
 class PlotNoiseCal(PlotVvsTime):
 
     prefix = 'pcal_'
@@ -871,6 +847,12 @@ class PlotPointingvsTime(PlotTimeStream):
 
     prefix = 'ppt_'
 
+    def lazy_datasets(self):
+
+        datasets = super(PlotPointingvsTime, self).lazy_datasets()
+        datasets.update(dict.fromkeys(['az', 'el']))
+        return datasets
+
     def plot(self, vis, vis_mask, li, gi, bl, ts, **kwargs):
 
         az  = ts['az'][:, gi]
@@ -1065,6 +1047,8 @@ class PlotSpectrum(PlotTimeStream):
 class CheckSpec(timestream_task.TimestreamTask):
     
     prefix = 'csp_'
+
+    _dist_axis_ = 'baseline'
     
     params_init = {
         'corr' : 'auto',
@@ -1095,7 +1079,7 @@ class CheckSpec(timestream_task.TimestreamTask):
                 print bad_freq
                 ts.vis_mask[:, slice(*bad_freq), ...] = True
 
-        ts.redistribute('baseline')
+        self.redistribute(ts, 'baseline')
         
 
         func = ts.bl_data_operate
@@ -11,6 +11,7 @@ from tlpipe.pipeline import pipeline
 from tlpipe.utils.path_util import output_path
 
 from fpipe.map import mapbase
+from fpipe.pipeline.profile import ProfiledTask
 from fpipe.map import algebra as al
 from fpipe.sim import beam
 from fpipe.ps import find_modes
@@ -18,7 +19,7 @@ from fpipe.ps import find_modes
 logger = logging.getLogger(__name__)
 
 
-class FGRM_SVD(pipeline.OneAndOne, mapbase.MultiMapBase):
+class FGRM_SVD(ProfiledTask, pipeline.OneAndOne, mapbase.MultiMapBase):
     """Module to estimate the power spectrum."""
 
     params_init = {
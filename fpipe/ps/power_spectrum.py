@@ -10,6 +10,7 @@ from tlpipe.pipeline.pipeline import OneAndOne
 from tlpipe.utils.path_util import output_path
 
 from fpipe.map import mapbase
+from fpipe.pipeline.profile import ProfiledTask
 from fpipe.map import algebra as al
 from fpipe.utils import physical_gridding as gridding
 from fpipe.utils import binning
@@ -22,7 +23,7 @@ physical_grid = gridding.physical_grid_lf
 #physical_grid = gridding.physical_grid
 
 
-class PowerSpectrum(OneAndOne, mapbase.MapBase):
+class PowerSpectrum(ProfiledTask, OneAndOne, mapbase.MapBase):
     """Module to estimate the power spectrum."""
 
     params_init = {
@@ -1,6 +1,11 @@
+import os
+import logging
+import hashlib
 import numpy as np
 import gc
 from fpipe.timestream import timestream_task
+from fpipe.timestream import noise_diode
+from fpipe.timestream.cal_state import CalState
 import h5py
 from astropy.time import Time
 from tlpipe.utils.path_util import output_path
@@ -13,37 +18,119 @@ from scipy import interpolate
 
 import matplotlib.pyplot as plt
 
-class Apply_EtaA(timestream_task.TimestreamTask):
+logger = logging.getLogger(__name__)
+
+class CalTask(timestream_task.TimestreamTask):
+    """
+    Base class of the calibration tasks.
+
+    If batch_cal, `cal_block` works on the local (time, freq, pol, beam) 
+    block at once, beams sharing the same noise diode mask are calibrated 
+    together. Otherwise, `cal_block` is called for each beam via 
+    `ts.bl_data_operate`, with a beam axis of length 1.
+    The per-observation arrays, sec1970 and freq, are read once.
+    """
 
     params_init = {
-            'eta_A' : None,
+            'batch_cal' : True,
             }
 
-    prefix = 'etaA_'
+    prefix = 'cal_'
+
+    _dist_axis_ = 'baseline'
 
     def process(self, ts):
 
         show_progress = self.params['show_progress']
         progress_step = self.params['progress_step']
 
+        self._noise_diode = {}
+        self._buffer = {}
+        self._time = ts['sec1970'][:]
+        self._freq = ts['freq'][:]
+
+        if self.params['batch_cal']:
+            self.redistribute(ts, 'baseline')
+            vis = ts.main_data.local_data
+            vis_mask = ts[ts.main_data_name + '_mask'].local_data
+            n_bl, bl_st, bl_ed = mpiutil.split_local(ts['blorder'].shape[0], 
+                    comm=ts.comm)
+            gi = np.arange(bl_st, bl_ed)
+            bl = ts['blorder']
+            bl = bl.local_data if bl.distributed else bl[bl_st:bl_ed]
+            ns_on = read_ns_on(ts, bl_st, bl_ed)
+            for st, ed in same_column_groups(ns_on):
+                logger.info('%s: cal. beam %s'%(self.__class__.__name__,
+                    ' '.join(['%03d'%(b[0] - 1) for b in bl[st:ed]])))
+                self.cal_block(vis[..., st:ed], vis_mask[..., st:ed],
+                        None if ns_on is None else ns_on[:, st], 
+                        gi[st:ed], bl[st:ed], ts)
+        else:
+            func = ts.bl_data_operate
+            func(self.cal_beam, full_data=True, copy_data=False, 
+                    show_progress=show_progress, 
+                    progress_step=progress_step, keep_dist_axis=False)
+
+        del self._buffer
+
+        return super(CalTask, self).process(ts)
+
+    def cal_beam(self, vis, vis_mask, li, gi, bl, ts, **kwargs):
+
+        ns_on = read_ns_on(ts, gi, gi + 1)
+        self.cal_block(vis[..., None], vis_mask[..., None], 
+                None if ns_on is None else ns_on[:, 0],
+                np.array([gi, ]), np.array([bl, ]), ts)
+
+    def cal_block(self, vis, vis_mask, on, gi, bl, ts):
+        """
+        Calibrate the block of beams in place, overridden by the subclasses.
+        Nothing is returned, the default leaves the block unchanged.
+
+        vis, vis_mask : (time, freq, pol, beam) arrays, updated in place
+        on : the noise diode mask shared by the beams, None if unknown
+        gi : global beam index
+        bl : blorder of the beams
+        """
+
+        pass
+
+    def get_noise_diode(self, on, n_time, bl):
 
-        func = ts.bl_data_operate
-        func(self.cal_etaA, full_data=True, copy_data=False, 
-                show_progress=show_progress, 
-                progress_step=progress_step, keep_dist_axis=False)
+        on_t = self.params['noise_on_time']
+        if on is None:
+            logger.warning('No Noise Diode Mask info for Ant. %03d'%(bl[0][0] - 1))
+            on = np.zeros(n_time, dtype='bool')
+        return noise_diode.cached_noise_diode(on, on_t, self._noise_diode)
+
+class Apply_EtaA(CalTask):
+    """
+    Divide the data by the aperture efficiency eta_A[beam], or
+    eta_A[beam, pol]. It is a per beam scaling, the same for all the
+    frequencies, so it commutes with `Rebin`. It does not commute with the
+    noise diode calibration, which cancels the scaling applied before it.
+    """
+
+    params_init = {
+            'eta_A' : None,
+            }
 
-        return super(Apply_EtaA, self).process(ts)
+    prefix = 'etaA_'
+
+    _reorder_group_ = 'beam_scale'
 
-    def cal_etaA(self, vis, vis_mask, li, gi, bl, ts, **kwargs):
+    def cal_block(self, vis, vis_mask, on, gi, bl, ts):
 
         eta_A = self.params['eta_A']
         if eta_A is not None:
-            print 'eta A cal'
+            if np.ndim(eta_A) > 2:
+                raise ValueError('eta_A should be eta_A[beam] or eta_A[beam, pol]')
+            logger.debug('eta A cal')
             #factor = np.pi ** 2. / 4. / np.log(2.)
-            vis /= eta_A[gi] #* factor
+            vis /= beam_factor(eta_A, gi) #* factor
 
 
-class Normal_Tsys(timestream_task.TimestreamTask):
+class Normal_Tsys(CalTask):
 
     params_init = {
             'T_sys' : 20. ,
@@ -52,130 +139,118 @@ class Normal_Tsys(timestream_task.TimestreamTask):
             'timevars_poly' : 6,
             'noise_on_time': 1,
             'sub_mean' : True,
+            'cal_state' : None,
+            'cal_state_blocks' : 8,
+            'cal_state_window' : 3600.,
             }
 
     prefix = 'tsyscal_'
 
-    def process(self, ts):
-
-        show_progress = self.params['show_progress']
-        progress_step = self.params['progress_step']
-
-
-        func = ts.bl_data_operate
-        func(self.cal_tsys, full_data=True, copy_data=False, 
-                show_progress=show_progress, 
-                progress_step=progress_step, keep_dist_axis=False)
-
-        return super(Normal_Tsys, self).process(ts)
-
-    def cal_tsys(self, vis, vis_mask, li, gi, bl, ts, **kwargs):
+    def cal_block(self, vis, vis_mask, on, gi, bl, ts):
 
         poly_order  = self.params['timevars_poly']
         on_t = self.params['noise_on_time']
-        if 'ns_on' in ts.iterkeys():
-            print 'Uisng Noise Diode Mask for Ant. %03d'%(bl[0] - 1)
-            if len(ts['ns_on'].shape) == 2:
-                on = ts['ns_on'][:, gi].astype('bool')
-            else:
-                on = ts['ns_on'][:]
-        else:
-            print "No Noise Diode Mask info"
-            on = np.zeros(vis.shape[0]).astype('bool')
-
-        vis1 = vis.copy()
-        vis1 = np.ma.array(vis1)
-        vis1.mask  = vis_mask.copy()
-        vis1[vis1==0] = np.ma.masked
-        vis1.mask[~on, ...] = True
-        vis1.mask[on, ...] = False
-
-        vis1, on = get_Ncal(vis1, vis_mask, on, on_t)
-        bandpass = np.ma.median(vis1, axis=0)
+        n_beam = vis.shape[-1]
+        nd = self.get_noise_diode(on, vis.shape[0], bl)
+        on = nd.on
+        # cal-on minus cal-off of each noise diode run, NaN if masked
+        vis1 = nd.diff(vis, vis_mask, per_sample=False, masked=False, 
+                out=get_buffer(self._buffer, 'ncal', (nd.n_run,) + vis.shape[1:], 
+                    vis.dtype))
+        bandpass = nanmedian(vis1, axis=0)
+        time  = self._time
+        state = [get_cal_state(self.params, _bl) for _bl in bl]
+        if self.params['cal_state'] is not None:
+            count = np.sum(~np.isnan(vis1), axis=0)
+            for b in range(n_beam):
+                state[b].update_bandpass(time[0], self._freq, bandpass[..., b], 
+                        count[..., b])
+                bandpass[..., b] = state[b].get_bandpass()
+        bandpass[np.isnan(bandpass)] = 0
         # smooth the bandpass to remove some RFI
-        bandpass[:,0] = medfilt(bandpass[:,0], kernel_size=51)
-        bandpass[:,1] = medfilt(bandpass[:,1], kernel_size=51)
-        bandpass = np.ma.filled(bandpass, 0)
+        bandpass[:, :2] = medfilt(bandpass[:, :2], kernel_size=[51, 1, 1])
         bandpass[bandpass==0] = np.inf
 
-        time  = ts['sec1970'][:]
         #time -= time[0]
         #time /= time.max()
         #vis1 /= np.ma.median(vis1, axis=(0,1))[None, None, :]
         vis1 /= bandpass[None, ...]
-        vis1[vis1 == 0.] = np.ma.masked
-        vis1 = np.ma.median(vis1, axis=1)
-        #poly_xx, poly_yy = polyfit_timedrift(vis1, time, on, poly_order)
-        poly_xx, poly_yy = medfilt_timedrift(vis1, time, on)
-        vis[..., 0] /= poly_xx[:, None]
-        vis[..., 1] /= poly_yy[:, None]
-        #vis_st = 0
-        #for st in np.arange(0, time.shape[0], 2048):
-        #    ed  = st + 2048
-        #    _time = time[st:ed].copy()
-        #    _time -= _time[0]
-        #    _time /= _time[-1]
-        #    _time_on = _time[on[st:ed]]
-        #    vis_ed = vis_st + _time_on.shape[0]
-        #    _vis1 = vis1[vis_st:vis_ed, ...]
-        #    vis_st = vis_ed
-        #    _good = ~_vis1.mask
-        #    vis1_poly_xx = np.poly1d(np.polyfit(_time_on[_good[:,0]], 
-        #                                        _vis1[:, 0][_good[:,0]],
-        #                                        poly_order))
-        #    vis1_poly_yy = np.poly1d(np.polyfit(_time_on[_good[:,1]], 
-        #                                        _vis1[:, 1][_good[:,1]], 
-        #                                        poly_order))
-
-        #    vis[st:ed, ..., 0] /= vis1_poly_xx(_time)[:, None]
-        #    vis[st:ed, ..., 1] /= vis1_poly_yy(_time)[:, None]
+        vis1[vis1 == 0.] = np.nan
+        vis1 = nanmedian(vis1, axis=1, overwrite_input=True)
+        vis1 = np.repeat(vis1, on_t, axis=0)
+        for b in range(n_beam):
+            time_on = time[on]
+            _vis1 = vis1[..., b]
+            if state[b] is not None:
+                # join the drift samples of the previous blocks
+                state[b].update_drift(time_on, _vis1)
+                state[b].save()
+                time_on, _vis1 = state[b].get_drift()
+            #poly_xx, poly_yy = polyfit_timedrift(_vis1, time, on, poly_order)
+            poly_xx, poly_yy = medfilt_timedrift(_vis1, time, on, time_on=time_on)
+            vis[..., 0, b] /= poly_xx[:, None]
+            vis[..., 1, b] /= poly_yy[:, None]
 
         del vis1
 
-        vis1 = vis.copy()
-        vis1 = np.ma.array(vis1)
-        vis1.mask  = vis_mask.copy()
-        vis1[vis1==0] = np.ma.masked
-
         T_sys = self.params['T_sys']
         if T_sys is not None:
-            print "Norm. T_sys to %f K"%T_sys
-            vis /= np.ma.median(vis1[~on, ...], axis=(0, 1))[None, None, :]
+            logger.debug("Norm. T_sys to %f K"%T_sys)
+            off = ~on
+            vis1 = get_buffer(self._buffer, 'off', (np.sum(off), ) + vis.shape[1:], 
+                    vis.dtype)
+            np.compress(off, vis, axis=0, out=vis1)
+            good = ~vis_mask[off]
+            good &= vis1 != 0
+            norm = np.empty(vis.shape[2:], dtype=vis.dtype)
+            for i in range(vis.shape[2]):
+                for b in range(n_beam):
+                    norm[i, b] = np.median(vis1[:, :, i, b][good[:, :, i, b]],
+                            overwrite_input=True)
+            del good, vis1
+            vis /= norm[None, None, ...]
             vis *= T_sys
             if self.params['sub_mean']:
                 vis -= T_sys
 
         relative_gain = self.params['relative_gain']
         if relative_gain is not None:
-            print "relative gain cal %d (%f %f)"%((gi,) + tuple(relative_gain[gi]))
-            vis *= relative_gain[gi, :][..., :]
+            logger.debug("relative gain cal %s"%gi)
+            vis *= beam_factor(relative_gain, gi)
 
         eta_A = self.params['eta_A']
         if eta_A is not None:
-            print 'eta A cal'
+            logger.debug('eta A cal')
             #factor = np.pi ** 2. / 4. / np.log(2.)
-            vis /= eta_A[gi] #* factor
+            vis /= beam_factor(eta_A, gi) #* factor
 
-        del vis1
-def medfilt_timedrift(vis1, time, on, kernel_size=31, fill_value = 'extrapolate'):
+def medfilt_timedrift(vis1, time, on, kernel_size=31, fill_value = 'extrapolate',
+        time_on=None):
+    '''
+    time_on: the time of vis1 samples, default to time[on]
+    '''
 
-    good_xx = ~vis1.mask[:, 0]
-    good_yy = ~vis1.mask[:, 1]
+    if time_on is None:
+        time_on = time[on]
+    vis1 = np.ma.filled(vis1, np.nan)
+    good_xx = np.isfinite(vis1[:, 0])
+    good_yy = np.isfinite(vis1[:, 1])
 
     nd_xx = medfilt(vis1[:, 0][good_xx], kernel_size=(kernel_size))
     nd_yy = medfilt(vis1[:, 1][good_yy], kernel_size=(kernel_size))
     #nd_xx = gaussian_filter1d(vis1[:, 0][good_xx], sigma=kernel_size)
     #nd_yy = gaussian_filter1d(vis1[:, 1][good_yy], sigma=kernel_size)
 
-    medfilt_xx = interpolate.interp1d(time[on][good_xx], nd_xx, kind='linear', 
+    medfilt_xx = interpolate.interp1d(time_on[good_xx], nd_xx, kind='linear', 
             bounds_error=False, fill_value=fill_value)(time)
-    medfilt_yy = interpolate.interp1d(time[on][good_yy], nd_yy, kind='linear', 
+    medfilt_yy = interpolate.interp1d(time_on[good_yy], nd_yy, kind='linear', 
             bounds_error=False, fill_value=fill_value)(time)
 
     return medfilt_xx, medfilt_yy
 
 def polyfit_timedrift(vis1, time, on, poly_order, poly_len=2048):
 
+    vis1 = np.ma.filled(vis1, np.nan)
     vis_st = 0
     poly_xx = []
     poly_yy = []
@@ -188,7 +263,7 @@ def polyfit_timedrift(vis1, time, on, poly_order, poly_len=2048):
         vis_ed = vis_st + _time_on.shape[0]
         _vis1 = vis1[vis_st:vis_ed, ...]
         vis_st = vis_ed
-        _good = ~_vis1.mask
+        _good = np.isfinite(_vis1)
         vis1_poly_xx = np.poly1d(np.polyfit(_time_on[_good[:,0]], 
                                             _vis1[:, 0][_good[:,0]],
                                             poly_order))
@@ -205,7 +280,7 @@ def polyfit_timedrift(vis1, time, on, poly_order, poly_len=2048):
     poly_yy = np.concatenate(poly_yy)
     return poly_xx, poly_yy
 
-class Bandpass_Cal(timestream_task.TimestreamTask):
+class Bandpass_Cal(CalTask):
     """
     """
 
@@ -216,91 +291,76 @@ class Bandpass_Cal(timestream_task.TimestreamTask):
             'Tnoise_file'   : None,
             'T_sys' : None,
             'plot_spec' : False,
+            'cal_state' : None,
+            'cal_state_blocks' : 8,
             }
 
     prefix = 'bpcal_'
 
-    def process(self, ts):
-
-        show_progress = self.params['show_progress']
-        progress_step = self.params['progress_step']
-
-
-        func = ts.bl_data_operate
-        func(self.cal_data, full_data=True, copy_data=False, 
-                show_progress=show_progress, 
-                progress_step=progress_step, keep_dist_axis=False)
-
-        return super(Bandpass_Cal, self).process(ts)
-
-    def cal_data(self, vis, vis_mask, li, gi, bl, ts, **kwargs):
+    def cal_block(self, vis, vis_mask, on, gi, bl, ts):
 
         on_t        = self.params['noise_on_time']
         kernel_size = self.params['bandpass_smooth']
         poly_order  = self.params['timevars_poly']
         Tnoise_file = self.params['Tnoise_file']
         plot_spec   = self.params['plot_spec']
+        freq        = self._freq
+        n_beam      = vis.shape[-1]
         if Tnoise_file is not None:
-            with h5py.File(Tnoise_file, 'r') as f:
-                Tnoise_xx = f['Tnoise'][:, 0, bl[0] - 1]
-                Tnoise_yy = f['Tnoise'][:, 1, bl[0] - 1]
-                Tnoise_f = f['freq'][:]
-            Tnoise_xx = gaussian_filter1d( Tnoise_xx, sigma=10 )
-            Tnoise_yy = gaussian_filter1d( Tnoise_yy, sigma=10 )
-
-            freq      = ts['freq'][:]
-            Tnoise_xx = interpolate.interp1d(Tnoise_f, Tnoise_xx, 
-                    bounds_error=False, fill_value=0)(freq)
-            Tnoise_yy = interpolate.interp1d(Tnoise_f, Tnoise_yy, 
-                    bounds_error=False, fill_value=0)(freq)
-
-        vis1 = np.ma.array(vis.copy())
-        vis1.mask = vis_mask.copy()
-
-        if 'ns_on' in ts.iterkeys():
-            print 'Uisng Noise Diode Mask for Ant. %03d'%(bl[0] - 1)
-            if len(ts['ns_on'].shape) == 2:
-                on = ts['ns_on'][:, gi].astype('bool')
-            else:
-                on = ts['ns_on'][:]
-            #on = ts['ns_on'][:]
-            vis1.mask[~on, ...] = True
-            vis1.mask[on, ...] = False
-            #vis1.mask[:, bad_freq] = True
-        else:
-            print "No Noise Diode Mask info"
+            Tnoise = get_Tnoise(Tnoise_file, freq)
+            Tnoise = Tnoise[:, :2, [_bl[0] - 1 for _bl in bl]]
 
-        vis1, on = get_Ncal(vis1, vis_mask, on, on_t)
+        nd = self.get_noise_diode(on, vis.shape[0], bl)
+        on = nd.on
+        # cal-on minus cal-off of each noise diode run, NaN if masked
+        vis1 = nd.diff(vis, vis_mask, per_sample=False, masked=False, 
+                out=get_buffer(self._buffer, 'ncal', (nd.n_run,) + vis.shape[1:], 
+                    vis.dtype))
 
         # take the median value of each channel as the bandpass
-        bandpass = np.ma.median(vis1, axis=0)
+        count = np.sum(~np.isnan(vis1), axis=0)
+        bandpass = nanmedian(vis1, axis=0, overwrite_input=True)
+        del vis1
+        if self.params['cal_state'] is not None:
+            for b in range(n_beam):
+                state = get_cal_state(self.params, bl[b])
+                state.update_bandpass(self._time[0], freq, bandpass[..., b], 
+                        count[..., b])
+                state.save()
+                bandpass[..., b] = state.get_bandpass()
         if plot_spec:
-            fig = plt.figure(figsize=(6, 4))
-            ax  = fig.add_axes([0.06, 0.1, 0.90, 0.8])
-            ax.plot(ts['freq'][:], bandpass[:, 0], 'r', label='bandpass X')
-            ax.plot(ts['freq'][:], bandpass[:, 1], 'b', label='bandpass Y')
+            axes = []
+            for b in range(n_beam):
+                fig = plt.figure(figsize=(6, 4))
+                ax  = fig.add_axes([0.06, 0.1, 0.90, 0.8])
+                ax.plot(freq, bandpass[:, 0, b], 'r', label='bandpass X')
+                ax.plot(freq, bandpass[:, 1, b], 'b', label='bandpass Y')
+                axes.append(ax)
+        bandpass[np.isnan(bandpass)] = 0
 
         # smooth the bandpass to remove some RFI
-        bandpass[:,0] = medfilt(bandpass[:,0], kernel_size=kernel_size)
-        bandpass[:,1] = medfilt(bandpass[:,1], kernel_size=kernel_size)
+        bandpass[:, :2] = medfilt(bandpass[:, :2], kernel_size=[kernel_size, 1, 1])
 
         if plot_spec:
-            ax.plot(ts['freq'][:], bandpass[:, 0], 'w')
-            ax.plot(ts['freq'][:], bandpass[:, 1], 'w')
-            ax.legend()
-            ax.set_ylim(ymin=2, ymax=12)
-            ax.set_xlim(xmin=ts['freq'][:].min(),xmax=ts['freq'][:].max())
+            for b, ax in enumerate(axes):
+                ax.plot(freq, bandpass[:, 0, b], 'w')
+                ax.plot(freq, bandpass[:, 1, b], 'w')
+                ax.legend()
+                ax.set_ylim(ymin=2, ymax=12)
+                ax.set_xlim(xmin=freq.min(),xmax=freq.max())
 
-        bandpass = np.ma.filled(bandpass, 0)
         bandpass[bandpass==0] = np.inf
 
         vis /= bandpass[None, ...]
 
         if plot_spec:
-            fig = plt.figure(figsize=(12, 4))
-            ax  = fig.add_axes([0.06, 0.1, 0.90, 0.8])
-            ax.plot(ts['freq'][:], np.ma.median(vis, axis=0)[:, 0], 'r')
-            ax.plot(ts['freq'][:], np.ma.median(vis, axis=0)[:, 1], 'b')
+            axes = []
+            for b in range(n_beam):
+                fig = plt.figure(figsize=(12, 4))
+                ax  = fig.add_axes([0.06, 0.1, 0.90, 0.8])
+                ax.plot(freq, np.median(vis[..., b], axis=0)[:, 0], 'r')
+                ax.plot(freq, np.median(vis[..., b], axis=0)[:, 1], 'b')
+                axes.append(ax)
 
         #vis2 = np.ma.array(vis.copy())
         #vis2.mask = vis_mask.copy()
@@ -310,95 +370,147 @@ class Bandpass_Cal(timestream_task.TimestreamTask):
 
         #vis /= norm
 
-        #if plot_spec:
-        #    ax.plot(ts['freq'][:], np.ma.median(vis, axis=0)[:, 0], 'k')
-        #    ax.plot(ts['freq'][:], np.ma.median(vis, axis=0)[:, 1], '0.5')
-
-        # get the time var
-        time  = ts['sec1970'][:]
-        time -= time[0]
-        time_on = time[on]
-        #vis1 /= np.ma.median(vis1, axis=(0,1))[None, None, :]
-        vis1 /= bandpass[None, ...]
-        vis1 = np.ma.median(vis1, axis=1)
-        good = ~vis1.mask
-        vis1_poly_xx = np.poly1d(np.polyfit(time_on[good[:,0]], 
-                                            vis1[:, 0][good[:,0]],
-                                            poly_order))
-        vis1_poly_yy = np.poly1d(np.polyfit(time_on[good[:,1]], 
-                                            vis1[:, 1][good[:,1]], 
-                                            poly_order))
-
-        #vis[..., 0] /= vis1_poly_xx(time)[:, None]
-        #vis[..., 1] /= vis1_poly_yy(time)[:, None]
-
+        # the time var of the noise diode is not applied, see Normal_Tsys
 
         if Tnoise_file is not None:
-            vis[..., 0] *= Tnoise_xx[None, :]
-            vis[..., 1] *= Tnoise_yy[None, :]
+            vis[..., :2, :] *= Tnoise[None, ...]
 
         if plot_spec:
-            ax.plot(ts['freq'][:], np.ma.median(vis, axis=0)[:, 0], 'm')
-            ax.plot(ts['freq'][:], np.ma.median(vis, axis=0)[:, 1], 'g')
-            ax.set_xlim(xmin=ts['freq'][:].min(),xmax=ts['freq'][:].max())
-            ax.set_ylim(ymin=15, ymax=25)
-            #ax.set_ylim(ymin=15, ymax=80)
+            for b, ax in enumerate(axes):
+                ax.plot(freq, np.median(vis[..., b], axis=0)[:, 0], 'm')
+                ax.plot(freq, np.median(vis[..., b], axis=0)[:, 1], 'g')
+                ax.set_xlim(xmin=freq.min(),xmax=freq.max())
+                ax.set_ylim(ymin=15, ymax=25)
+                #ax.set_ylim(ymin=15, ymax=80)
 
         if self.params['T_sys'] is not None:
             T_sys = self.params['T_sys']
-            print "Norm. T_sys to %f K"%T_sys
-            vis /= np.ma.median(vis[~on, ...], axis=(0, 1))[None, None, :]
+            logger.debug("Norm. T_sys to %f K"%T_sys)
+            vis /= np.median(vis[~on, ...], axis=(0, 1))[None, None, ...]
             vis *= T_sys
 
+def get_buffer(buffers, name, shape, dtype):
+    '''
+    get the buffer `name` from dict `buffers`, reused across beams, 
+    a new one if the shape or dtype changes.
+    '''
 
+    buf = buffers.get(name, None)
+    if buf is None or buf.shape != shape or buf.dtype != dtype:
+        buf = np.empty(shape, dtype=dtype)
+        buffers[name] = buf
+    return buf
 
+def nanmedian(data, axis=0, overwrite_input=False):
+    '''
+    median along axis, ignoring NaNs, NaN if all are NaN.
 
+    the same as np.ma.median with the NaNs masked, but working on plain
+    arrays. The data is sorted in place if overwrite_input.
+    '''
+
+    if overwrite_input:
+        data.sort(axis=axis)
+    else:
+        data = np.sort(data, axis=axis)
+    # NaNs are sorted to the end
+    n = np.sum(~np.isnan(data), axis=axis, keepdims=True)
+    lo = np.take_along_axis(data, np.maximum((n - 1) // 2, 0), axis=axis)
+    hi = np.take_along_axis(data, np.minimum(n // 2, data.shape[axis] - 1), 
+            axis=axis)
+    med = np.squeeze(lo, axis=axis)
+    med += np.squeeze(hi, axis=axis)
+    med *= 0.5
+    med[np.squeeze(n, axis=axis) == 0] = np.nan
+    return med
+
+def get_cal_state(params, bl):
+    '''
+    the calibration state of the beam if params['cal_state'] is set, 
+    otherwise None.
+    '''
+
+    if params['cal_state'] is None:
+        return None
+    return CalState(params['cal_state'], bl[0] - 1, 
+            max_block=params['cal_state_blocks'], 
+            drift_window=params.get('cal_state_window', 3600.))
+
+_Tnoise_cache = {}
+
+def get_Tnoise(Tnoise_file, freq, sigma=10):
+    '''
+    noise diode temperature of all pols and beams, (freq, pol, beam), 
+    smoothed and interpolated onto freq, 0 out of the table range.
+
+    the results are memoised by (file, mtime, freq), so that the table is 
+    loaded once for all beams and pipeline iterations.
+    '''
+
+    Tnoise_file = os.path.abspath(Tnoise_file)
+    key = (Tnoise_file, os.path.getmtime(Tnoise_file), freq.shape, 
+            hashlib.sha1(np.ascontiguousarray(freq)).hexdigest(), sigma)
+    if key in _Tnoise_cache:
+        return _Tnoise_cache[key]
+
+    with h5py.File(Tnoise_file, 'r') as f:
+        Tnoise = f['Tnoise'][:]
+        Tnoise_f = f['freq'][:]
+    Tnoise = gaussian_filter1d( Tnoise, sigma=sigma, axis=0 )
+    Tnoise = interpolate.interp1d(Tnoise_f, Tnoise, axis=0, 
+            bounds_error=False, fill_value=0)(freq)
+
+    # keep the tables of recent files only
+    for _key in list(_Tnoise_cache.keys()):
+        if _key[0] == Tnoise_file:
+            del _Tnoise_cache[_key]
+    _Tnoise_cache[key] = Tnoise
+    return Tnoise
+
+def beam_factor(factor, gi):
+    '''
+    per beam factor, factor[gi], broadcast to (time, freq, pol, beam).
+    '''
+
+    factor = np.moveaxis(np.asarray(factor)[gi], 0, -1)
+    return factor.reshape((1, ) * (4 - factor.ndim) + factor.shape)
+
+def read_ns_on(ts, st, ed):
+    '''
+    the noise diode mask of beam [st, ed), (time, beam), None if unknown.
+    '''
+
+    if 'ns_on' not in ts.iterkeys():
+        return None
+    ns_on = ts['ns_on']
+    if len(ns_on.shape) == 1:
+        ns_on = ns_on[:][:, None] * np.ones(ed - st, dtype='bool')[None, :]
+    elif ns_on.distributed and ns_on.distributed_axis == 1 \
+            and ns_on.local_data.shape[1] == ed - st:
+        ns_on = ns_on.local_data
+    else:
+        ns_on = ns_on[:, st:ed]
+    return np.asarray(ns_on).astype('bool')
+
+def same_column_groups(ns_on):
+    '''
+    split the beams into groups of consecutive beams with the same 
+    noise diode mask, return list of (st, ed).
+    '''
+
+    if ns_on is None or ns_on.shape[1] == 0:
+        return [(0, None), ]
+    change = np.any(ns_on[:, 1:] != ns_on[:, :-1], axis=0)
+    edges = np.concatenate([[0], np.flatnonzero(change) + 1, [ns_on.shape[1]]])
+    return zip(edges[:-1], edges[1:])
 
 def get_Ncal(vis, vis_mask, on, on_t):
+    '''
+    cal-on minus cal-off of the noise diode, see noise_diode.NoiseDiode
 
-    # remove the cal at the beginning/ending
-    on[ :on_t] = False
-    on[-on_t:] = False
-    if on_t == 2:
-        # noise cal may have half missing, because of the RFI flagging
-        # remove them
-        on  = (np.roll(on, 1) * on) + (np.roll(on, -1) * on)
-        # use one time stamp before, one after as cal off
-        off = (np.roll(on, 1) + np.roll(on, -1)) ^ on
-        vis1_on  = vis[on, ...].data
-        vis1_off = vis[off, ...].data
-        mask     = vis_mask[off, ...]
-    elif on_t == 1:
-        off = np.roll(on, 1) + np.roll(on, -1)
-        vis1_on  = vis[on, ...].data
-        vis1_off = vis[off, ...].data
-        # because the nearby time are masked, we use futher ones.
-        mask_off = np.roll(on, 2) + np.roll(on, -2)
-        mask     = vis_mask[mask_off, ...]
-
-        vis_shp = vis1_off.shape
-        vis1_off = vis1_off.reshape( (-1, 2) + vis_shp[1:] )
-        vis1_off = np.ma.mean(vis1_off, axis=1)
-
-        mask    = mask.reshape((-1, 2) + vis_shp[1:])
-        mask    = np.sum(mask, axis=1).astype('bool')
-    else:
-        raise
-    
-    #vis1 = vis1.data
-    #print vis1_on.dtype
-    #print vis1_off.dtype
-    #print np.all(vis1_off.mask)
-    #print np.all(vis1_on.mask)
-    vis1 = vis1_on - vis1_off
-    vis1 = np.ma.array(vis1)
-    vis1.mask = mask
-
-    if on_t > 1:
-        vis_shp = vis1.shape
-        vis1 = vis1.reshape((-1, on_t) + vis_shp[1:])
-        vis1 = vis1 + vis1[:, ::-1, ...]
-        vis1.shape = vis_shp
-
-    return vis1, on
+    return the difference, one row for each used cal-on time stamp, 
+    and the mask of the used cal-on time stamps.
+    '''
 
+    nd = noise_diode.NoiseDiode(on, on_t)
+    return nd.diff(vis, vis_mask), nd.on
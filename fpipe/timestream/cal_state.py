@@ -0,0 +1,144 @@
+"""Noise diode calibration state shared by consecutive observation blocks.
+
+The bandpass and the time drift of the noise diode only change slowly
+within one night, so the blocks of the same night can share them. The state
+of each beam is kept in a hdf5 file `<path>/M%03d.h5` with
+
+    freq        (n_freq, )                 frequency channels
+    block       (n_block, )                first time stamp of the blocks
+    bandpass    (n_block, n_freq, n_pol)   median noise diode of each block
+    count       (n_block, n_freq, n_pol)   number of runs in the median
+    drift_time  (n_drift, )                time of the drift samples
+    drift       (n_drift, n_pol)           noise diode relative to bandpass
+
+The running bandpass is the count weighted median of the medians of the
+last `max_block` blocks. The drift samples within `drift_window` seconds
+before the new block are kept, so that the drift model joins the previous
+block smoothly. A new block is calibrated with the updated state, without
+reading the earlier blocks again. Re-processing a block replaces its
+entries.
+
+"""
+
+import os
+
+import numpy as np
+import h5py
+
+
+def weighted_median(data, weight, axis=0):
+    """Weighted median along `axis`, NaN entries or zero total weight give NaN."""
+
+    weight = np.where(np.isnan(data), 0, weight).astype('float64')
+    order = np.argsort(data, axis=axis)
+    data = np.take_along_axis(data, order, axis=axis)
+    cum = np.cumsum(np.take_along_axis(weight, order, axis=axis), axis=axis)
+    total = np.take(cum, [-1], axis=axis)
+    idx = np.argmax(cum >= 0.5 * total, axis=axis)
+    med = np.take_along_axis(data, np.expand_dims(idx, axis), axis=axis)
+    med = np.squeeze(med, axis=axis)
+    med[np.squeeze(total, axis=axis) == 0] = np.nan
+    return med
+
+class CalState(object):
+    """Calibration state of one beam.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the state files.
+    beam : int
+        Beam index, 0 based.
+    max_block : int
+        Number of recent blocks used for the bandpass.
+    drift_window : float
+        Length in seconds of the drift samples kept before a new block.
+    """
+
+    def __init__(self, path, beam, max_block=8, drift_window=3600.):
+
+        self.fname = os.path.join(path, 'M%03d.h5'%beam)
+        self.max_block = max_block
+        self.drift_window = drift_window
+
+        self.freq = None
+        self.block = np.zeros(0)
+        self.bandpass = None
+        self.count = None
+        self.drift_time = np.zeros(0)
+        self.drift = None
+        if os.path.exists(self.fname):
+            with h5py.File(self.fname, 'r') as f:
+                self.freq = f['freq'][:]
+                self.block = f['block'][:]
+                self.bandpass = f['bandpass'][:]
+                self.count = f['count'][:]
+                self.drift_time = f['drift_time'][:]
+                self.drift = f['drift'][:]
+
+    @property
+    def n_block(self):
+        return self.block.shape[0]
+
+    def update_bandpass(self, block, freq, bandpass, count):
+        """Add the bandpass of the block starting at time `block`."""
+
+        if self.freq is None:
+            self.freq = freq
+            self.bandpass = np.zeros((0, ) + bandpass.shape, dtype=bandpass.dtype)
+            self.count = np.zeros((0, ) + bandpass.shape, dtype='int32')
+        elif not np.array_equal(self.freq, freq):
+            raise ValueError('Frequency of %s does not match'%self.fname)
+
+        keep = self.block != block
+        order = np.argsort(np.append(self.block[keep], block), kind='mergesort')
+        order = order[-self.max_block:]
+        self.block = np.append(self.block[keep], block)[order]
+        self.bandpass = np.concatenate([self.bandpass[keep],
+            bandpass[None, ...]])[order]
+        self.count = np.concatenate([self.count[keep],
+            count[None, ...].astype('int32')])[order]
+
+    def get_bandpass(self):
+        """The running bandpass, NaN if no valid runs."""
+
+        return weighted_median(self.bandpass, self.count, axis=0)
+
+    def update_drift(self, time, drift):
+        """Add the drift samples of a new block, drop the ones out of window."""
+
+        if self.drift is None:
+            self.drift = np.zeros((0, ) + drift.shape[1:], dtype=drift.dtype)
+
+        keep  = self.drift_time < time[0]
+        keep &= self.drift_time >= time[0] - self.drift_window
+        self.drift_time = np.append(self.drift_time[keep], time)
+        self.drift = np.concatenate([self.drift[keep], drift])
+
+    def get_drift(self):
+        """Time and value of the drift samples."""
+
+        return self.drift_time, self.drift
+
+    def save(self):
+
+        path = os.path.dirname(self.fname)
+        if not os.path.exists(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                # created by other process
+                pass
+
+        tmp_name = self.fname + '.%d.tmp'%os.getpid()
+        with h5py.File(tmp_name, 'w') as f:
+            f['freq'] = self.freq
+            f['block'] = self.block
+            f['bandpass'] = self.bandpass
+            f['count'] = self.count
+            f['drift_time'] = self.drift_time
+            if self.drift is not None:
+                f['drift'] = self.drift
+            else:
+                f['drift'] = np.zeros((0, ) + self.bandpass.shape[2:])
+        os.rename(tmp_name, self.fname)
@@ -6,8 +6,10 @@ import matplotlib.gridspec as gridspec
 from matplotlib.ticker import MaxNLocator,ScalarFormatter
 
 import data_format
+import tl_layout
 import h5py
 from fpipe.utils import coord
+from caput import mpiutil
 
 from astropy import units as u
 from astropy.time import Time
@@ -35,118 +37,192 @@ _Location = EarthLocation.from_geodetic(_Lon, _Lat)
 def convert_to_tl(data_path, data_file, output_path, alt_f, az_f, feed_rotation=0,
                   beam_list = [0, ], block_list = [0, 1],
                   fmin=None, fmax=None, degrade_freq_resol=None,
-                  noise_cal = [8, 1, 0]):
+                  noise_cal = [8, 1, 0], chunk_len=1024,
+                  chunk_vis=False, chunk_shape=None, chunk_size=1024,
+                  vis_compression=None, mask_compression=None,
+                  pointing_accuracy=None, coord_file=None, pointing_cache=None):
+    '''
+    convert the FAST fits files to tlpipe format hdf5 file.
+
+    chunk_len: the fits files are memory mapped and streamed in time chunks
+               of chunk_len samples, written directly to the output file.
+               If None, all data of one beam are loaded in memory first.
+
+    chunk_vis, chunk_shape, chunk_size: chunk the vis and vis_mask in
+               (time block, freq block, pol, 1 beam), see
+               tl_layout.get_chunk_shape.
+    vis_compression, mask_compression: compression filter for vis and
+               vis_mask, e.g. 'bitshuffle', 'lzf' or 'gzip'.
+    pointing_accuracy: if not None, use the fast pointing with the required
+               accuracy in arcsec, see coord.get_pointing_any_scan.
+    coord_file, pointing_cache: if coord_file is not None, the pointing is
+               read from the feed cabin coordinate file instead of alt_f and
+               az_f, and saved to/reused from the pointing_cache directory,
+               see coord.get_pointing_cached.
+
+    If running with MPI, the beams are distributed over the ranks, which read,
+    flag and rebin their beams concurrently. The ranks then take turns to
+    write their beams to the output file.
+    '''
     
     data_file_list = [[data_path + data_file%(_beam, _block)
                        for _block in block_list] for _beam in beam_list]
+    beam_n = len(beam_list)
     
     history = 'Convert from:\n'
-    with h5py.File(output_path, 'w') as df:
-        
-        fill_info(df) # some infomation
-        
-        data_shp = None
-        beam_n = len(beam_list)
-        for ii in range(beam_n):
-        
-            print fmin, fmax
-            fdata = data_format.FASTfits_Spec(data_file_list[ii], fmin, fmax)
-            fdata.flag_cal(*noise_cal)
-            if degrade_freq_resol is not None:
-                fdata.rebin_freq(degrade_freq_resol)
-            print fdata.history
-            if ii == 0: history += fdata.history
-        
-            if data_shp is None:
-                data_shp = fdata.data.shape + (beam_n, )
-                df.create_dataset('vis', dtype='float32', shape=data_shp)
-                df['vis'].attrs['dimname'] = 'Time, Frequency, Polarization, Baseline'
-            
-                df.create_dataset('vis_mask', dtype='uint8', shape=data_shp)
-                df['vis_mask'].attrs['dimname'] = 'Time, Frequency, Polarization, Baseline'
-                
-                obstime = fdata.date_obs.datetime.strftime('%Y/%m/%d %H:%M:%S')
-                inttime = fdata.time[1] - fdata.time[0]
-                df.attrs['inttime'] = inttime
-                df.attrs['obstime'] = obstime
-                df.attrs['sec1970'] = fdata.time[0]
-                df['sec1970'] = fdata.time
-                df['sec1970'].attrs['dimname'] = 'Time, '
-                df['pol'] = np.array([0, 1, 2, 3])
-                df['pol'].attrs['dimname'] = 'Polarization, '
-                
-                nfreq = fdata.freq.shape[0]
-                df.attrs['nfreq'] = nfreq
-                df.attrs['freqstart'] = fdata.freq[0]
-                df.attrs['freqstep'] = fdata.freq[1] - fdata.freq[0]
-                print 'Frequency range [%8.4f, %8.4f] MHz'%(
-                        fdata.freq[0], fdata.freq[-1])
-                print 'Frequency %8.4f MHz x %d'%(
-                        fdata.freq[1] - fdata.freq[0], nfreq)
 
+    # the time and frequency of the first beam, read from the fits header
+    # only, are used for the meta data and checking the other beams.
+    fhead = _load_beam(data_file_list[0], fmin, fmax, noise_cal,
+                       degrade_freq_resol, chunk_len=1)
+    history += fhead.history
+    data_shp = fhead.shape + (beam_n, )
+    layout = {
+            'vis'      : dict(chunk_vis=chunk_vis, chunk_shape=chunk_shape,
+                              chunk_size=chunk_size, compression=vis_compression),
+            'vis_mask' : dict(chunk_vis=chunk_vis, chunk_shape=chunk_shape,
+                              chunk_size=chunk_size, compression=mask_compression),
+            }
+
+    if mpiutil.rank0:
+        print fmin, fmax
+        print fhead.history
+        with h5py.File(output_path, 'w') as df:
+            fill_info(df) # some infomation
+            if coord_file is None:
                 ## get ra dec according to meridian scan
-                #ra, dec = get_pointing_meridian_scan(fdata.time, dec0, 
+                #ra, dec = get_pointing_meridian_scan(fhead.time, dec0, 
                 #        time_format='unix', feed_rotation=feed_rotation)
-                #ra, dec = get_pointing_meridian_scan(fdata.time, alt, az,
+                #ra, dec = get_pointing_meridian_scan(fhead.time, alt, az,
                 #        time_format='unix', feed_rotation=feed_rotation)
-                alt0 = alt_f(fdata.time)
-                az0  = az_f(fdata.time)
-                az, alt, ra, dec = coord.get_pointing_any_scan(fdata.time, 
-                        alt0, az0, time_format='unix', feed_rotation=feed_rotation)
-
-                cal_on = fdata.cal_on[:, None] * np.ones(beam_n)[None, :]
-                cal_on = cal_on.astype('bool')
-                df['ns_on'] = cal_on
-                df['ns_on'].attrs['dimname']  = 'Time, Baseline'
-
+                alt0 = alt_f(fhead.time)
+                az0  = az_f(fhead.time)
+                pointing = coord.get_pointing_any_scan(fhead.time, 
+                        alt0, az0, time_format='unix', feed_rotation=feed_rotation,
+                        accuracy=pointing_accuracy)
             else:
-                if not np.array_equal(df['sec1970'][:], fdata.time):
-                    emsg = 'Time not match between M%03d and M001'%(beam_list[ii])
-                    raise ValueError(emsg)
-                if df.attrs['freqstart'] != fdata.freq[0]:
-                    emsg = 'Freq not match between M%03d and M001'%(beam_list[ii])
-                    raise ValueError(emsg)
-
-        
-            df['vis'][...,ii] = fdata.data.astype('float32')
-            df['vis_mask'][..., ii] = fdata.mask.astype('uint8')
-
-            del fdata
-            gc.collect()
-            
-            print
-        
-        # get ra dec according to meridian scan
-        beam_indx = [x-1 for x in beam_list]
-        ra  = ra[:,  beam_indx]
-        dec = dec[:, beam_indx]
-
-        df['ra'] = ra
-        df['ra'].attrs['dimname']  = 'Time, Baseline'
-
-        df['dec'] = dec.astype('float32')
-        df['dec'].attrs['dimname'] = 'Time, Baseline'
-
-        df.attrs['history'] = history
-        df.attrs['nants'] = data_shp[3]
-        df.attrs['npol']  = data_shp[2]
-        
-        channo = []
-        feedpos= []
-        feedno = np.array(beam_list)
-        for _b in beam_list:
-            channo.append([2 * _b -1, 2 * _b])
-            feedpos.append([0, 0, 0])
-
-        blorder = [[feedno[i], feedno[i]] for i in range(len(beam_list))]
-        df['blorder'] = blorder
-        df['blorder'].attrs['dimname'] = 'Baselines, BaselineName'
-        df['feedno'] = feedno
-        df['channo'] = np.array(channo)
-        df['channo'].attrs['dimname'] = 'Feed No., (HPolarization VPolarization)'
-        df['feedpos'] = np.array(feedpos)
-        df['feedpos'].attrs['dimname'] = 'Feed No., (X,Y,Z) coordinate' ###
-        df['feedpos'].attrs['unit'] = 'degree'
+                pointing = coord.get_pointing_cached(coord_file, fhead.time,
+                        feed_rotation=feed_rotation, accuracy=pointing_accuracy,
+                        cache_dir=pointing_cache)
+            init_tl_datasets(df, fhead, data_shp, pointing, beam_list, history,
+                             layout)
+    mpiutil.barrier()
+
+    for round_st in range(0, beam_n, mpiutil.size):
+        ii = round_st + mpiutil.rank
+        emsg = []
+        if ii < beam_n:
+            print 'RANK %03d: load M%03d'%(mpiutil.rank, beam_list[ii])
+            fdata = _load_beam(data_file_list[ii], fmin, fmax, noise_cal,
+                               degrade_freq_resol, chunk_len=chunk_len)
+            if not np.array_equal(fhead.time, fdata.time):
+                emsg.append('Time not match between M%03d and M%03d'%(
+                        beam_list[ii], beam_list[0]))
+            if not np.array_equal(fhead.freq, fdata.freq):
+                emsg.append('Freq not match between M%03d and M%03d'%(
+                        beam_list[ii], beam_list[0]))
+        # raise on all ranks, otherwise the others hang in the barrier below
+        emsg = mpiutil.allreduce(emsg)
+        if len(emsg) > 0:
+            raise ValueError('; '.join(emsg))
+        # single writer, ranks write their beams in turn.
+        for rank in range(mpiutil.size):
+            if rank == mpiutil.rank and ii < beam_n:
+                with h5py.File(output_path, 'r+') as df:
+                    for st, data, mask in fdata.iter_chunks():
+                        et = st + data.shape[0]
+                        df['vis'][st:et, ..., ii] = data.astype('float32')
+                        if mask is not None:
+                            df['vis_mask'][st:et, ..., ii] = mask.astype('uint8')
+                        del data, mask
+                del fdata
+                gc.collect()
+            mpiutil.barrier()
+
+def _load_beam(file_list, fmin, fmax, noise_cal, degrade_freq_resol,
+               chunk_len=None):
+
+    if chunk_len is None:
+        fdata = data_format.FASTfits_Spec(file_list, fmin, fmax)
+    else:
+        fdata = data_format.FASTfits_SpecStream(file_list, fmin, fmax,
+                chunk_len=chunk_len)
+    fdata.flag_cal(*noise_cal)
+    if degrade_freq_resol is not None:
+        fdata.rebin_freq(degrade_freq_resol)
+    return fdata
+
+def init_tl_datasets(df, fdata, data_shp, pointing, beam_list, history,
+                     layout=None):
+
+    if layout is None:
+        layout = {}
+    tl_layout.create_dataset(df, 'vis', data_shp, 'float32',
+            **layout.get('vis', {'chunk_vis': False}))
+    df['vis'].attrs['dimname'] = 'Time, Frequency, Polarization, Baseline'
+
+    tl_layout.create_dataset(df, 'vis_mask', data_shp, 'uint8',
+            **layout.get('vis_mask', {'chunk_vis': False}))
+    df['vis_mask'].attrs['dimname'] = 'Time, Frequency, Polarization, Baseline'
+    
+    obstime = fdata.date_obs.datetime.strftime('%Y/%m/%d %H:%M:%S')
+    inttime = fdata.time[1] - fdata.time[0]
+    df.attrs['inttime'] = inttime
+    df.attrs['obstime'] = obstime
+    df.attrs['sec1970'] = fdata.time[0]
+    df['sec1970'] = fdata.time
+    df['sec1970'].attrs['dimname'] = 'Time, '
+    df['pol'] = np.array([0, 1, 2, 3])
+    df['pol'].attrs['dimname'] = 'Polarization, '
+    
+    nfreq = fdata.freq.shape[0]
+    df.attrs['nfreq'] = nfreq
+    df.attrs['freqstart'] = fdata.freq[0]
+    df.attrs['freqstep'] = fdata.freq[1] - fdata.freq[0]
+    print 'Frequency range [%8.4f, %8.4f] MHz'%(
+            fdata.freq[0], fdata.freq[-1])
+    print 'Frequency %8.4f MHz x %d'%(
+            fdata.freq[1] - fdata.freq[0], nfreq)
+
+    az, alt, ra, dec = pointing
+
+    beam_n = data_shp[3]
+    cal_on = fdata.cal_on[:, None] * np.ones(beam_n)[None, :]
+    cal_on = cal_on.astype('bool')
+    df['ns_on'] = cal_on
+    df['ns_on'].attrs['dimname']  = 'Time, Baseline'
+
+    # get ra dec according to meridian scan
+    beam_indx = [x-1 for x in beam_list]
+    ra  = ra[:,  beam_indx]
+    dec = dec[:, beam_indx]
+
+    df['ra'] = ra
+    df['ra'].attrs['dimname']  = 'Time, Baseline'
+
+    df['dec'] = dec.astype('float32')
+    df['dec'].attrs['dimname'] = 'Time, Baseline'
+
+    df.attrs['history'] = history
+    df.attrs['nants'] = data_shp[3]
+    df.attrs['npol']  = data_shp[2]
+    
+    channo = []
+    feedpos= []
+    feedno = np.array(beam_list)
+    for _b in beam_list:
+        channo.append([2 * _b -1, 2 * _b])
+        feedpos.append([0, 0, 0])
+
+    blorder = [[feedno[i], feedno[i]] for i in range(len(beam_list))]
+    df['blorder'] = blorder
+    df['blorder'].attrs['dimname'] = 'Baselines, BaselineName'
+    df['feedno'] = feedno
+    df['channo'] = np.array(channo)
+    df['channo'].attrs['dimname'] = 'Feed No., (HPolarization VPolarization)'
+    df['feedpos'] = np.array(feedpos)
+    df['feedpos'].attrs['dimname'] = 'Feed No., (X,Y,Z) coordinate' ###
+    df['feedpos'].attrs['unit'] = 'degree'
         
 
 def fill_info(df):
@@ -4,6 +4,8 @@ import h5py
 from astropy import units as u
 from astropy.time import Time
 
+from fpipe.timestream import noise_diode
+
 class FASTfits_Spec(object):
     '''
     Load the raw FAST fits file
@@ -102,47 +104,183 @@ class FASTfits_Spec(object):
                 %(l, p, d)
         self.history += msg
         
-        cal_on = np.zeros(self.data.shape[0]).astype('bool')
-        cal_on = cal_on.reshape(-1, p)
-        cal_on[:, d:l] = True
-        cal_on = cal_on.flatten()
+        cal_on = noise_diode.cal_on_mask(self.time.shape[0], p, l, d)
         self.cal_on = cal_on
         self.cal_off = np.roll(cal_on, 1)
 
     def rebin_freq(self, n=16):
 
-        time_n, freq_n, pol_n = self.data.shape
-
-        freq = self.freq
-        freq_reso = freq[1] - freq[0]
-        freq_n = freq_n / n
-        freq = freq[:freq_n*n].reshape(freq_n, n)
-        msg  = "Degrade frequency resolution from %16.12f kHz to %16.12f kHz\n"%(
-                freq_reso * 1.e3, freq_reso * n * 1.e3)
-        msg += "By averaging avery %d frequency bins\n"%n
-
-        data_shp = (time_n, freq_n, n, pol_n)
+        freq, msg = rebin_freq_axis(self.freq, n)
+        data, mask = rebin_freq_data(self.data, self.mask, n)
 
-        data = self.data[...,:freq_n*n].reshape(data_shp)
-        mask = self.mask[...,:freq_n*n].reshape(data_shp)
-        data[mask] = 0.
-        mask = (~mask).astype('int')
-        
-        freq = np.mean(freq, axis=1)
-        msg += "Freq(0) = %16.12f MHz, dFreq = %16.12f kHz\n"%(
-                freq[0], (freq[1] - freq[0] ) * 1.e3)
-        data = np.sum(data, axis=2)
-        norm = np.sum(mask, axis=2) * 1.
-        mask = norm < n * 0.8
-        norm[mask] = np.inf
-        data = data / norm
-        
         self.data = data
         self.mask = mask
         self.freq = freq
 
         self.history += msg
 
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def iter_chunks(self):
+        """Iterate over the time chunks, yield (start, data, mask)."""
+
+        yield 0, self.data, self.mask
+
+class FASTfits_SpecStream(FASTfits_Spec):
+    '''
+    Stream the raw FAST fits file in time chunks
+
+    The fits files are memory mapped, only the time stamps and the frequency
+    channels are loaded at initialization. The data are read chunk by chunk
+    with `iter_chunks`, truncated to [fmin, fmax] and rescaled on the fly.
+
+    attrs:
+        shape : shape of the main data, [time, freq, pol]
+        time : the timestamps, in unix time
+        freq : the frequency chennals, in MHz
+
+    '''
+
+    def __init__(self, file_name_list, fmin=None, fmax=None, chunk_len=1024):
+
+        if not isinstance( file_name_list, list):
+            file_name_list = [file_name_list, ]
+
+        self.file_name_list = file_name_list
+        self.chunk_len = chunk_len
+        self.rebin_n = None
+        self.history = ''
+
+        time = []
+        freq = None
+        for file_name in file_name_list:
+            _time, _freq, _f_sel, _n_pol = self.load_one_header(file_name, fmin, fmax)
+            time.append(_time)
+            if freq is None:
+                freq = _freq
+            else:
+                if np.any(_freq != freq):
+                    raise ValueError('Freq not match between files')
+
+        self.freq = freq
+        self.f_sel = _f_sel
+        self.n_pol = _n_pol
+        self.n_time_list = [x.shape[0] for x in time]
+
+        time = np.concatenate(time, axis=0)
+        time = Time(time, format='mjd', scale='utc')
+        self.time = time.unix
+        self.date_obs = time[0]
+
+    def load_one_header(self, file_name, fmin, fmax):
+
+        self.history += '%s\n'%file_name
+        hdulist = pyfits.open(file_name, memmap=True)
+
+        data_sets = hdulist[1].data
+        freq_0 = data_sets.field('FREQ')[0]
+        freq_n = data_sets.field('NCHAN')[0]
+        freq_w = data_sets.field('CHAN_BW')[0]
+
+        freq = np.arange(freq_n) * freq_w + freq_0
+
+        if not ((fmin is None) and (fmax is None)):
+            f_st, f_ed = self.freq_truncate(freq, fmin, fmax)
+        else:
+            f_st = 0
+            f_ed = None
+        freq = freq[f_st:f_ed]
+
+        time = np.array(data_sets.field('UTOBS'))
+        n_pol = data_sets.field('DATA').shape[-1]
+
+        del data_sets
+        hdulist.close()
+
+        return time, freq, slice(f_st, f_ed), n_pol
+
+    def rebin_freq(self, n=16):
+
+        freq, msg = rebin_freq_axis(self.freq, n)
+
+        self.rebin_n = n
+        self.freq = freq
+        self.history += msg
+
+    @property
+    def shape(self):
+        return (self.time.shape[0], self.freq.shape[0], self.n_pol)
+
+    def iter_chunks(self):
+        """Iterate over the time chunks, yield (start, data, mask).
+
+        The mask is None if no data are flagged in the chunk.
+        """
+
+        t_st = 0
+        for file_name in self.file_name_list:
+            hdulist = pyfits.open(file_name, memmap=True)
+            data_sets = hdulist[1].data
+            n_time = data_sets.shape[0]
+            for st in range(0, n_time, self.chunk_len):
+                et = min(st + self.chunk_len, n_time)
+                data = np.array(data_sets.field('DATA')[st:et, self.f_sel, :],
+                        dtype='float32')
+                data *= 1.e-10 # raw data have huge value, reacaled by 10^-10.
+                mask = None
+                if self.rebin_n is not None:
+                    data, mask = rebin_freq_data(data, mask, self.rebin_n)
+                yield t_st + st, data, mask
+                del data, mask
+            t_st += n_time
+            del data_sets
+            hdulist.close()
+
+def rebin_freq_axis(freq, n=16):
+    """Average every `n` frequency channels, return the new freq and history."""
+
+    freq_reso = freq[1] - freq[0]
+    freq_n = freq.shape[0] // n
+    freq = freq[:freq_n*n].reshape(freq_n, n)
+    msg  = "Degrade frequency resolution from %16.12f kHz to %16.12f kHz\n"%(
+            freq_reso * 1.e3, freq_reso * n * 1.e3)
+    msg += "By averaging avery %d frequency bins\n"%n
+
+    freq = np.mean(freq, axis=1)
+    msg += "Freq(0) = %16.12f MHz, dFreq = %16.12f kHz\n"%(
+            freq[0], (freq[1] - freq[0] ) * 1.e3)
+
+    return freq, msg
+
+def rebin_freq_data(data, mask, n=16):
+    """Average every `n` frequency bins of data [time, freq, pol].
+
+    The mask can be None if nothing is flagged, and then None is returned as
+    the new mask. Otherwise, bins with less than 80% valid data are masked.
+    """
+
+    time_n, freq_n, pol_n = data.shape
+    freq_n = freq_n // n
+    data_shp = (time_n, freq_n, n, pol_n)
+
+    data = data[:, :freq_n*n].reshape(data_shp)
+    if mask is None:
+        return np.mean(data, axis=2), None
+
+    mask = mask[:, :freq_n*n].reshape(data_shp)
+    data[mask] = 0.
+    mask = (~mask).astype('int')
+
+    data = np.sum(data, axis=2)
+    norm = np.sum(mask, axis=2) * 1.
+    mask = norm < n * 0.8
+    norm[mask] = np.inf
+    data = data / norm
+
+    return data, mask
+
 class FASTh5_Spec(object):
     '''
     Load the FAST hdf5 file
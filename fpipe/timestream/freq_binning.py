@@ -0,0 +1,161 @@
+"""Mask aware averaging of adjacent frequency channels.
+
+The number of channels need not be a multiple of the number of bins. Each
+channel is split into `bin_number` parts and the `nfreq * bin_number` parts
+are distributed evenly to the bins, so a channel on the boundary of two bins
+contributes to both of them in proportion to the overlap, see
+:func:`rebin_weights`.
+
+A range of bins can be computed from the channels in :func:`bin_channels`
+only, so that the data can be rebinned block by block along the frequency,
+e.g. while reading, and the blocks give the same result as the full
+rebinning.
+
+"""
+
+import numpy as np
+from caput import mpiutil
+from caput import mpiarray
+
+
+def rebin_weights(nfreq, bin_number):
+    """Weights of the input channels to the output bins.
+
+    Each input channel is split into `bin_number` parts, and the
+    `nfreq * bin_number` parts are distributed evenly to the `bin_number`
+    bins. As the bins are wider than the channels, a channel contributes to
+    at most two adjacent bins.
+
+    Returns
+    -------
+    starts : 1D int array, length bin_number
+        The first channel starting in each bin.
+    first : 1D int array, length nfreq
+        The bin where each channel starts.
+    w1 : 1D int array, length nfreq
+        Number of parts of each channel in the bin `first`, the rest
+        `bin_number - w1` are in bin `first + 1`.
+    """
+
+    if bin_number >= nfreq:
+        raise ValueError('The number of bins can not exceed the number of '
+                'frequencies')
+
+    num, start, end = mpiutil.split_m(nfreq*bin_number, bin_number)
+    end = np.asarray(end)
+    chan_st = np.arange(nfreq) * bin_number
+    first = np.searchsorted(end, chan_st, side='right')
+    w1 = np.minimum(end[first], chan_st + bin_number) - chan_st
+    starts = np.searchsorted(first, np.arange(bin_number))
+    return starts, first, w1
+
+def bin_channels(weights, j0, j1):
+    """The channel range [c0, c1) contributing to the bins [j0, j1)."""
+
+    starts, first, w1 = weights
+    bin_number = starts.shape[0]
+    c0 = starts[j0]
+    if c0 > 0 and w1[c0 - 1] < bin_number:
+        # the channel on the lower boundary
+        c0 -= 1
+    c1 = starts[j1] if j1 < bin_number else first.shape[0]
+    return c0, c1
+
+def rebin_freq(freq, weights):
+    """Weighted average of the frequency in each bin."""
+
+    starts, first, w1 = weights
+    bin_number = starts.shape[0]
+    w2 = bin_number - w1
+    split = np.flatnonzero(w2)
+    freq = np.asarray(freq, dtype='float64')
+
+    freq_sum = np.add.reduceat(freq * w1, starts)
+    np.add.at(freq_sum, first[split] + 1, freq[split] * w2[split])
+    w_sum = np.add.reduceat(w1, starts)
+    np.add.at(w_sum, first[split] + 1, w2[split])
+    return freq_sum / w_sum
+
+def rebin_data(vis, vis_mask, weights, out=None, out_mask=None, bins=None):
+    """Average `vis` along the frequency axis (axis 1) excluding the masked.
+
+    Parameters
+    ----------
+    vis, vis_mask : array
+        The data and mask, frequency as axis 1.
+    weights : tuple
+        Output of :func:`rebin_weights`.
+    out, out_mask : array or None
+        The output rebinned data and mask. The average is accumulated in the
+        dtype of `out` if it is float32, otherwise in float64.
+    bins : tuple or None
+        Only compute the bins [j0, j1), `vis` and `vis_mask` then hold the
+        channels given by :func:`bin_channels`. Default all bins.
+
+    Returns
+    -------
+    out, out_mask
+    """
+
+    starts, first, w1 = weights
+    bin_number = starts.shape[0]
+    j0, j1 = (0, bin_number) if bins is None else bins
+    c0, c1 = bin_channels(weights, j0, j1)
+    if vis.shape[1] != c1 - c0:
+        raise ValueError('Need channels %d to %d for bins %d to %d, got %d'
+                %(c0, c1, j0, j1, vis.shape[1]))
+
+    # weights relative to the channel and bin range
+    starts = starts[j0:j1] - c0
+    first = first[c0:c1] - j0
+    w1 = w1[c0:c1]
+    w2 = bin_number - w1
+    split = np.flatnonzero((w2 > 0) & (first + 1 < j1 - j0))
+
+    shp = vis.shape[:1] + (j1 - j0, ) + vis.shape[2:]
+    if out is None:
+        out = np.empty(shp, dtype=vis.dtype)
+    if out_mask is None:
+        out_mask = np.empty(shp, dtype='bool')
+    if out.dtype == np.float32:
+        dtype = np.float32
+    else:
+        dtype = np.float64
+    _w = lambda w : w.astype(dtype).reshape((-1, ) + (1, ) * (vis.ndim - 2))
+
+    good = np.logical_not(vis_mask).astype(dtype)
+    data = np.asarray(vis, dtype=dtype) * good
+    vis_sum = np.add.reduceat(data * _w(w1), starts, axis=1)
+    cnt_sum = np.add.reduceat(good * _w(w1), starts, axis=1)
+    if split.size > 0:
+        # the second part of the channels on the bin boundary
+        vis_sum[:, first[split] + 1] += data[:, split] * _w(w2[split])
+        cnt_sum[:, first[split] + 1] += good[:, split] * _w(w2[split])
+    del data, good
+
+    np.equal(cnt_sum, 0, out=out_mask)
+    cnt_sum[out_mask] = np.inf
+    np.divide(vis_sum, cnt_sum, out=out, casting='unsafe')
+    return out, out_mask
+
+def set_rebinned(ts, vis, vis_mask, freq, nfreq, axis):
+    """Replace the main data, `vis_mask` and `freq` of `ts` with the rebinned
+    ones, and scale the `freqstep` attribute from the `nfreq` channels.
+
+    `vis` and `vis_mask` are the local arrays distributed along `axis`.
+    """
+
+    vis = mpiarray.MPIArray.wrap(vis, axis=axis)
+    vis_mask= mpiarray.MPIArray.wrap(vis_mask, axis=axis)
+    ts.create_main_data(vis, recreate=True, copy_attrs=True)
+    axis_order = ts.main_axes_ordered_datasets['vis']
+    ts.create_main_axis_ordered_dataset(axis_order, 'vis_mask', vis_mask, axis_order, recreate=True, copy_attrs=True)
+    ts.create_freq_ordered_dataset('freq', freq, recreate=True, copy_attrs=True, check_align=True)
+
+    # for other freq_axis datasets
+    for name in ts.freq_ordered_datasets.keys():
+        if name in ts.iterkeys() and not name in ('freq', 'vis', 'vis_mask'): # exclude already rebinned datasets
+            raise RuntimeError('Should not have other freq_ordered_datasets %s' % name)
+
+    # update freqstep attr
+    ts.attrs['freqstep'] = nfreq * ts.attrs['freqstep'] / freq.shape[0]
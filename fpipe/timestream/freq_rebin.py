@@ -13,9 +13,8 @@ import numpy as np
 from fpipe.timestream import timestream_task
 #from tlpipe.container.timestream import Timestream
 from fpipe.container.timestream import FAST_Timestream as Timestream
-from caput import mpiutil
-from caput import mpiarray
-from tlpipe.utils.np_util import unique, average
+from fpipe.timestream.freq_binning import rebin_weights, rebin_freq, rebin_data
+from fpipe.timestream.freq_binning import set_rebinned
 
 
 class Rebin(timestream_task.TimestreamTask):
@@ -24,14 +23,27 @@ class Rebin(timestream_task.TimestreamTask):
     This task rebins the data along the frequency by merging (and average)
     the adjacent frequency channels.
 
+    The number of channels need not be a multiple of `bin_number`, a
+    channel on the boundary of two bins contributes to both of them in
+    proportion to the overlap. The masked values are excluded from the
+    average, a bin is masked if all its values are masked.
+
+    If `float32`, the average is accumulated and stored in float32.
+
     """
 
     params_init = {
                     'bin_number': 16,
+                    'float32': False,
+                    'time_chunk': 1024,
                   }
 
     prefix = 'rb_'
 
+    _dist_axis_ = 'baseline'
+    # a masked average, commutes with the per beam scaling
+    _reorder_group_ = 'beam_scale'
+
     def process(self, ts):
         #print ts.vis.shape
         #print ts['ra'].shape
@@ -39,8 +51,9 @@ class Rebin(timestream_task.TimestreamTask):
         assert isinstance(ts, Timestream), '%s only works for Timestream object' % self.__class__.__name__
 
         bin_number = self.params['bin_number']
+        time_chunk = self.params['time_chunk']
 
-        ts.redistribute('baseline')
+        self.redistribute(ts, 'baseline')
 
         #nt = len(ts.time)
         nt = len(ts['sec1970'][:])
@@ -48,44 +61,26 @@ class Rebin(timestream_task.TimestreamTask):
         if bin_number >= nfreq:
             warnings.warn('The number of bins can not exceed the number of frequencies, do nothing')
         else:
-            repeat_inds = np.repeat(np.arange(nfreq), bin_number)
-            num, start, end = mpiutil.split_m(nfreq*bin_number, bin_number)
-            freq = np.zeros(bin_number, dtype=ts.freq.dtype)
-            vis = np.zeros((nt, bin_number)+ts.local_vis.shape[2:], dtype=ts.vis.dtype)
+            weights = rebin_weights(nfreq, bin_number)
+            if self.params['float32']:
+                dtype = np.float32
+            else:
+                dtype = ts.vis.dtype
+            freq = rebin_freq(ts.freq[:], weights)
+            vis = np.zeros((nt, bin_number)+ts.local_vis.shape[2:], dtype=dtype)
             vis_mask= np.zeros((nt, bin_number)+ts.local_vis.shape[2:], dtype=ts.vis_mask.dtype) # all False
 
             # average over frequency
             dfreq_raw = ts.freq[1] - ts.freq[0]
             nfreq_raw = ts.freq.shape[0]
-            for idx in xrange(bin_number):
-                inds, weight = unique(repeat_inds[start[idx]:end[idx]], return_counts=True)
-                # rebin freq
-                freq[idx] = average(ts.freq[inds], axis=0, weights=weight)
-                # rebin vis
-                masked_vis = np.ma.array(ts.local_vis[:, inds], mask=ts.local_vis_mask[:, inds])
-                vis[:, idx] = average(masked_vis, axis=1, weights=weight) # freq mean
-                # rebin vis_mask
-                valid_cnt = np.sum(np.logical_not(ts.local_vis_mask[:, inds]).astype(np.int16) * weight[:, np.newaxis, np.newaxis].astype(np.int16), axis=1) # use int16 to save memory
-                vis_mask[:, idx] = np.where(valid_cnt==0, True, False)
-                del valid_cnt
-
-            # create rebinned datasets
-            vis = mpiarray.MPIArray.wrap(vis, axis=3)
-            vis_mask= mpiarray.MPIArray.wrap(vis_mask, axis=3)
-            ts.create_main_data(vis, recreate=True, copy_attrs=True)
-            axis_order = ts.main_axes_ordered_datasets['vis']
-            ts.create_main_axis_ordered_dataset(axis_order, 'vis_mask', vis_mask, axis_order, recreate=True, copy_attrs=True)
-            ts.create_freq_ordered_dataset('freq', freq, recreate=True, copy_attrs=True, check_align=True)
+            for st in range(0, nt, time_chunk):
+                et = min(st + time_chunk, nt)
+                rebin_data(ts.local_vis[st:et], ts.local_vis_mask[st:et], 
+                        weights, out=vis[st:et], out_mask=vis_mask[st:et])
+
+            set_rebinned(ts, vis, vis_mask, freq, nfreq, axis=3)
 
             print 'freq resolution reduced from %s to %f MHz (%d - %d)'%(
                    dfreq_raw,  freq[1] - freq[0], nfreq_raw, freq.shape[0])
 
-            # for other freq_axis datasets
-            for name in ts.freq_ordered_datasets.keys():
-                if name in ts.iterkeys() and not name in ('freq', 'vis', 'vis_mask'): # exclude already rebinned datasets
-                    raise RuntimeError('Should not have other freq_ordered_datasets %s' % name)
-
-            # update freqstep attr
-            ts.attrs['freqstep'] = nfreq * ts.attrs['freqstep'] / bin_number
-
         return super(Rebin, self).process(ts)
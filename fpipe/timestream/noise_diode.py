@@ -0,0 +1,172 @@
+"""Noise diode on/off index sets and the cal-on minus cal-off differences.
+
+The noise diode is fired for `on_t` time stamps of every period. The on
+samples are grouped in runs of consecutive time stamps, each run is compared
+with the time stamp just before and just after it, so that the slow variation
+of the system temperature cancels,
+
+    diff = sum(vis[on]) - on_t * mean(vis[before], vis[after])
+
+The index sets only depend on the noise diode mask, they are computed once
+with :class:`NoiseDiode` and applied to every beam and frequency with a
+single gather.
+
+"""
+
+import numpy as np
+
+
+def cal_on_mask(n_time, period=8, length=1, delay=0):
+    """Noise diode on mask, `length` of every `period` time stamps, starting
+    from time stamp `delay`."""
+
+    phase = (np.arange(n_time) - delay) % period
+    return phase < length
+
+class NoiseDiode(object):
+    """On/off index sets of the noise diode.
+
+    Parameters
+    ----------
+    on : 1D bool array
+        Noise diode on mask of the time stamps.
+    on_t : int
+        Number of time stamps of each noise diode run. Runs of other length,
+        e.g. partly lost to RFI flagging, or too close to the ends are
+        dropped.
+    mask_gap : int or None
+        The mask of the cal-off reference is taken from the time stamps
+        `mask_gap` before and after the run. The time stamps next to a
+        single time stamp run are usually flagged together with the noise
+        diode, so the default is 2 if `on_t` is 1, otherwise 1.
+
+    Attributes
+    ----------
+    st : 1D int array
+        First time stamp of the runs.
+    before, after : 1D int array
+        The cal-off time stamps of the runs.
+    on, off : 1D bool array
+        Mask of the on and off time stamps in use.
+    """
+
+    def __init__(self, on, on_t=1, mask_gap=None):
+
+        on = np.asarray(on, dtype='bool')
+        n_time = on.shape[0]
+        if mask_gap is None:
+            mask_gap = 2 if on_t == 1 else 1
+
+        edge = np.diff(np.concatenate([[0], on.astype('int8'), [0]]))
+        st = np.flatnonzero(edge ==  1)
+        ed = np.flatnonzero(edge == -1)
+
+        good  = (ed - st) == on_t
+        good &= st - max(mask_gap, 1) >= 0
+        good &= ed - 1 + max(mask_gap, 1) < n_time
+        st = st[good]
+
+        self.on_t = on_t
+        self.n_time = n_time
+        self.st = st
+        self.before = st - 1
+        self.after  = st + on_t
+        self.mask_before = st - mask_gap
+        self.mask_after  = st + on_t - 1 + mask_gap
+
+        self.on_index = (st[:, None] + np.arange(on_t)[None, :]).ravel()
+        self.on = np.zeros(n_time, dtype='bool')
+        self.on[self.on_index] = True
+        self.off = np.zeros(n_time, dtype='bool')
+        self.off[self.before] = True
+        self.off[self.after]  = True
+
+    @classmethod
+    def from_period(cls, n_time, period=8, length=1, delay=0, mask_gap=None):
+
+        return cls(cal_on_mask(n_time, period, length, delay), length, mask_gap)
+
+    @property
+    def n_run(self):
+        return self.st.shape[0]
+
+    def diff(self, vis, vis_mask=None, per_sample=True, masked=True, out=None):
+        """Cal-on minus cal-off of each run.
+
+        Parameters
+        ----------
+        vis : array, time as the first axis
+        vis_mask : bool array of the same shape, or None
+        per_sample : bool
+            If True, the difference of each run is repeated for all of its
+            on time stamps, the rows align with `vis[self.on]`. Otherwise,
+            one row per run.
+        masked : bool
+            If True, return a masked array. Otherwise, the masked values are
+            set to NaN.
+        out : array or None
+            Buffer of shape (n_run, ) + vis.shape[1:] for the per run result.
+
+        Returns
+        -------
+        diff : masked array or array, masked if the cal-off reference is
+            masked.
+        """
+
+        on_t = self.on_t
+        if out is None:
+            out = np.empty((self.n_run, ) + vis.shape[1:], dtype=vis.dtype)
+        np.take(vis, self.st, axis=0, out=out)
+        for i in range(1, on_t):
+            out += vis[self.st + i]
+        vis_off = vis[self.before]
+        vis_off += vis[self.after]
+        vis_off *= 0.5 * on_t
+        out -= vis_off
+        del vis_off
+
+        if vis_mask is None:
+            mask = np.ma.nomask
+        else:
+            mask = vis_mask[self.mask_before]
+            mask |= vis_mask[self.mask_after]
+
+        if not masked:
+            if mask is not np.ma.nomask:
+                out[mask] = np.nan
+            if per_sample and on_t > 1:
+                out = np.repeat(out, on_t, axis=0)
+            return out
+
+        if per_sample and on_t > 1:
+            out = np.repeat(out, on_t, axis=0)
+            if mask is not np.ma.nomask:
+                mask = np.repeat(mask, on_t, axis=0)
+
+        return np.ma.array(out, mask=mask, copy=False)
+
+def cached_noise_diode(on, on_t, cache=None):
+    """The :class:`NoiseDiode` of mask `on`, kept in `cache`, a dict, as the
+    beams usually share the same mask."""
+
+    if cache is None:
+        return NoiseDiode(on, on_t)
+    key = (on_t, on.tobytes())
+    if key not in cache:
+        cache[key] = NoiseDiode(on, on_t)
+    return cache[key]
+
+def ts_noise_diode(ts, gi, on_t, cache=None):
+    """The :class:`NoiseDiode` of beam `gi` of the time stream.
+
+    The noise diode mask is read from `ts['ns_on']`, None if missing.
+    """
+
+    if 'ns_on' not in ts.iterkeys():
+        return None
+    if len(ts['ns_on'].shape) == 2:
+        on = ts['ns_on'][:, gi].astype('bool')
+    else:
+        on = ts['ns_on'][:].astype('bool')
+
+    return cached_noise_diode(on, on_t, cache)
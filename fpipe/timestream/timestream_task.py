@@ -10,13 +10,20 @@ Inheritance diagram
 import logging
 import sys, traceback
 from os import path
+import numpy as np
 import h5py
 
 #from tlpipe.timestream import timestream_task
 from tlpipe.utils.path_util import input_path, output_path
 from fpipe.pipeline.pipeline import OneAndOne
 
-from fpipe.container.timestream import FAST_Timestream
+from fpipe.container.timestream import FAST_Timestream, LazyTimestream
+from fpipe.container.timestream import file_freq
+from fpipe.timestream import tl_layout
+from fpipe.timestream import freq_binning
+from fpipe.pipeline import dist_plan
+from fpipe.pipeline import handoff
+from fpipe.pipeline.profile import ProfiledTask
 from caput import mpiutil
 
 
@@ -24,15 +31,22 @@ from caput import mpiutil
 logger = logging.getLogger(__name__)
 
 
-class TimestreamTask(OneAndOne):
+class TimestreamTask(ProfiledTask, OneAndOne):
 
     _Tod_class = FAST_Timestream
 
+    # the distributed axis the task works on, None if any
+    _dist_axis_ = None
+    # adjacent tasks of the same group commute, see dist_plan.order_tasks
+    _reorder_group_ = None
+
     params_init = {
                     'mode': 'r',
                     'start': 0,
                     'stop': None,
                     'dist_axis': 0,
+                    'plan_dist_axis': True, # read along the axis of the task
+                                            # if dist_axis is left at 0
                     'exclude': [],
                     'check_status': True,
                     'write_hints': True,
@@ -40,12 +54,20 @@ class TimestreamTask(OneAndOne):
                     'chunk_vis': False, # chunk vis and vis_mask in saved files
                     'chunk_shape': None,
                     'chunk_size': 64, # KB
+                    'vis_compression': None, # 'bitshuffle', 'lzf' or 'gzip'
+                    'mask_compression': None, # 'gzip' or 'lzf'
                     'output_failed_continue': False, # continue to run if output to files failed
+                    'handoff': False, # keep the output in memory for the next run
+                    'checkpoint': False, # also write the output files in handoff mode
                     'time_select': (0, None),
                     'freq_select': (0, None),
                     'pol_select': (0, None), # only useful for ts
                     'feed_select': (0, None),
                     'corr': 'all',
+                    'rebin_factor': None, # rebin frequency on read, channels per bin
+                    'rebin_width': None, # or the target channel width in MHz
+                    'rebin_block': 64, # number of bins read at once
+                    'lazy_read': False, # only read the datasets of lazy_datasets
                     'show_progress': False,
                     'progress_step': None,
                     'show_info': False,
@@ -77,17 +99,14 @@ class TimestreamTask(OneAndOne):
                     input_files = input_path(self.input_files, iteration=self.iteration)
                 else:
                     input_files = self.input_files
-                # ensure all input_files are exist
+                # ensure all input_files are exist, or handed off in memory
                 for infile in input_files:
-                    if not path.exists(infile):
+                    if not path.exists(infile) and not handoff.has(input_files):
                         if mpiutil.rank0:
                             msg = 'Missing input file %s, will stop then...' % infile
                             logger.info(msg)
                         self.stop_iteration(True)
                         return None
-                # see 'vis' dataset from the first input file
-                with h5py.File(input_files[0], 'r') as f:
-                    vis_shp = f['vis'].shape
                 self._Tod_class = FAST_Timestream
             # from arg
             else:
@@ -105,13 +124,40 @@ class TimestreamTask(OneAndOne):
         mode = self.params['mode']
         start = self.params['start']
         stop = self.params['stop']
-        dist_axis = self.params['dist_axis']
+        dist_axis = self.read_dist_axis()
         tag_input_iter = self.params['tag_input_iter']
 
         if self.iterable and tag_input_iter:
             input_files = input_path(self.input_files, iteration=self.iteration)
         else:
             input_files = self.input_files
+
+        if handoff.has(input_files):
+            # output of the previous run kept in memory, the data is the
+            # same as read from the files, lazy_read is not needed.
+            tod = handoff.get(input_files)
+            if mpiutil.rank0:
+                logger.info('take %s from memory'%input_files)
+            time_select = self.handoff_time_select(tod, start, stop)
+            tod, full_data = self.subset_select(tod, time_select=time_select)
+            if not full_data:
+                tod = tod.subset(return_copy=False)
+            self.rebin_loaded(tod)
+            return tod
+
+        if self.params['lazy_read']:
+            datasets = self.lazy_datasets()
+            if datasets is not None:
+                return LazyTimestream(input_files, start, stop, dist_axis,
+                        self.lazy_selection(), datasets, comm=mpiutil.world)
+            if mpiutil.rank0:
+                logger.warning('%s needs the full data, lazy_read ignored'
+                        %self.__class__.__name__)
+
+        rebin = self.read_rebin_weights(input_files)
+        if rebin is not None:
+            return self.read_input_rebin(input_files, *rebin)
+
         tod = self._Tod_class(input_files, mode, start, stop, dist_axis,
                 use_hints=False)
 
@@ -121,6 +167,196 @@ class TimestreamTask(OneAndOne):
 
         return tod
 
+    def read_dist_axis(self):
+        """The distributed axis to read along. If `plan_dist_axis` and
+        `dist_axis` is left at its default, the axis of the task, so that the
+        task needs no redistribution."""
+
+        dist_axis = self.params['dist_axis']
+        if not self.params['plan_dist_axis'] or self._dist_axis_ is None \
+                or dist_axis != TimestreamTask.params_init['dist_axis']:
+            return dist_axis
+
+        planned = self._Tod_class._main_data_axes_.index(self._dist_axis_)
+        if planned != dist_axis and mpiutil.rank0:
+            logger.info('%s: read along %s instead of dist_axis %s'%(
+                self.__class__.__name__, self._dist_axis_, dist_axis))
+        return planned
+
+    def redistribute(self, ts, dist_axis):
+        """Redistribute `ts` along `dist_axis`, skipped if it already is,
+        the bytes moved are recorded by :mod:`fpipe.pipeline.dist_plan`."""
+
+        if isinstance(ts, LazyTimestream):
+            # nothing to move, the datasets are read again
+            ts.redistribute(dist_axis)
+            return
+        dist_plan.redistribute(ts, dist_axis, stage=self.__class__.__name__)
+
+    def lazy_datasets(self):
+        """Datasets needed by the task in lazy read mode, as a dict
+        {name : {axis name : (start, stop[, step])} or None} of the hyperslabs
+        relative to the data selection. None if the task needs the full
+        data, which is the default."""
+
+        return None
+
+    def lazy_selection(self):
+        """The data selection of the main axes for lazy read. The feeds are
+        selected as baselines, i.e. auto-correlation only."""
+
+        return {
+                'time'         : self.params['time_select'],
+                'frequency'    : self.params['freq_select'],
+                'polarization' : self.params['pol_select'],
+                'baseline'     : self.params['feed_select'],
+                }
+
+    def read_rebin_weights(self, input_files):
+        """Index of the first selected channel, the selected frequencies and
+        their rebin weights, None if no rebin on read is required."""
+
+        rebin_factor = self.params['rebin_factor']
+        rebin_width = self.params['rebin_width']
+        if rebin_factor is None and rebin_width is None:
+            return None
+
+        with h5py.File(input_files[0], 'r') as f:
+            freq = file_freq(f)
+            freqstep = f.attrs['freqstep'] if 'freqstep' in f.attrs \
+                    else freq[1] - freq[0]
+        freq_select = self.params['freq_select']
+        fst, fet, fstep = slice(*freq_select).indices(freq.shape[0])
+        if fstep != 1:
+            raise ValueError('Rebin on read needs continuous freq_select')
+        nfreq = fet - fst
+
+        bin_number = self.rebin_bin_number(nfreq, freqstep)
+        if bin_number is None:
+            return None
+
+        weights = freq_binning.rebin_weights(nfreq, bin_number)
+        return fst, freq[fst:fet], weights
+
+    def rebin_bin_number(self, nfreq, freqstep):
+        """Number of bins of `rebin_factor` or `rebin_width`, None if no
+        rebin is required."""
+
+        rebin_factor = self.params['rebin_factor']
+        rebin_width = self.params['rebin_width']
+        if rebin_factor is None and rebin_width is None:
+            return None
+
+        if rebin_factor is not None:
+            bin_number = int(round(float(nfreq) / rebin_factor))
+        else:
+            bin_number = int(round(nfreq * abs(freqstep) / rebin_width))
+        bin_number = max(bin_number, 1)
+        if bin_number >= nfreq:
+            if mpiutil.rank0:
+                logger.warning('The number of bins can not exceed the number '
+                        'of frequencies, no rebin on read')
+            return None
+        return bin_number
+
+    def rebin_loaded(self, tod):
+        """Rebin the frequency of a time stream already in memory, e.g.
+        handed off, the same as rebin on read."""
+
+        freq = tod.freq[:]
+        nfreq = freq.shape[0]
+        freqstep = tod.attrs['freqstep'] if 'freqstep' in tod.attrs \
+                else freq[1] - freq[0]
+        bin_number = self.rebin_bin_number(nfreq, freqstep)
+        if bin_number is None:
+            return
+
+        weights = freq_binning.rebin_weights(nfreq, bin_number)
+        self.redistribute(tod, 'baseline')
+        shp = tod.local_vis.shape[:1] + (bin_number, ) + tod.local_vis.shape[2:]
+        vis = np.zeros(shp, dtype=tod.vis.dtype)
+        vis_mask = np.zeros(shp, dtype=tod.vis_mask.dtype)
+        freq_binning.rebin_data(tod.local_vis, tod.local_vis_mask, weights,
+                out=vis, out_mask=vis_mask)
+        freq_binning.set_rebinned(tod, vis, vis_mask,
+                freq_binning.rebin_freq(freq, weights), nfreq, axis=3)
+        self.redistribute(tod, self.read_dist_axis())
+
+        if mpiutil.rank0:
+            logger.info('rebin %d channels to %d in memory'%(nfreq, bin_number))
+
+    def handoff_time_select(self, tod, start, stop):
+        """The `time_select` of the handed-off `tod` including the `start`,
+        `stop` time range, as if read from the files."""
+
+        time_select = self.params['time_select']
+        if start in (0, None) and stop is None:
+            return time_select
+
+        n_time = tod['sec1970'].shape[0]
+        index = np.arange(n_time)[start:stop][slice(*time_select)]
+        if index.shape[0] == 0:
+            raise ValueError('Empty time range start %s stop %s time_select %s'
+                    %(start, stop, time_select))
+        step = int(index[1] - index[0]) if index.shape[0] > 1 else 1
+        return (int(index[0]), int(index[-1]) + 1, step)
+
+    def read_input_rebin(self, input_files, fst, freq, weights):
+        """Read the data and rebin the frequency block by block.
+
+        The time stream is opened once with the first selected channel only,
+        for all the other datasets. Each block of `rebin_block` bins then
+        reads the channels it needs of `vis` and `vis_mask`, so the full
+        resolution data is never held in memory. The result is the same as
+        the task `Rebin` applied to the full data.
+        """
+
+        mode = self.params['mode']
+        start = self.params['start']
+        stop = self.params['stop']
+        dist_axis = self.read_dist_axis()
+        rebin_block = self.params['rebin_block']
+        if dist_axis in (1, 'frequency'):
+            # keep the frequency local while rebinning
+            dist_axis = 0
+
+        nfreq = freq.shape[0]
+        bin_number = weights[0].shape[0]
+
+        tod = self._Tod_class(input_files, mode, start, stop, dist_axis,
+                use_hints=False)
+        tod, full_data = self.data_select(tod, freq_select=(fst, fst + 1))
+        tod.load_all()
+
+        selection = self.lazy_selection()
+        selection['frequency'] = (fst, fst + nfreq)
+        names = [tod.main_data_name, tod.main_data_name + '_mask']
+        main = LazyTimestream(input_files, start, stop, dist_axis, selection,
+                dict([(name, None) for name in names]), comm=mpiutil.world)
+
+        shp = tod.local_vis.shape[:1] + (bin_number, ) + tod.local_vis.shape[2:]
+        vis = np.zeros(shp, dtype=tod.vis.dtype)
+        vis_mask = np.zeros(shp, dtype=tod.vis_mask.dtype)
+        for j0 in range(0, bin_number, rebin_block):
+            j1 = min(j0 + rebin_block, bin_number)
+            c0, c1 = freq_binning.bin_channels(weights, j0, j1)
+            _vis, _vis_mask = [main.read_hyperslab(name, {'frequency': (c0, c1)})
+                    for name in names]
+            freq_binning.rebin_data(_vis, _vis_mask, weights,
+                    out=vis[:, j0:j1], out_mask=vis_mask[:, j0:j1],
+                    bins=(j0, j1))
+            del _vis, _vis_mask
+
+        freq = freq_binning.rebin_freq(freq, weights)
+        freq_binning.set_rebinned(tod, vis, vis_mask, freq, nfreq,
+                axis=tod.main_data_dist_axis)
+        self.redistribute(tod, self.read_dist_axis())
+
+        if mpiutil.rank0:
+            logger.info('rebin %d channels to %d on read'%(nfreq, bin_number))
+
+        return tod
+
     def full_data_select(self):
         """Check to see whether select all data or not."""
         # may need better check here in future...
@@ -136,16 +372,18 @@ class TimestreamTask(OneAndOne):
 
         return full_data
 
-    def data_select(self, tod):
-        """Data select."""
+    def data_select(self, tod, freq_select=None):
+        """Data select, `freq_select` overrides the parameter if given."""
         # may need better check here in future...
         full_data = True
+        if freq_select is None:
+            freq_select = self.params['freq_select']
         if self.params['time_select'] != (0, None):
             full_data = False
             tod.time_select(self.params['time_select'])
-        if self.params['freq_select'] != (0, None):
+        if freq_select != (0, None):
             full_data = False
-            tod.frequency_select(self.params['freq_select'])
+            tod.frequency_select(freq_select)
         if self._Tod_class == FAST_Timestream and self.params['pol_select'] != (0, None):
             full_data = False
             tod.polarization_select(self.params['pol_select'])
@@ -155,13 +393,15 @@ class TimestreamTask(OneAndOne):
 
         return tod, full_data
 
-    def subset_select(self, tod):
-        """Data subset select."""
+    def subset_select(self, tod, time_select=None):
+        """Data subset select, `time_select` overrides the parameter if given."""
         # may need better check here in future...
         full_data = True
-        if self.params['time_select'] != (0, None):
+        if time_select is None:
+            time_select = self.params['time_select']
+        if time_select != (0, None):
             full_data = False
-            tod.subset_time_select(self.params['time_select'])
+            tod.subset_time_select(time_select)
         if self.params['freq_select'] != (0, None):
             full_data = False
             tod.subset_frequency_select(self.params['freq_select'])
@@ -197,6 +437,8 @@ class TimestreamTask(OneAndOne):
         chunk_vis = self.params['chunk_vis']
         chunk_shape = self.params['chunk_shape']
         chunk_size = self.params['chunk_size']
+        vis_compression = self.params['vis_compression']
+        mask_compression = self.params['mask_compression']
         output_failed_continue = self.params['output_failed_continue']
         tag_output_iter = self.params['tag_output_iter']
 
@@ -205,8 +447,36 @@ class TimestreamTask(OneAndOne):
         else:
             output_files = self.output_files
 
+        if self.params['handoff']:
+            handoff.put(output_files, output)
+            if not self.params['checkpoint']:
+                return
+
+        if chunk_vis and (chunk_shape is None or len(chunk_shape) < 4):
+            # align the chunks to (time block, freq block, pol, 1 baseline)
+            chunk_shape = tl_layout.get_chunk_shape(output.main_data.shape,
+                    output.main_data.dtype, chunk_shape, chunk_size)
+
+        layout = {
+                'vis'      : dict(chunk_vis=chunk_vis, chunk_shape=chunk_shape,
+                                  chunk_size=chunk_size, compression=vis_compression),
+                'vis_mask' : dict(chunk_vis=chunk_vis, chunk_shape=chunk_shape,
+                                  chunk_size=chunk_size, compression=mask_compression),
+                }
+        compress = [name for name in layout.keys()
+                if layout[name]['compression'] is not None
+                and name in output and name not in exclude]
+
         try:
-            output.to_files(output_files, exclude, check_status, write_hints, libver, chunk_vis, chunk_shape, chunk_size)
+            # the containers write without compression, the compressed main
+            # data are written here with the filters set at creation.
+            output.to_files(output_files, list(exclude) + compress,
+                    check_status, write_hints, libver, chunk_vis, chunk_shape,
+                    chunk_size)
+            mpiutil.barrier()
+            self.write_compressed(output, output_files, compress, layout)
+            self.record_layout(output_files,
+                    [name for name in layout.keys() if name not in compress])
         except Exception as e:
             if output_failed_continue:
                 msg = 'Process %d writing output to files failed...' % mpiutil.rank
@@ -214,3 +484,68 @@ class TimestreamTask(OneAndOne):
                 traceback.print_exc(file=sys.stdout)
             else:
                 raise e
+
+    def write_compressed(self, output, output_files, names, layout):
+        """Write the main data `names` to the output files already written by
+        `to_files`, creating the data sets with the compression of `layout`.
+
+        Each file holds the time range of its `sec1970`. Compressed data sets
+        can not be written in parallel, the ranks write their local data in
+        turn.
+        """
+
+        if len(names) == 0:
+            return
+
+        n_time = []
+        for fname in output_files:
+            with h5py.File(fname, 'r') as f:
+                n_time.append(f['sec1970'].shape[0])
+        t_st = np.cumsum([0, ] + n_time)
+
+        if mpiutil.rank0:
+            for fi, fname in enumerate(output_files):
+                with h5py.File(fname, 'r+') as f:
+                    for name in names:
+                        shp = (n_time[fi], ) + tuple(output[name].shape[1:])
+                        dset = tl_layout.create_dataset(f, name, shp,
+                                output[name].dtype, **layout[name])
+                        for key, value in output[name].attrs.items():
+                            if not key.startswith('layout_'):
+                                dset.attrs[key] = value
+        mpiutil.barrier()
+
+        dist_axis = output.main_data_dist_axis
+        for rank in range(mpiutil.size):
+            if rank == mpiutil.rank:
+                for name in names:
+                    local = output[name].local_data
+                    sel = [slice(None), ] * local.ndim
+                    if dist_axis == 0:
+                        l_st = output[name].local_offset[0]
+                    else:
+                        l_st = 0
+                        sel[dist_axis] = slice(output[name].local_offset[dist_axis],
+                                output[name].local_offset[dist_axis]
+                                + local.shape[dist_axis])
+                    l_et = l_st + local.shape[0]
+                    for fi, fname in enumerate(output_files):
+                        st = max(l_st, t_st[fi])
+                        et = min(l_et, t_st[fi + 1])
+                        if st >= et:
+                            continue
+                        sel[0] = slice(st - t_st[fi], et - t_st[fi])
+                        with h5py.File(fname, 'r+') as f:
+                            f[name][tuple(sel)] = local[st - l_st:et - l_st]
+            mpiutil.barrier()
+
+    def record_layout(self, output_files, names):
+        """Record the layout of the uncompressed main data `names` written by
+        `to_files`."""
+
+        for ii in mpiutil.mpirange(len(output_files)):
+            with h5py.File(output_files[ii], 'r+') as f:
+                for name in names:
+                    if name in f:
+                        tl_layout.record_layout(f[name])
+        mpiutil.barrier()
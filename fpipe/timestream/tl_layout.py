@@ -0,0 +1,192 @@
+"""On-disk layout of the time ordered data.
+
+The main data `vis` and `vis_mask` of shape (time, frequency, polarization,
+baseline) are stored in chunks of (time block, frequency block, all
+polarizations, 1 baseline), so that reading a frequency range or a few
+baselines only touches the chunks needed. Optional compression filters are
+applied, `bitshuffle` (with LZ4, needs the `bitshuffle` package, falls back to
+`lzf` with byte shuffle) or `lzf` for `vis`, and the lossless `gzip` for
+`vis_mask`.
+
+The layout is recorded in the dataset attributes `layout_chunks` and
+`layout_compression`, see :func:`read_layout`.
+
+"""
+
+import os
+import time
+import logging
+
+import numpy as np
+from numpy.lib.utils import safe_eval
+import h5py
+
+try:
+    import bitshuffle.h5 as bshuf_h5
+except ImportError:
+    bshuf_h5 = None
+
+logger = logging.getLogger(__name__)
+
+
+def get_chunk_shape(data_shp, dtype, chunk_shape=None, chunk_size=1024):
+    """Chunk shape aligned to (time block, freq block, all pol, 1 baseline).
+
+    Parameters
+    ----------
+    data_shp : tuple
+        Shape of the (time, frequency, polarization, baseline) data.
+    dtype : numpy dtype
+    chunk_shape : tuple or None
+        (time block, freq block) or the full chunk shape, None entries are
+        set automatically.
+    chunk_size : int
+        Target chunk size in KB, used for the automatic blocks.
+    """
+
+    n_time, n_freq, n_pol, n_bl = data_shp
+    itemsize = np.dtype(dtype).itemsize
+    if chunk_shape is None:
+        chunk_shape = (None, None)
+    chunk_shape = tuple(chunk_shape) + (n_pol, 1)[len(chunk_shape) - 2:]
+    t_blk, f_blk, p_blk, b_blk = chunk_shape
+
+    if f_blk is None:
+        f_blk = min(n_freq, 256)
+    if t_blk is None:
+        t_blk = chunk_size * 1024 // (f_blk * p_blk * b_blk * itemsize)
+        t_blk = max(t_blk, 1)
+
+    return (min(t_blk, n_time), min(f_blk, n_freq),
+            min(p_blk, n_pol), min(b_blk, n_bl))
+
+def filter_kwargs(compression=None):
+    """Keyword arguments of `create_dataset` for the compression filter."""
+
+    if compression is None:
+        return {}
+    elif compression == 'bitshuffle':
+        if bshuf_h5 is None:
+            logger.warning('bitshuffle is not available, use lzf instead')
+            return filter_kwargs('lzf')
+        return {'compression' : bshuf_h5.H5FILTER,
+                'compression_opts' : (0, bshuf_h5.H5_COMPRESS_LZ4)}
+    elif compression == 'lzf':
+        return {'compression' : 'lzf', 'shuffle' : True}
+    elif compression == 'gzip':
+        return {'compression' : 'gzip', 'compression_opts' : 4, 'shuffle' : True}
+    else:
+        raise ValueError('Unknown compression filter %s'%compression)
+
+def create_dataset(df, name, data_shp, dtype, chunk_vis=True, chunk_shape=None,
+        chunk_size=1024, compression=None, data=None):
+    """Create the main data set with the required layout.
+
+    The data set is contiguous if `chunk_vis` is False and no compression is
+    required.
+    """
+
+    if compression == 'bitshuffle' and bshuf_h5 is None:
+        logger.warning('bitshuffle is not available, use lzf instead')
+        compression = 'lzf'
+    kwargs = filter_kwargs(compression)
+    if chunk_vis or compression is not None:
+        kwargs['chunks'] = get_chunk_shape(data_shp, dtype, chunk_shape,
+                chunk_size)
+    dset = df.create_dataset(name, shape=data_shp, dtype=dtype, data=data,
+            **kwargs)
+    record_layout(dset, compression)
+    return dset
+
+def record_layout(dset, compression=None):
+
+    dset.attrs['layout_chunks'] = repr(dset.chunks)
+    dset.attrs['layout_compression'] = repr(compression)
+
+def read_layout(dset):
+    """Return (chunks, compression) of a data set, chunks is None if contiguous."""
+
+    if 'layout_chunks' in dset.attrs:
+        chunks = safe_eval(dset.attrs['layout_chunks'])
+        compression = safe_eval(dset.attrs['layout_compression'])
+    else:
+        chunks = dset.chunks
+        compression = dset.compression
+    return chunks, compression
+
+def repack(fname, layout, block_len=None):
+    """Rewrite the data sets of the file with a new layout.
+
+    An offline tool for existing files, the pipeline output is written with
+    its layout directly.
+
+    Parameters
+    ----------
+    fname : str
+        The hdf5 file, replaced by the repacked one.
+    layout : dict
+        {dset name : dict of :func:`create_dataset` kwargs}
+    block_len : int or None
+        Number of time samples copied at once, default to the time block of
+        the chunk.
+    """
+
+    tmp_name = fname + '.repack'
+    with h5py.File(fname, 'r') as fi, h5py.File(tmp_name, 'w') as fo:
+        for key, value in fi.attrs.items():
+            fo.attrs[key] = value
+        for name in fi.keys():
+            if name not in layout:
+                fi.copy(name, fo)
+                continue
+            di = fi[name]
+            do = create_dataset(fo, name, di.shape, di.dtype, **layout[name])
+            for key, value in di.attrs.items():
+                if not key.startswith('layout_'):
+                    do.attrs[key] = value
+            _block_len = block_len
+            if _block_len is None:
+                _block_len = do.chunks[0] if do.chunks is not None else di.shape[0]
+            for st in range(0, di.shape[0], _block_len):
+                et = min(st + _block_len, di.shape[0])
+                do[st:et] = di[st:et]
+    os.rename(tmp_name, fname)
+
+def benchmark_read(fname, name='vis', n_repeat=3):
+    """Report the read throughput of typical selections.
+
+    The selections are the full data, the first 1/8 of time, the first 1/8 of
+    frequency, one polarization and one baseline. Note that the file may be
+    in the OS page cache after the first read.
+    """
+
+    with h5py.File(fname, 'r') as df:
+        dset = df[name]
+        n_time, n_freq, n_pol, n_bl = dset.shape
+        selections = [
+                ('full',         np.s_[...]),
+                ('time block',   np.s_[:max(n_time//8, 1)]),
+                ('freq range',   np.s_[:, :max(n_freq//8, 1)]),
+                ('one pol',      np.s_[:, :, 0]),
+                ('one baseline', np.s_[..., 0]),
+                ]
+        chunks, compression = read_layout(dset)
+        print 'Benchmark %s[%s] chunks %s compression %s'%(
+                fname, name, chunks, compression)
+        result = {}
+        for sel_name, sel in selections:
+            t0 = time.time()
+            for ii in range(n_repeat):
+                data = dset[sel]
+            dt = (time.time() - t0) / n_repeat
+            size = data.nbytes / 1024.**2
+            result[sel_name] = (size, dt)
+            print '%-14s %10.2f MB %8.3f s %10.2f MB/s'%(
+                    sel_name, size, dt, size / max(dt, 1.e-9))
+            del data
+    return result
+
+if __name__ == '__main__':
+    import sys
+    for fname in sys.argv[1:]:
+        benchmark_read(fname)
@@ -1,4 +1,7 @@
 import os
+import logging
+import hashlib
+import calendar
 import astropy.units as u
 from astropy.coordinates import AltAz, SkyCoord
 from astropy.coordinates import EarthLocation
@@ -6,6 +9,7 @@ from astropy.coordinates.angles import Angle
 
 from astropy.time import Time
 import numpy as np
+from scipy import interpolate
 
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
@@ -17,13 +21,23 @@ _Lat = (25. + 39./60. + 10.6/3600.) * u.deg
 _Location = EarthLocation.from_geodetic(_Lon, _Lat)
 _dir_ = os.path.dirname(__file__)
 
+# error bound in arcsec of altaz2radec_fast with the default time step,
+# tested in tests/test_coord.py
+_FAST_ACCURACY = 0.01
+
+logger = logging.getLogger(__name__)
+
 def get_pointing_any_scan(time, alt0, az0, time_format='unix', feed_rotation=0,
-        beam_pos_file = _dir_ + '/../data/beam_pos.dat'):
+        beam_pos_file = _dir_ + '/../data/beam_pos.dat', accuracy=None):
     
     '''
     estimate the pointing RA Dec accoriding obs time and pointing alt az 
     
     time: obs time
+    accuracy: if None, every (time, beam) pair is transformed to ICRS with
+              astropy. Otherwise, only the pointing center is transformed on
+              a coarse time grid, see altaz2radec_fast, and accuracy is the
+              required precision in arcsec.
     '''
 
     #if alt0 > 90.: alt0=90.
@@ -101,15 +115,193 @@ def get_pointing_any_scan(time, alt0, az0, time_format='unix', feed_rotation=0,
     #    print '%3d'%i, '%3dd%3dm%6.2fs'%alt[i].dms,  '%6dd%3dm%6.2fs'%az[i].dms
     
     
-    _t, _alt, _az = np.broadcast_arrays(time[:, None], alt.deg, az.deg)
+    if accuracy is None:
+        ra, dec = altaz2radec(time, alt.deg, az.deg, time_format)
+    else:
+        ra, dec = altaz2radec_fast(time, alt.deg, az.deg, time_format, accuracy)
+
+    return az.deg, alt.deg, ra, dec
+
+def get_pointing_cached(coord_file, time, time_format='unix', feed_rotation=0,
+        beam_pos_file = _dir_ + '/../data/beam_pos.dat', accuracy=None,
+        cache_dir=None):
+    '''
+    get the pointing az alt ra dec of all beams from the feed cabin coordinate
+    file, see get_pointing_any_scan.
+
+    If cache_dir is not None, the results are saved to a npz file in
+    cache_dir, keyed by the hash of the coordinate file, the time samples,
+    feed_rotation, the beam position file and accuracy. Later calls with the
+    same key load the pointing without reading the coordinate file.
+    '''
+
+    if cache_dir is not None:
+        key = hashlib.sha1()
+        key.update(_file_hash(coord_file))
+        key.update(np.ascontiguousarray(time, dtype='float64').tobytes())
+        key.update(time_format)
+        key.update(repr(float(feed_rotation)))
+        key.update(_file_hash(beam_pos_file))
+        key.update(repr(accuracy))
+        cache_file = os.path.join(cache_dir, 'pointing_%s.npz'%key.hexdigest())
+        if os.path.exists(cache_file):
+            logger.info('load pointing from %s'%cache_file)
+            with np.load(cache_file) as f:
+                return f['az'], f['alt'], f['ra'], f['dec']
+
+    az_f, alt_f = azalt_interp(coord_file)
+    unix = Time(time, format=time_format).unix
+    alt0 = alt_f(unix)
+    az0  = az_f(unix)
+    az, alt, ra, dec = get_pointing_any_scan(time, alt0, az0, 
+            time_format=time_format, feed_rotation=feed_rotation,
+            beam_pos_file=beam_pos_file, accuracy=accuracy)
+
+    if cache_dir is not None:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        # write to a temporary file first, in case of the concurrent runs
+        tmp_file = cache_file + '.%d.tmp'%os.getpid()
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, az=az, alt=alt, ra=ra, dec=dec, time=time,
+                     feed_rotation=feed_rotation)
+        os.rename(tmp_file, cache_file)
+        logger.info('save pointing to %s'%cache_file)
+
+    return az, alt, ra, dec
+
+def _file_hash(file_name, block_size=2**20):
+
+    h = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def altaz2radec(time, alt, az, time_format='unix'):
+    '''
+    convert alt az [time, beam] to ICRS RA Dec with astropy
+    '''
+
+    _t, _alt, _az = np.broadcast_arrays(time[:, None], alt, az)
     _t = Time(_t, format=time_format, location=_Location)
     _alt = Angle(_alt, u.deg)
     _az  = Angle(_az,  u.deg)
     c0   = SkyCoord(alt=_alt, az=_az, frame='altaz', location=_Location, obstime=_t)
     c0   = c0.transform_to('icrs')
-    
 
-    return az.deg, alt.deg, c0.ra.deg, c0.dec.deg
+    return c0.ra.deg, c0.dec.deg
+
+def altaz2radec_fast(time, alt, az, time_format='unix', accuracy=1., 
+        time_step=60., offset=1., check=None):
+    '''
+    convert alt az [time, beam] to ICRS RA Dec, with the 0th beam as the
+    pointing center.
+
+    Only the pointing center and two points `offset` deg away from it are
+    transformed with astropy, on a coarse time grid of `time_step` seconds.
+    They give the local transformation matrix from the AltAz to the ICRS unit
+    vectors, which is interpolated in time and applied to all beams. The
+    error is below _FAST_ACCURACY arcsec with the default time step,
+    including near the zenith.
+
+    If `check` is True, the beams at the middle of the grid points are also
+    transformed with astropy, and the time grid is refined until the error
+    is less than `accuracy` arcsec. If None, only checked if `accuracy` is
+    below _FAST_ACCURACY.
+    '''
+
+    if check is None:
+        check = accuracy < _FAST_ACCURACY
+
+    n_time = time.shape[0]
+    alt, az = np.broadcast_arrays(alt, az)
+    alt = np.broadcast_to(alt, (n_time, alt.shape[-1]))
+    az  = np.broadcast_to(az,  (n_time, az.shape[-1]))
+    vec = _sph2vec(az, alt)
+
+    if time_format == 'unix':
+        step = time_step
+    else:
+        step = time_step / 86400.
+    step = max(int(step / np.median(np.diff(time))), 1) if n_time > 1 else 1
+    while True:
+        idx = np.unique(np.append(np.arange(0, n_time, step), n_time - 1))
+        if idx.shape[0] < 4 or idx.shape[0] * 4 > n_time:
+            # too short to interpolate
+            return altaz2radec(time, alt, az, time_format)
+
+        T = _altaz2icrs_matrix(time[idx], vec[idx, 0], time_format, offset)
+        T_f = interpolate.interp1d(time[idx], T, axis=0, kind='cubic')
+        if not check:
+            break
+
+        mid = (idx[:-1] + idx[1:]) // 2
+        ra, dec = altaz2radec(time[mid], alt[mid], az[mid], time_format)
+        err = _vec2sep(_apply_matrix(T_f(time[mid]), vec[mid]), _sph2vec(ra, dec))
+        err = err.max() * 180. / np.pi * 3600.
+        logger.debug('pointing error %f arcsec with time step %d'%(err, step))
+        if err <= accuracy or step == 1:
+            break
+        step = step // 2
+
+    vec = _apply_matrix(T_f(time), vec)
+    ra  = np.arctan2(vec[..., 1], vec[..., 0]) * 180. / np.pi
+    ra[ra < 0] += 360.
+    dec = np.arcsin(np.clip(vec[..., 2], -1, 1)) * 180. / np.pi
+
+    return ra, dec
+
+def _altaz2icrs_matrix(time, vec, time_format, offset=1.):
+
+    n_time = time.shape[0]
+
+    # local tangent frame at the pointing center, e1 towards zenith
+    zenith = np.array([0., 0., 1.])
+    e1 = zenith[None, :] - vec[:, 2:] * vec
+    norm = np.sqrt(np.sum(e1 ** 2, axis=1))
+    at_zenith = norm < 1.e-8
+    e1[at_zenith] = [1., 0., 0.]
+    norm[at_zenith] = 1.
+    e1 /= norm[:, None]
+    e2 = np.cross(vec, e1)
+
+    d = offset * np.pi / 180.
+    p = np.concatenate([vec[:, None, :],
+                        (np.cos(d) * vec + np.sin(d) * e1)[:, None, :],
+                        (np.cos(d) * vec + np.sin(d) * e2)[:, None, :]], axis=1)
+    az  = np.arctan2(p[..., 1], p[..., 0]) * 180. / np.pi
+    alt = np.arcsin(np.clip(p[..., 2], -1, 1)) * 180. / np.pi
+    ra, dec = altaz2radec(time, alt, az, time_format)
+    P = _sph2vec(ra, dec)
+
+    # M maps the coordinates in local frame to the ICRS unit vector
+    M = np.empty((n_time, 3, 3))
+    M[:, :, 0] = P[:, 0]
+    M[:, :, 1] = (P[:, 1] - np.cos(d) * P[:, 0]) / np.sin(d)
+    M[:, :, 2] = (P[:, 2] - np.cos(d) * P[:, 0]) / np.sin(d)
+    A = np.concatenate([vec[:, :, None], e1[:, :, None], e2[:, :, None]], axis=2)
+
+    return np.einsum('tij,tkj->tik', M, A)
+
+def _apply_matrix(T, vec):
+
+    vec = np.einsum('tij,tbj->tbi', T, vec)
+    vec /= np.sqrt(np.sum(vec ** 2, axis=-1))[..., None]
+    return vec
+
+def _sph2vec(lon, lat):
+
+    lon = np.asarray(lon) * np.pi / 180.
+    lat = np.asarray(lat) * np.pi / 180.
+    return np.concatenate([(np.cos(lat) * np.cos(lon))[..., None],
+                           (np.cos(lat) * np.sin(lon))[..., None],
+                           np.sin(lat)[..., None]], axis=-1)
+
+def _vec2sep(vec1, vec2):
+
+    d = np.sqrt(np.sum((vec1 - vec2) ** 2, axis=-1))
+    return 2. * np.arcsin(np.clip(d / 2., 0, 1))
 
 def project_to_antenna_coord(alt, az, alt0=None, az0=None):
     
@@ -159,38 +351,17 @@ def beam_axes():
     return fig2, ax2
 
 
-def xyz2azalt(coord_file, min_row=2, max_row=None):
+def xyz2azalt(coord_file, min_row=2, max_row=None, cache_dir=''):
     '''
 
     convert the antenna xyz to az alt
 
+    cache_dir: see load_coord.
+
     '''
     
-    wb = load_workbook(coord_file)
-    datasheet = wb[u'\u6d4b\u91cf\u6570\u636e']
-    
-    if max_row is None:
-        max_row = datasheet.max_row
-    time = [col for col in datasheet.iter_cols(min_col=1, max_col=1, 
-                                               min_row=min_row, max_row=max_row,
-                                               values_only=True)]
-    time = np.array(time).flatten()
-    time = Time(time) - 8. * u.hour # convert from Bejing time to UTC
-    
-    data_col_min = 20
-    data_col_max = 22
-    data_name = [col for col in datasheet.iter_cols(min_col=data_col_min, max_col=data_col_max, 
-                                                    min_row=1, max_row=1,
-                                                    values_only=True)]
-    data = [col for col in datasheet.iter_cols(min_col=data_col_min, max_col=data_col_max, 
-                                               min_row=min_row, max_row=max_row,
-                                               values_only=True)]
-    print 'read ant. coord %s %s %s'%(tuple([x[0] for x in data_name]))
-
-    data = np.array(data)
-    X = data[0]
-    Y = data[1]
-    Z = data[2]
+    time, X, Y, Z = load_coord(coord_file, min_row, max_row, cache_dir)
+    time = Time(time, format='unix')
 
     # alt = 90. - za
     sinalt = -Z / (X**2 + Y**2 + Z**2) ** 0.5
@@ -201,3 +372,78 @@ def xyz2azalt(coord_file, min_row=2, max_row=None):
     az = 270. - az
     
     return time, az * u.deg, alt * u.deg
+
+def azalt_interp(coord_file, min_row=2, max_row=None, cache_dir=''):
+    '''
+    get the az and alt interpolators, as functions of unix time (UTC), of the
+    feed cabin coordinate file.
+    '''
+
+    time, az, alt = xyz2azalt(coord_file, min_row, max_row, cache_dir)
+    az_f  = interpolate.interp1d(time.unix, az.to(u.deg).value )
+    alt_f = interpolate.interp1d(time.unix, alt.to(u.deg).value)
+
+    return az_f, alt_f
+
+def load_coord(coord_file, min_row=2, max_row=None, cache_dir=''):
+    '''
+    read the time and X Y Z of the feed cabin coordinate file
+
+    The xlsx file is read in read-only streaming mode, and converted once to a
+    binary npz cache with time as unix seconds (UTC) and X, Y, Z as float64.
+    The cache is used if it is newer than the xlsx file.
+
+    cache_dir: directory of the cache file, '' for the directory of the xlsx
+               file, None to disable the cache.
+    '''
+
+    if cache_dir is not None:
+        if cache_dir == '':
+            cache_dir = os.path.dirname(os.path.abspath(coord_file))
+        cache_file = os.path.join(cache_dir, os.path.basename(coord_file) 
+                + '.%d-%s.npz'%(min_row, max_row))
+        if os.path.exists(cache_file) and \
+                os.path.getmtime(cache_file) >= os.path.getmtime(coord_file):
+            with np.load(cache_file) as f:
+                print 'read ant. coord %s %s %s from cache'%tuple(f['name'])
+                return f['time'], f['X'], f['Y'], f['Z']
+
+    wb = load_workbook(coord_file, read_only=True, data_only=True)
+    datasheet = wb[u'\u6d4b\u91cf\u6570\u636e']
+
+    data_col_min = 20
+    data_col_max = 22
+    data_name = next(datasheet.iter_rows(min_row=1, max_row=1, 
+                                         min_col=data_col_min, max_col=data_col_max, 
+                                         values_only=True))
+    print 'read ant. coord %s %s %s'%tuple(data_name)
+
+    time = []
+    data = []
+    for row in datasheet.iter_rows(min_row=min_row, max_row=max_row, 
+                                   max_col=data_col_max, values_only=True):
+        if row[0] is None:
+            break
+        # convert from Bejing time to UTC
+        time.append(calendar.timegm(row[0].timetuple()) 
+                + row[0].microsecond * 1.e-6 - 8. * 3600.)
+        data.append(row[data_col_min-1:data_col_max])
+    wb.close()
+
+    time = np.array(time, dtype='float64')
+    data = np.array(data, dtype='float64')
+    X = data[:, 0]
+    Y = data[:, 1]
+    Z = data[:, 2]
+
+    if cache_dir is not None:
+        try:
+            tmp_file = cache_file + '.%d.tmp'%os.getpid()
+            with open(tmp_file, 'wb') as f:
+                np.savez(f, time=time, X=X, Y=Y, Z=Z, 
+                         name=np.array([str(x) for x in data_name]))
+            os.rename(tmp_file, cache_file)
+        except (IOError, OSError) as e:
+            logger.warning('can not write coord cache %s: %s'%(cache_file, e))
+
+    return time, X, Y, Z
@@ -0,0 +1,64 @@
+"""Compare the fast AltAz to ICRS conversion with the exact one of astropy."""
+
+import unittest
+
+import numpy as np
+from astropy.utils import iers
+
+from fpipe.utils import coord
+
+iers.conf.auto_download = False
+
+
+def drift_scan(alt0, az0, n_time=1200, n_beam=5, spread=0.2):
+    """Alt Az [time, beam] of a drift scan, 1 s sampling, the beams spread
+    over `spread` deg around the pointing center (alt0, az0)."""
+
+    time = 1.6e9 + np.arange(n_time, dtype='float64')
+    d = np.linspace(-0.5, 0.5, n_beam)[1:] * spread
+    alt = np.append(alt0, np.minimum(alt0 + d, 90.))[None, :]
+    az = np.append(az0, az0 + d[::-1])[None, :]
+    return time, alt, az
+
+def max_sep(ra1, dec1, ra2, dec2):
+    """Max separation in arcsec."""
+
+    sep = coord._vec2sep(coord._sph2vec(ra1, dec1), coord._sph2vec(ra2, dec2))
+    return sep.max() * 180. / np.pi * 3600.
+
+
+class TestAltAz2RaDecFast(unittest.TestCase):
+
+    def compare(self, alt0, az0, **kwargs):
+
+        time, alt, az = drift_scan(alt0, az0)
+        ra, dec = coord.altaz2radec(time, alt, az)
+        ra_f, dec_f = coord.altaz2radec_fast(time, alt, az, **kwargs)
+        self.assertEqual(ra_f.shape, ra.shape)
+        return max_sep(ra, dec, ra_f, dec_f)
+
+    def test_drift_scan(self):
+
+        err = self.compare(60., 180.)
+        self.assertLess(err, coord._FAST_ACCURACY)
+
+    def test_near_zenith(self):
+
+        err = self.compare(89.95, 30.)
+        self.assertLess(err, coord._FAST_ACCURACY)
+
+    def test_at_zenith(self):
+
+        err = self.compare(90., 0.)
+        self.assertLess(err, coord._FAST_ACCURACY)
+
+    def test_check(self):
+
+        accuracy = 1.e-3
+        err = self.compare(89.95, 30., accuracy=accuracy, time_step=300.,
+                check=True)
+        self.assertLess(err, accuracy)
+
+
+if __name__ == '__main__':
+    unittest.main()